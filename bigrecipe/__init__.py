@@ -1,6 +1,6 @@
 import os
 import json
-from flask import Flask
+from flask import Flask, Response
 from flask_sqlalchemy import SQLAlchemy
 from bigrecipe.constants import *
 
@@ -14,7 +14,15 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY="dev",
         SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path, "development.db"),
-        SQLALCHEMY_TRACK_MODIFICATIONS=False
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        NAME_CACHE_SIZE=10000,
+        RESPONSE_CACHE=True,
+        RESPONSE_CACHE_BYTES=16 * 1024 * 1024,
+        RESPONSE_CACHE_TTL=60,
+        SQLITE_PROFILE="default",
+        SQLITE_PRAGMAS={},
+        SQLITE_POOL_SIZE=16,
+        METRICS=False
     )
 
     if test_config is None:
@@ -27,12 +35,41 @@ def create_app(test_config=None):
     except OSError:
         pass
 
+    from . import sqlite
+    sqlite.configure_engine(app)
     db.init_app(app)
+    sqlite.init_app(app)
 
+    from . import autocomplete
+    from . import benchmark
+    from . import cache
+    from . import generate
+    from . import index
+    from . import matrix
+    from . import metrics
     from . import models
+    from . import response_cache
+    from . import similar
+    from . import transfer
     from . import api
+    autocomplete.init_app(app)
+    cache.init_app(app)
+    index.init_app(app)
+    matrix.init_app(app)
+    metrics.init_app(app)
+    response_cache.init_app(app)
+    similar.init_app(app)
     app.cli.add_command(models.init_db_command)
+    app.cli.add_command(models.rebuild_search_command)
+    app.cli.add_command(models.upgrade_db_command)
+    app.cli.add_command(matrix.nutrition_report_command)
+    app.cli.add_command(similar.build_similar_command)
+    app.cli.add_command(sqlite.bench_sqlite_command)
     app.cli.add_command(models.generate_test_data)
+    app.cli.add_command(generate.generate_data_command)
+    app.cli.add_command(benchmark.benchmark_command)
+    app.cli.add_command(transfer.export_command)
+    app.cli.add_command(transfer.import_command)
     app.cli.add_command(models.generate_test_data_existing)
     app.cli.add_command(models.arbitrary_test)
     app.cli.add_command(models.generate_associations)
@@ -40,9 +77,24 @@ def create_app(test_config=None):
 
     @app.route("/api/")
     def send_entry():
-        entry = {"@namespaces":{"bigrec": {"name": "/bigrecipe/link-relations#"}},"@controls": {"bigrec:recipes-all": {"href": "/api/recipes/"},"bigrec:ingredients-all": {"href": "/api/ingredients/"}, "bigrec:drinks-all": {"href": "/api/recipes/"}}}
+        entry = {"@namespaces":{"bigrec": {"name": "/bigrecipe/link-relations#"}},"@controls": {"bigrec:recipes-all": {"href": "/api/recipes/"},"bigrec:ingredients-all": {"href": "/api/ingredients/"}, "bigrec:drinks-all": {"href": "/api/recipes/"}, "bigrec:pantry": {"href": "/api/pantry/", "method": "POST"}, "bigrec:nutrition": {"href": "/api/nutrition/", "method": "POST"}, "bigrec:shopping-list": {"href": "/api/shopping-list", "method": "POST"}, "bigrec:autocomplete": {"href": "/api/autocomplete?kind={kind}&prefix={prefix}", "isHrefTemplate": True}, "bigrec:batch": {"href": "/api/batch", "method": "POST"}, "bigrec:catalog": {"href": "/api/bulk/catalog/"}}}
         return entry
 
+    @app.route("/api/_stats/")
+    def send_stats():
+        stats = {"name_cache": cache.get_name_cache().stats()}
+        if response_cache.get_response_cache() is not None:
+            stats["response_cache"] = response_cache.get_response_cache().stats()
+        return stats
+
+    if app.config["METRICS"]:
+        @app.route("/api/_metrics")
+        def send_metrics():
+            return Response(
+                metrics.get_metrics().exposition(), 200,
+                mimetype="text/plain", content_type="text/plain; version=0.0.4; charset=utf-8"
+            )
+
     @app.route(LINK_RELATIONS_URL)
     def send_link_relations():
         return "link relations"
@@ -2,16 +2,32 @@ from flask import Blueprint
 from flask_restful import Api
 
 from bigrecipe.resources.ingredient import IngredientCollection, IngredientItem
-from bigrecipe.resources.recipe import RecipeItem, RecipeCollection, RecipeIngredientPairing
+from bigrecipe.resources.recipe import RecipeItem, RecipeCollection, RecipeIngredientPairing, RecipeImport, RecipeSearch
 from bigrecipe.resources.drink import DrinkItem, DrinkCollection
+from bigrecipe.resources.pantry import PantryMatch
+from bigrecipe.resources.nutrition import NutritionReport
+from bigrecipe.resources.shoppinglist import ShoppingList
+from bigrecipe.resources.similar import SimilarRecipes
+from bigrecipe.resources.autocomplete import Autocomplete
+from bigrecipe.resources.batch import Batch
+from bigrecipe.resources.catalog import Catalog
 
 api_bp = Blueprint("api", __name__, url_prefix="/api")
 api = Api(api_bp)
 
 api.add_resource(RecipeCollection, "/recipes/")
+api.add_resource(RecipeSearch, "/recipes/search")
 api.add_resource(RecipeItem, "/recipes/<recipe>/")
+api.add_resource(SimilarRecipes, "/recipes/<recipe>/similar/")
 api.add_resource(IngredientCollection, "/ingredients/")
 api.add_resource(IngredientItem, "/ingredients/<ingredient>/")
 api.add_resource(DrinkCollection, "/drinks/")
 api.add_resource(DrinkItem, "/drinks/<drink>/")
-api.add_resource(RecipeIngredientPairing, "/recipes/<recipe>/ingredients/")
\ No newline at end of file
+api.add_resource(RecipeIngredientPairing, "/recipes/<recipe>/ingredients/")
+api.add_resource(RecipeImport, "/bulk/recipes/")
+api.add_resource(Catalog, "/bulk/catalog/")
+api.add_resource(PantryMatch, "/pantry/")
+api.add_resource(NutritionReport, "/nutrition/")
+api.add_resource(ShoppingList, "/shopping-list")
+api.add_resource(Autocomplete, "/autocomplete")
+api.add_resource(Batch, "/batch")
\ No newline at end of file
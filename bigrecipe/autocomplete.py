@@ -0,0 +1,100 @@
+from bisect import bisect_left
+from flask import current_app
+from bigrecipe import db
+from bigrecipe.index import VersionedIndex
+from bigrecipe.models import Drink, Ingredient, Recipe, Revision
+
+"""
+Case-insensitive prefix lookups over the unique name columns, answered from
+sorted arrays in memory. Each kind of name gets its own index, built from the
+database on first use and rebuilt once the name revision of its kind moves,
+which only creates, deletes and renames do, unless the handler that wrote the
+names applied them in place.
+"""
+
+KINDS = {
+    "recipe": Recipe,
+    "ingredient": Ingredient,
+    "drink": Drink,
+}
+
+
+class PrefixIndex(VersionedIndex):
+    """
+    Names sorted by their casefolded form, kept in two parallel lists so a
+    prefix is found with one binary search.
+    """
+
+    def __init__(self, kind):
+        super().__init__(kind + "-names")
+        self._model = KINDS[kind]
+        self._keys = []
+        self._names = []
+
+    def build(self):
+        versions = Revision.current(*self.revisions)
+        pairs = sorted(
+            (name.casefold(), name) for (name,) in db.session.query(self._model.name).yield_per(10000)
+        )
+        with self._lock:
+            self._keys = [key for key, name in pairs]
+            self._names = [name for key, name in pairs]
+            self.versions = versions
+
+    def add(self, name):
+        key = name.casefold()
+        with self._lock:
+            if not self._writable:
+                return
+            i = bisect_left(self._keys, key)
+            while i < len(self._keys) and self._keys[i] == key and self._names[i] < name:
+                i += 1
+            self._keys.insert(i, key)
+            self._names.insert(i, name)
+
+    def remove(self, name):
+        key = name.casefold()
+        with self._lock:
+            if not self._writable:
+                return
+            i = bisect_left(self._keys, key)
+            while i < len(self._keys) and self._keys[i] == key:
+                if self._names[i] == name:
+                    del self._keys[i]
+                    del self._names[i]
+                    return
+                i += 1
+
+    def rename(self, old_name, new_name):
+        if old_name != new_name:
+            with self._lock:
+                self.remove(old_name)
+                self.add(new_name)
+
+    def complete(self, prefix, limit):
+        key = prefix.casefold()
+        with self._lock:
+            i = bisect_left(self._keys, key)
+            end = min(i + limit, len(self._keys))
+            matches = []
+            while i < end and self._keys[i].startswith(key):
+                matches.append(self._names[i])
+                i += 1
+            return matches
+
+
+def init_app(app):
+    app.extensions["prefix_index"] = {kind: PrefixIndex(kind) for kind in KINDS}
+
+def get_prefix_index(kind, build=True):
+    """
+    Returns the prefix index for one kind of name, brought up to date with
+    the database first. Writers pass build=False and apply their own changes
+    in an updating() block, as an index that isn't current will be rebuilt
+    anyway.
+    """
+
+    index = current_app.extensions["prefix_index"][kind]
+    if build:
+        index.ensure_current()
+    return index
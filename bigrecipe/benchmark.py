@@ -0,0 +1,314 @@
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from urllib.parse import quote
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, func
+from bigrecipe import create_app, db
+from bigrecipe.generate import generate_data_command
+from bigrecipe.models import Drink, Ingredient, Recipe, Recingpairings
+from bigrecipe.utils import encode_cursor
+
+"""
+Latency and query count benchmarks for every API resource. Each scale gets
+a database seeded by gen-data, kept in the instance folder so that it is only
+generated once. Every run works on a fresh copy of it, so the writes a run
+makes never leak into the next one. Requests go through the Flask test
+client, so no server or network is involved.
+"""
+
+DEFAULT_SCALES = "1000,100000,1000000"
+PAGE = 50
+
+
+def _seeded_database(scale, seed):
+    """
+    Returns the path of the seeded database of one scale, generating it if
+    it doesn't exist yet.
+    """
+
+    path = os.path.join(current_app.instance_path, "bench-{}-{}.db".format(scale, seed))
+    if os.path.exists(path):
+        return path
+    click.echo("Seeding {} recipes".format(scale))
+    # gen-data refreshes any signature files it finds, which must not be
+    # the ones of the development database
+    with tempfile.TemporaryDirectory() as folder:
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + path + ".tmp",
+            "SIMILAR_INDEX_PATH": os.path.join(folder, "similar"),
+        })
+        # The command runs in whichever app context is current, so the
+        # seeded app's context is pushed around it
+        with app.app_context():
+            db.create_all()
+            result = app.test_cli_runner().invoke(generate_data_command, [
+                "--recipes", str(scale),
+                "--ingredients", str(min(max(scale // 50, 100), 20000)),
+                "--seed", str(seed)
+            ])
+            db.engine.dispose()
+    if result.exit_code != 0:
+        raise click.ClickException("Seeding failed: {}".format(result.exception or result.output))
+    os.replace(path + ".tmp", path)
+    return path
+
+def _copy_database(source, path):
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(path)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+def _fixture(app):
+    """
+    Picks the rows the scenarios address: rows in the middle of each
+    collection, cursors near their ends and the most used ingredient.
+    """
+
+    with app.app_context():
+        recipes = Recipe.query.count()
+        ingredients = Ingredient.query.count()
+
+        def nth(column, n):
+            return db.session.query(column).order_by(column).offset(n).limit(1).scalar()
+
+        middle = db.session.query(Recipe.name, Recipe.text).filter(
+            Recipe.name == nth(Recipe.name, recipes // 2)
+        ).one()
+        popular = db.session.query(Ingredient.name).join(
+            Recingpairings, Recingpairings.ingredient_id == Ingredient.id
+        ).group_by(Ingredient.id).order_by(func.count().desc()).limit(1).scalar()
+        ingredient = db.session.query(Ingredient.name, Ingredient.unit).filter(
+            Ingredient.name == nth(Ingredient.name, ingredients // 2)
+        ).one()
+        drink = db.session.query(Drink.name, Drink.alcohol).order_by(Drink.id).first()
+        return {
+            "recipe": middle.name,
+            "recipe_text": middle.text,
+            "recipe_names": [name for (name,) in db.session.query(Recipe.name).order_by(Recipe.id).limit(PAGE)],
+            "deep_recipe": nth(Recipe.name, recipes * 9 // 10),
+            "deep_offset": recipes * 9 // 10,
+            "popular": popular,
+            "ingredient": ingredient.name,
+            "unit": ingredient.unit,
+            "deep_ingredient": nth(Ingredient.name, ingredients * 9 // 10),
+            "ingredient_names": [name for (name,) in db.session.query(Ingredient.name).order_by(Ingredient.id)],
+            "drink": drink.name,
+            "alcohol": drink.alcohol,
+        }
+
+def _scenarios(f):
+    """
+    Returns (name, method, expected status, request) for every scenario. The
+    request function gets the iteration number and returns a path and an
+    optional JSON body. Scenarios that create rows come before the ones that
+    delete them.
+    """
+
+    recipe = "/api/recipes/{}/".format(quote(f["recipe"], safe=""))
+    ingredient = "/api/ingredients/{}/".format(quote(f["ingredient"], safe=""))
+    drink = "/api/drinks/{}/".format(quote(f["drink"], safe=""))
+    pairings = "/api/recipes/bench-pairing/ingredients/"
+    names = f["ingredient_names"]
+    batch = [{"recipe": name} for name in f["recipe_names"]]
+
+    def pairing(i):
+        return {"recipe": "bench-pairing", "ingredient": names[i % len(names)], "amount": 1}
+
+    return [
+        ("recipe_collection_first", "GET", 200, lambda i: ("/api/recipes/?limit={}".format(PAGE), None)),
+        ("recipe_collection_deep", "GET", 200, lambda i: (
+            "/api/recipes/?limit={}&after={}".format(PAGE, encode_cursor(f["deep_recipe"])), None
+        )),
+        ("recipe_collection_offset_deep", "GET", 200, lambda i: (
+            "/api/recipes/?limit={}&start={}".format(PAGE, f["deep_offset"]), None
+        )),
+        ("recipe_collection_by_ingredient", "GET", 200, lambda i: (
+            "/api/recipes/?limit={}&ingredient={}".format(PAGE, quote(f["popular"], safe="")), None
+        )),
+        ("recipe_collection_post", "POST", 201, lambda i: (
+            "/api/recipes/", {"name": "bench-recipe-{}".format(i), "text": "bench"}
+        )),
+        ("recipe_item_get", "GET", 200, lambda i: (recipe, None)),
+        ("recipe_item_put", "PUT", 204, lambda i: (recipe, {
+            "name": f["recipe"], "text": f["recipe_text"], "description": "bench {}".format(i)
+        })),
+        ("recipe_item_delete", "DELETE", 204, lambda i: ("/api/recipes/bench-recipe-{}/".format(i), None)),
+        ("recipe_search", "GET", 200, lambda i: ("/api/recipes/search?q=stew", None)),
+        ("recipe_similar", "GET", 200, lambda i: (recipe + "similar/", None)),
+        ("recipe_import", "POST", 200, lambda i: ("/api/bulk/recipes/", [{
+            "name": "bench-import-{}".format(i), "text": "bench",
+            "ingredients": [{"ingredient": name, "amount": 1} for name in names[:10]]
+        }])),
+        ("pairing_get", "GET", 200, lambda i: (recipe + "ingredients/", None)),
+        ("pairing_post", "POST", 201, lambda i: (pairings, pairing(i))),
+        ("pairing_delete", "DELETE", 204, lambda i: (pairings, pairing(i))),
+        ("ingredient_collection_first", "GET", 200, lambda i: ("/api/ingredients/?limit={}".format(PAGE), None)),
+        ("ingredient_collection_deep", "GET", 200, lambda i: (
+            "/api/ingredients/?limit={}&after={}".format(PAGE, encode_cursor(f["deep_ingredient"])), None
+        )),
+        ("ingredient_collection_post", "POST", 201, lambda i: (
+            "/api/ingredients/", {"name": "bench-ingredient-{}".format(i), "unit": "g"}
+        )),
+        ("ingredient_item_get", "GET", 200, lambda i: (ingredient, None)),
+        ("ingredient_item_put", "PUT", 204, lambda i: (ingredient, {
+            "name": f["ingredient"], "unit": f["unit"], "description": "bench {}".format(i)
+        })),
+        ("ingredient_item_delete", "DELETE", 204, lambda i: ("/api/ingredients/bench-ingredient-{}/".format(i), None)),
+        ("drink_collection_first", "GET", 200, lambda i: ("/api/drinks/?limit={}".format(PAGE), None)),
+        ("drink_collection_post", "POST", 201, lambda i: (
+            "/api/drinks/", {"name": "bench-drink-{}".format(i), "alcohol": False}
+        )),
+        ("drink_item_get", "GET", 200, lambda i: (drink, None)),
+        ("drink_item_put", "PUT", 204, lambda i: (drink, {
+            "name": f["drink"], "alcohol": f["alcohol"], "description": "bench {}".format(i)
+        })),
+        ("drink_item_delete", "DELETE", 204, lambda i: ("/api/drinks/bench-drink-{}/".format(i), None)),
+        ("pantry", "POST", 200, lambda i: ("/api/pantry/", {
+            "ingredients": [{"ingredient": name} for name in names[:20]]
+        })),
+        ("nutrition", "POST", 200, lambda i: ("/api/nutrition/", {"recipes": batch})),
+        ("shopping_list", "POST", 200, lambda i: ("/api/shopping-list", {"recipes": batch})),
+        ("autocomplete", "GET", 200, lambda i: ("/api/autocomplete?kind=recipe&prefix=Sm", None)),
+        ("batch", "POST", 200, lambda i: ("/api/batch", {
+            "requests": ["/api/recipes/{}/".format(quote(name, safe="")) for name in f["recipe_names"][:20]]
+        })),
+    ]
+
+def _summary(times, queries):
+    times = np.array(times) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(times, 50)), 3),
+        "p90_ms": round(float(np.percentile(times, 90)), 3),
+        "p99_ms": round(float(np.percentile(times, 99)), 3),
+        "mean_ms": round(float(times.mean()), 3),
+        "max_ms": round(float(times.max()), 3),
+        "queries": round(float(np.mean(queries)), 2),
+    }
+
+def run_scale(source, iterations, warmup, response_cache):
+    """
+    Runs every scenario against a copy of one seeded database and returns
+    the summaries by scenario name.
+    """
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "bench.db")
+        _copy_database(source, path)
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + path,
+            "SIMILAR_INDEX_PATH": os.path.join(folder, "similar"),
+            "RESPONSE_CACHE": response_cache,
+        })
+        fixture = _fixture(app)
+        client = app.test_client()
+        if client.post("/api/recipes/", json={"name": "bench-pairing", "text": "bench"}).status_code != 201:
+            raise click.ClickException("Could not create the pairing recipe")
+
+        statements = []
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", lambda *args: statements.append(None))
+
+        results = {}
+        for name, method, status, make in _scenarios(fixture):
+            times = []
+            queries = []
+            for i in range(-warmup, iterations):
+                href, body = make(i)
+                del statements[:]
+                start = time.perf_counter()
+                resp = client.open(href, method=method, json=body)
+                elapsed = time.perf_counter() - start
+                if resp.status_code != status:
+                    raise click.ClickException("{} {} gave {}, expected {}: {}".format(
+                        method, href, resp.status_code, status, resp.get_data(as_text=True)[:200]
+                    ))
+                if i >= 0:
+                    times.append(elapsed)
+                    queries.append(len(statements))
+            results[name] = _summary(times, queries)
+        engine.dispose()
+        return results
+
+def compare(results, baseline, metric, threshold, min_delta):
+    """
+    Lists the scenarios that got slower than the baseline by more than
+    threshold (a fraction) and min_delta milliseconds, or that run more
+    queries than they did.
+    """
+
+    regressions = []
+    for scale, scenarios in results["scales"].items():
+        for name, current in scenarios.items():
+            old = baseline.get("scales", {}).get(scale, {}).get(name)
+            if old is None:
+                continue
+            before, after = old[metric], current[metric]
+            if after > before * (1 + threshold) and after - before > min_delta:
+                regressions.append("{} {}: {} {:.3f} ms -> {:.3f} ms ({:+.0%})".format(
+                    scale, name, metric, before, after, after / before - 1 if before else 1
+                ))
+            if current["queries"] > old["queries"]:
+                regressions.append("{} {}: queries {} -> {}".format(
+                    scale, name, old["queries"], current["queries"]
+                ))
+    return regressions
+
+@click.command("benchmark")
+@click.option("--scales", default=DEFAULT_SCALES, help="Comma separated recipe counts")
+@click.option("--iterations", default=50, help="Timed requests per scenario")
+@click.option("--warmup", default=3, help="Untimed requests before each scenario")
+@click.option("--seed", default=42, help="Seed of the generated databases")
+@click.option("--response-cache/--no-response-cache", default=False, help="Run with the response cache on")
+@click.option("--output", default=None, help="Where to write the results, instance/benchmark.json by default")
+@click.option("--baseline", default=None, help="Earlier results to compare against")
+@click.option("--metric", default="p50_ms", type=click.Choice(["p50_ms", "p90_ms", "p99_ms", "mean_ms"]))
+@click.option("--threshold", default=0.2, help="Slowdown that counts as a regression, as a fraction")
+@click.option("--min-delta", default=0.5, help="Smallest slowdown in milliseconds that counts")
+@with_appcontext
+def benchmark_command(scales, iterations, warmup, seed, response_cache, output, baseline, metric, threshold, min_delta):
+    """
+    Measures latency percentiles and queries per request of every API
+    resource at each data scale, and compares them against a baseline.
+    """
+
+    try:
+        scales = [int(scale) for scale in scales.split(",")]
+    except ValueError:
+        raise click.BadParameter("scales must be comma separated numbers")
+    if iterations < 1 or warmup < 0:
+        raise click.BadParameter("iterations must be positive")
+
+    results = {"iterations": iterations, "warmup": warmup, "seed": seed, "scales": {}}
+    for scale in scales:
+        source = _seeded_database(scale, seed)
+        click.echo("Running {} recipes".format(scale))
+        scenarios = run_scale(source, iterations, warmup, response_cache)
+        results["scales"][str(scale)] = scenarios
+        for name, summary in scenarios.items():
+            click.echo("  {:32} p50 {:8.3f} ms  p90 {:8.3f} ms  p99 {:8.3f} ms  {:6.2f} queries".format(
+                name, summary["p50_ms"], summary["p90_ms"], summary["p99_ms"], summary["queries"]
+            ))
+
+    output = output or os.path.join(current_app.instance_path, "benchmark.json")
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    click.echo("Wrote {}".format(output))
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), metric, threshold, min_delta)
+        for line in regressions:
+            click.echo("REGRESSION " + line)
+        if regressions:
+            raise SystemExit(1)
+        click.echo("No regressions against {}".format(baseline))
@@ -0,0 +1,175 @@
+import threading
+from collections import OrderedDict
+from flask import current_app, g, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from bigrecipe import db
+from bigrecipe.utils import query_in_chunks
+
+"""
+Name to primary key resolution for the models that are addressed by their
+unique name in the API. Lookups go through an identity map that lives for
+the current request, then a bounded LRU shared by the whole process, and only
+then the database.
+"""
+
+
+class NameCache(object):
+    """
+    A thread safe, size bounded LRU mapping (model name, row name) pairs to
+    primary keys. Hit and miss counters are kept for sizing the cache.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                pk = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return pk
+
+    def put(self, key, pk):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = pk
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+def init_app(app):
+    app.extensions["name_cache"] = NameCache(app.config["NAME_CACHE_SIZE"])
+
+def get_name_cache():
+    return current_app.extensions["name_cache"]
+
+def _request_map():
+    if "name_ids" not in g:
+        g.name_ids = {}
+    return g.name_ids
+
+def lookup_id(model, name, verify=False):
+    """
+    Resolves the primary key of the model row with the given unique name, or
+    None if there is no such row. Handlers that write with the id pass
+    verify, which checks a remembered id against the row it points to, as
+    get_by_name does, since another process may have deleted the row and
+    given its id to a new one.
+    """
+
+    key = model.__name__, name
+    request_map = _request_map()
+    cache = get_name_cache()
+    pk = request_map[key] if key in request_map else cache.get(key)
+    if pk is not None and verify and db.session.query(model.name).filter_by(id=pk).scalar() != name:
+        invalidate_name(model, name)
+        pk = None
+    if pk is None:
+        pk = db.session.query(model.id).filter_by(name=name).scalar()
+        if pk is not None:
+            cache.put(key, pk)
+    if pk is not None:
+        request_map[key] = pk
+    return pk
+
+def prefetch(model, names, *options):
+    """
+    Loads the rows with the given names in one IN query per chunk of names
+    and remembers their ids for the current request. Lookups that follow
+    are then answered by the session's identity map without queries. Extra
+    arguments are passed on as loader options.
+    """
+
+    request_map = _request_map()
+    names = [name for name in set(names) if (model.__name__, name) not in request_map]
+    cache = get_name_cache()
+    # The identity map holds rows weakly, so they are kept alive here
+    if "prefetched" not in g:
+        g.prefetched = {}
+    for row in query_in_chunks(model.query.options(*options), model.name, names):
+        key = model.__name__, row.name
+        request_map[key] = row.id
+        cache.put(key, row.id)
+        g.prefetched[key] = row
+
+def prefetched(model, name):
+    """
+    Returns the row with the given name if prefetch loaded it during the
+    current request, otherwise None.
+    """
+
+    return g.get("prefetched", {}).get((model.__name__, name))
+
+def get_by_name(model, name, *options):
+    """
+    Fetches the model row with the given unique name, or None. The cached id
+    is checked against the row it points to, so an entry made stale by
+    another process falls back to a query by name. Extra arguments are
+    passed on as loader options.
+    """
+
+    pk = lookup_id(model, name)
+    if pk is None:
+        return None
+    row = db.session.get(model, pk, options=options)
+    if row is not None and row.name == name:
+        return row
+
+    invalidate_name(model, name)
+    row = model.query.options(*options).filter_by(name=name).first()
+    if row is not None:
+        get_name_cache().put((model.__name__, name), row.id)
+    return row
+
+def invalidate_name(model, name):
+    key = model.__name__, name
+    _request_map().pop(key, None)
+    get_name_cache().invalidate(key)
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_flushed(session, flush_context):
+    """
+    Drops cache entries for every named row that was renamed or deleted in
+    the flush, so no handler can serve a stale id after a write.
+    """
+
+    if not has_app_context() or "name_cache" not in current_app.extensions:
+        return
+    for obj in session.deleted:
+        name = inspect(obj).dict.get("name")
+        if name is not None:
+            invalidate_name(type(obj), name)
+    for obj in session.dirty:
+        if hasattr(obj, "name"):
+            for name in inspect(obj).attrs.name.history.deleted or ():
+                invalidate_name(type(obj), name)
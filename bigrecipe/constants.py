@@ -1,4 +1,5 @@
 MASON = "application/vnd.mason+json"
+NDJSON = "application/x-ndjson"
 LINK_RELATIONS_URL = "/bigrec/link-relations/"
 ERROR_PROFILE = "/profiles/error/"
 
@@ -13,3 +14,48 @@ DRINKCOLLECTION_PROFILE= "/profiles/drinkcollection/"
 #Low recipe page size to demonstrate pagination.
 #RECIPE_PAGE_SIZE = 50
 RECIPE_PAGE_SIZE = 2
+#Upper bound for the ?limit= query parameter on paginated collections
+MAX_PAGE_SIZE = 100
+PANTRY_PAGE_SIZE = 20
+SEARCH_PAGE_SIZE = 10
+INGREDIENT_PAGE_SIZE = 50
+DRINK_PAGE_SIZE = 50
+#Fields a client can pick with ?fields=, in the order they are rendered.
+#Recipe lists leave out the unbounded text unless it is asked for.
+RECIPE_FIELDS = ("name", "description", "text", "calories")
+RECIPE_LIST_FIELDS = ("name", "description", "calories")
+INGREDIENT_FIELDS = ("name", "unit", "calories", "description")
+DRINK_FIELDS = ("name", "alcohol", "description")
+#Related resources a client can have nested in an item with ?embed=
+RECIPE_EMBEDS = ("ingredients", "drink")
+INGREDIENT_EMBEDS = ("recipes",)
+DRINK_EMBEDS = ("recipes",)
+#Most recipes nested in one ingredient or drink, the rest are paged through
+#the recipe collection
+EMBED_SIZE = 100
+AUTOCOMPLETE_SIZE = 10
+#Most recipes one nutrition request may ask about
+NUTRITION_BATCH_SIZE = 10000
+#Most paths one batch GET may ask for
+BATCH_SIZE = 100
+SIMILAR_SIZE = 5
+#MinHash signature length and the number of LSH bands it is split into.
+#Recipes sharing a band of 4 hash values become candidates, which finds
+#most pairs with a Jaccard similarity above 0.5.
+MINHASH_SIZE = 64
+LSH_BANDS = 16
+#Fixed so that signatures written by one process are valid in every other
+MINHASH_SEED = 20200501
+#How many ingredients a pantry match may lack when the client doesn't say
+PANTRY_MAX_MISSING = 2
+#Rows fetched per round trip, and items sent per chunk, when streaming
+STREAM_CHUNK_SIZE = 500
+#SQLite limits the number of bound parameters per statement, so long IN
+#lists are split into chunks of this size
+IN_CLAUSE_CHUNK = 500
+#Rows of an NDJSON catalog import written per batch of statements, and the
+#ways an import can treat rows whose names already exist
+TRANSFER_BATCH_SIZE = 5000
+CONFLICT_POLICIES = ("skip", "overwrite", "fail")
+#Upper bounds in seconds of the request latency histogram buckets
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
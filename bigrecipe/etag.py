@@ -0,0 +1,61 @@
+from flask import Response, request
+from bigrecipe import db
+from bigrecipe.models import Revision
+from bigrecipe.utils import create_error_response
+
+"""
+Strong ETags built from version counters. Items use the version column of
+their rows, collections the counters in the revision table. Both are cheap
+to look up, so a conditional request can be answered before any rows are
+fetched or any body is serialized.
+"""
+
+
+def make_etag(*versions):
+    return "-".join("0" if version is None else str(version) for version in versions)
+
+def row_etag(query):
+    """
+    Makes an ETag from the version columns selected by query, or returns
+    None if the query finds no row.
+    """
+
+    row = query.first()
+    if row is None:
+        return None
+    return make_etag(*row)
+
+def collection_etag(*names):
+    versions = dict(
+        db.session.query(Revision.name, Revision.version).filter(Revision.name.in_(names))
+    )
+    return make_etag(*(versions.get(name) for name in names))
+
+def not_modified(etag):
+    """
+    Returns a 304 response if the client's copy matches etag, otherwise
+    None.
+    """
+
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+def precondition_failed(etag):
+    """
+    Returns a 412 error response if the request has an If-Match header that
+    doesn't match etag, otherwise None.
+    """
+
+    if request.if_match and not request.if_match.contains(etag):
+        return create_error_response(
+            412, "Precondition failed",
+            "The resource has been modified since it was fetched"
+        )
+    return None
+
+def tagged(response, etag):
+    response.set_etag(etag)
+    return response
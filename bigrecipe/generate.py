@@ -0,0 +1,186 @@
+import random
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import text
+from bigrecipe import db
+from bigrecipe.models import Drink, Ingredient, Recipe, Recingpairings, Revision
+
+"""
+Synthetic data for load testing. Every row is generated from a seeded random
+generator, so the same options always give the same database. Rows are
+inserted with Core executemany in chunks, one transaction per chunk of
+recipes, with ids assigned up front so that pairings never need to read
+anything back.
+"""
+
+_STYLES = [
+    "Smoky", "Spicy", "Creamy", "Crispy", "Rustic", "Hearty", "Zesty", "Tangy",
+    "Golden", "Roasted", "Grilled", "Braised", "Quick", "Classic", "Sweet",
+    "Savory", "Lemony", "Garlicky", "Herbed", "Honey Glazed",
+]
+_DISHES = [
+    "Stew", "Chili", "Soup", "Salad", "Curry", "Pie", "Risotto", "Pasta",
+    "Tacos", "Burger", "Casserole", "Stir Fry", "Sandwich", "Bowl", "Skillet",
+    "Roast", "Bake", "Noodles", "Pancakes", "Omelette",
+]
+_FOODS = [
+    "Lentil", "Chickpea", "Bean", "Rice", "Potato", "Tomato", "Onion", "Garlic",
+    "Carrot", "Pepper", "Mushroom", "Spinach", "Kale", "Cabbage", "Pumpkin",
+    "Zucchini", "Eggplant", "Corn", "Pea", "Broccoli", "Cauliflower", "Leek",
+    "Chicken", "Beef", "Pork", "Lamb", "Salmon", "Cod", "Shrimp", "Tofu",
+    "Egg", "Cheese", "Butter", "Cream", "Milk", "Yogurt", "Flour", "Oat",
+    "Barley", "Quinoa", "Noodle", "Apple", "Lemon", "Lime", "Orange", "Berry",
+    "Coconut", "Almond", "Walnut", "Peanut", "Sesame", "Ginger", "Chili",
+    "Basil", "Parsley", "Dill", "Thyme", "Cumin", "Paprika", "Honey",
+]
+_FORMS = [
+    "Fresh", "Dried", "Frozen", "Organic", "Smoked", "Ground", "Whole",
+    "Chopped", "Canned", "Raw",
+]
+_UNITS = ["g", "g", "g", "ml", "ml", "whole", "tbsp", "tsp", "cup"]
+_DRINKS = ["Lager", "Stout", "Cider", "Red Wine", "White Wine", "Lemonade", "Iced Tea", "Juice", "Soda", "Kombucha"]
+_STEPS = [
+    "Chop the {} and set it aside.",
+    "Heat a pan and fry the {} until golden.",
+    "Stir in the {} and let it simmer for a while.",
+    "Season the {} to taste.",
+    "Fold the {} in gently.",
+    "Roast the {} in a hot oven.",
+    "Whisk the {} until smooth.",
+    "Top with the {} and serve.",
+]
+
+
+def parse_range(value):
+    """
+    Parses a "low-high" or single number option into a (low, high) pair.
+    """
+
+    low, sep, high = value.partition("-")
+    try:
+        low = int(low)
+        high = int(high) if sep else low
+    except ValueError:
+        raise click.BadParameter("expected a number or a range like 5-30")
+    if low < 0 or high < low:
+        raise click.BadParameter("expected a range like 5-30")
+    return low, high
+
+def _ingredient_rows(rng, count):
+    names = ["{} {}".format(form, food) for form in _FORMS for food in _FOODS]
+    rng.shuffle(names)
+    rows = []
+    for i in range(count):
+        name = names[i % len(names)]
+        if i >= len(names):
+            name = "{} {}".format(name, i // len(names) + 1)
+        unit = rng.choice(_UNITS)
+        calories = rng.randint(1, 9) if unit in ("g", "ml") else rng.randint(5, 400)
+        rows.append({
+            "id": i + 1,
+            "name": name,
+            "unit": unit,
+            # One in ten ingredients has no calorie count
+            "calories": None if rng.random() < 0.1 else calories,
+            "description": "{} from the {} aisle".format(name, rng.choice(_FORMS).lower()),
+        })
+    return rows
+
+def _drink_rows(rng, count):
+    return [
+        {
+            "id": i + 1,
+            "name": "{} {} {}".format(rng.choice(_STYLES), rng.choice(_DRINKS), i + 1),
+            "alcohol": rng.random() < 0.5,
+            "description": None if rng.random() < 0.3 else "Goes with most things",
+        }
+        for i in range(count)
+    ]
+
+def _pick_ingredients(rng, count, size):
+    # A few ingredients turn up in most recipes, like in real ones
+    picked = set()
+    size = min(size, count)
+    while len(picked) < size:
+        picked.add(int(count * rng.random() ** 3) + 1)
+    return picked
+
+@click.command("gen-data")
+@click.option("--recipes", default=1000, help="Number of recipes")
+@click.option("--ingredients", default=200, help="Number of ingredients")
+@click.option("--drinks", default=None, type=int, help="Number of drinks, a hundredth of the recipes by default")
+@click.option("--pairings-per-recipe", "pairings", default="5-30", help="Ingredients per recipe, a number or a range")
+@click.option("--seed", default=42, help="Seed of the random generator")
+@click.option("--batch-size", default=50000, help="Recipes inserted per transaction")
+@with_appcontext
+def generate_data_command(recipes, ingredients, drinks, pairings, seed, batch_size):
+    """
+    Fills an empty database with deterministic synthetic recipes,
+    ingredients, drinks and pairings for load testing.
+    """
+
+    low, high = parse_range(pairings)
+    if drinks is None:
+        drinks = max(recipes // 100, 1)
+    if ingredients < 1 or recipes < 0 or batch_size < 1:
+        raise click.BadParameter("counts must be positive")
+    for model in (Recipe, Ingredient, Drink):
+        if db.session.query(model.query.exists()).scalar():
+            raise click.ClickException("gen-data needs an empty database, run init-db on a new file first")
+
+    rng = random.Random(seed)
+    # The command is a one off load, durability of every commit doesn't matter
+    db.session.execute(text("PRAGMA synchronous=OFF"))
+
+    ingredient_rows = _ingredient_rows(rng, ingredients)
+    db.session.execute(Ingredient.__table__.insert(), ingredient_rows)
+    db.session.execute(Drink.__table__.insert(), _drink_rows(rng, drinks))
+    db.session.commit()
+    calories = [0] + [row["calories"] or 0 for row in ingredient_rows]
+    units = [None] + [row["unit"] for row in ingredient_rows]
+    names = [None] + [row["name"].lower() for row in ingredient_rows]
+    click.echo("Inserted {} ingredients and {} drinks".format(ingredients, drinks))
+
+    total_pairings = 0
+    with click.progressbar(length=recipes, label="Inserting recipes") as bar:
+        for start in range(0, recipes, batch_size):
+            recipe_rows = []
+            pairing_rows = []
+            for recipe_id in range(start + 1, min(start + batch_size, recipes) + 1):
+                picked = sorted(_pick_ingredients(rng, ingredients, rng.randint(low, high)))
+                total = 0
+                for ingredient_id in picked:
+                    amount = rng.randint(10, 500) if units[ingredient_id] in ("g", "ml") else rng.randint(1, 5)
+                    total += amount * calories[ingredient_id]
+                    pairing_rows.append({"recipe_id": recipe_id, "ingredient_id": ingredient_id, "amount": amount})
+                style, dish = rng.choice(_STYLES), rng.choice(_DISHES)
+                main = names[picked[0]] if picked else rng.choice(_FOODS).lower()
+                recipe_rows.append({
+                    "id": recipe_id,
+                    "name": "{} {} {} {}".format(style, main.title(), dish, recipe_id),
+                    "description": None if rng.random() < 0.2 else "A {} {} for {} people".format(
+                        style.lower(), dish.lower(), rng.randint(1, 8)
+                    ),
+                    "text": " ".join(
+                        rng.choice(_STEPS).format(names[pk]) for pk in picked[:8]
+                    ) or "Serve as it is.",
+                    "calories": total,
+                    "drink_id": rng.randint(1, drinks) if rng.random() < 0.3 else None,
+                })
+            db.session.execute(Recipe.__table__.insert(), recipe_rows)
+            if pairing_rows:
+                db.session.execute(Recingpairings.__table__.insert(), pairing_rows)
+            db.session.commit()
+            total_pairings += len(pairing_rows)
+            bar.update(len(recipe_rows))
+
+    # Core inserts don't go through the flush events
+    Revision.bump(*Revision.NAMES)
+    db.session.commit()
+    # Signatures left from an older database would be wrong for this one
+    similar_index = current_app.extensions["similar_index"]
+    if similar_index.load():
+        similar_index.build()
+        similar_index.save()
+    click.echo("Inserted {} recipes with {} pairings".format(recipes, total_pairings))
@@ -0,0 +1,226 @@
+import threading
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from contextlib import contextmanager
+from flask import current_app
+from bigrecipe import db
+from bigrecipe.models import Recipe, Recingpairings, Revision
+
+"""
+In-memory inverted index from ingredients to the recipes that use them, used
+to answer multi-ingredient recipe filters without joins. The index is built
+from the database the first time it is needed and rebuilt whenever the
+revision table shows a write it hasn't seen, which also covers writes made
+by other processes. The handler that made a write applies it in place
+instead, when the index was current right before that write.
+"""
+
+
+def _contains(postings, value):
+    i = bisect_left(postings, value)
+    return i < len(postings) and postings[i] == value
+
+
+class VersionedIndex(object):
+    """
+    Base of the indexes derived from database rows. versions holds the
+    revision versions the index reflects, read before the rows it was built
+    from, so a write committed during a build only makes the index look
+    older than it is and it is built again on the next use.
+    """
+
+    def __init__(self, *revisions):
+        self.revisions = revisions
+        self.versions = None
+        self._writable = False
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()
+
+    @property
+    def built(self):
+        return self.versions is not None
+
+    def ensure_current(self):
+        """
+        Builds the index again if a revision it depends on has moved since
+        it was built.
+        """
+
+        if Revision.current(*self.revisions) == self.versions:
+            return
+        with self._build_lock:
+            # Another thread may have caught up while this one waited
+            if Revision.current(*self.revisions) != self.versions:
+                self.build()
+
+    @contextmanager
+    def updating(self):
+        """
+        Lets the updates made in the block through if the index was current
+        right before the transaction that was just committed, and then moves
+        it to the versions after that transaction. Otherwise the updates are
+        ignored and the index is rebuilt when it is next used.
+        """
+
+        changes = Revision.committed(*self.revisions)
+        with self._lock:
+            self._writable = self.built and bool(changes) and all(
+                self.versions.get(name) == before for name, (before, after) in changes.items()
+            )
+            try:
+                yield self
+            finally:
+                if self._writable:
+                    self.versions = dict(self.versions, **{name: after for name, (before, after) in changes.items()})
+                self._writable = False
+
+
+class RecipeIndex(VersionedIndex):
+    """
+    Holds a sorted array of recipe ids for every ingredient id, plus the
+    recipe names in sorted order so that filtered results can be paged by
+    name entirely in memory.
+    """
+
+    def __init__(self):
+        # Only names, ids and pairings are held, so edits to recipe text or
+        # calorie totals leave the index current
+        super().__init__("recipe-names", "pairing")
+        self._postings = {}
+        self._names = []
+        self._ids_by_name = {}
+        self._names_by_id = {}
+
+    def build(self):
+        versions = Revision.current(*self.revisions)
+        postings = {}
+        for ingredient_id, recipe_id in db.session.query(
+            Recingpairings.ingredient_id, Recingpairings.recipe_id
+        ).order_by(Recingpairings.ingredient_id, Recingpairings.recipe_id).yield_per(10000):
+            if ingredient_id not in postings:
+                postings[ingredient_id] = array("i")
+            postings[ingredient_id].append(recipe_id)
+        ids_by_name = dict(db.session.query(Recipe.name, Recipe.id))
+
+        with self._lock:
+            self._postings = postings
+            self._ids_by_name = ids_by_name
+            self._names_by_id = {pk: name for name, pk in ids_by_name.items()}
+            self._names = sorted(ids_by_name)
+            self.versions = versions
+
+    def add_recipe(self, recipe_id, name):
+        with self._lock:
+            if not self._writable:
+                return
+            insort(self._names, name)
+            self._ids_by_name[name] = recipe_id
+            self._names_by_id[recipe_id] = name
+
+    def rename_recipe(self, recipe_id, old_name, new_name):
+        with self._lock:
+            if not self._writable or old_name == new_name:
+                return
+            self._remove_name(old_name)
+            self.add_recipe(recipe_id, new_name)
+
+    def remove_recipe(self, recipe_id, name):
+        with self._lock:
+            if not self._writable:
+                return
+            # Recipes can only be deleted once their pairings are gone, so
+            # there is nothing to remove from the posting lists.
+            self._remove_name(name)
+            self._names_by_id.pop(recipe_id, None)
+
+    def _remove_name(self, name):
+        i = bisect_left(self._names, name)
+        if i < len(self._names) and self._names[i] == name:
+            del self._names[i]
+        self._ids_by_name.pop(name, None)
+
+    def add_pairing(self, recipe_id, ingredient_id):
+        with self._lock:
+            if not self._writable:
+                return
+            postings = self._postings.setdefault(ingredient_id, array("i"))
+            if not _contains(postings, recipe_id):
+                insort(postings, recipe_id)
+
+    def remove_pairing(self, recipe_id, ingredient_id):
+        with self._lock:
+            if not self._writable:
+                return
+            postings = self._postings.get(ingredient_id, ())
+            i = bisect_left(postings, recipe_id)
+            if i < len(postings) and postings[i] == recipe_id:
+                del postings[i]
+
+    def page(self, include, exclude, limit, after=None, before=None, start=None):
+        """
+        Finds one page of recipe names for recipes that use every ingredient
+        id in include and none in exclude, ordered by name. Paging works like
+        utils.keyset_page, with start as an optional offset for old clients.
+
+        Returns a tuple of (names, has_prev, has_next).
+        """
+
+        with self._lock:
+            excluded = [self._postings.get(pk, ()) for pk in exclude]
+            if include:
+                # Intersect starting from the rarest ingredient, so every
+                # other posting list is only probed with binary searches.
+                included = sorted((self._postings.get(pk, ()) for pk in include), key=len)
+                candidates = [
+                    recipe_id for recipe_id in included[0]
+                    if all(_contains(postings, recipe_id) for postings in included[1:])
+                    and not any(_contains(postings, recipe_id) for postings in excluded)
+                ]
+                names = sorted(self._names_by_id[recipe_id] for recipe_id in candidates)
+                keep = None
+            else:
+                names = self._names
+                ids_by_name = self._ids_by_name
+                keep = None
+                if excluded:
+                    keep = lambda name: not any(_contains(postings, ids_by_name[name]) for postings in excluded)
+
+            if before is not None:
+                pos = bisect_left(names, before)
+                rows = self._collect(names, range(pos - 1, -1, -1), keep, limit + 1)
+                has_prev = len(rows) > limit
+                rows = rows[:limit]
+                rows.reverse()
+                return rows, has_prev, True
+
+            pos = bisect_right(names, after) if after is not None else 0
+            skip = start or 0
+            rows = self._collect(names, range(pos, len(names)), keep, skip + limit + 1)[skip:]
+            return rows[:limit], after is not None or skip > 0, len(rows) > limit
+
+    @staticmethod
+    def _collect(names, positions, keep, count):
+        rows = []
+        for i in positions:
+            if keep is None or keep(names[i]):
+                rows.append(names[i])
+                if len(rows) >= count:
+                    break
+        return rows
+
+
+def init_app(app):
+    app.extensions["recipe_index"] = RecipeIndex()
+
+def get_recipe_index(build=True):
+    """
+    Returns the recipe index of the current app, brought up to date with the
+    database first. Writers pass build=False and apply their own changes in
+    an updating() block, as an index that isn't current will be rebuilt
+    anyway.
+    """
+
+    index = current_app.extensions["recipe_index"]
+    if build:
+        index.ensure_current()
+    return index
@@ -0,0 +1,198 @@
+import click
+import csv
+import threading
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+from bigrecipe import db
+from bigrecipe.models import Ingredient, Recipe, Recingpairings, Revision
+
+"""
+Recipe x ingredient matrix in compressed sparse row form, built from
+Recingpairings with NumPy arrays, together with the ingredient calories as a
+dense vector, so that questions about the whole catalog can be answered with
+a few vectorized operations instead of per recipe loops. The matrix is cached
+per app, keyed on the revisions of recipe and ingredient names, pairings and
+calories it was loaded at, and loaded again on the first use after any
+process moves one of them. Edits to recipe text or descriptions leave it be.
+"""
+
+
+class RecipeMatrix(object):
+    """
+    Rows are recipes ordered by name, columns are ingredients ordered by id.
+    The nonzero entries of row i are indices[indptr[i]:indptr[i + 1]] with
+    the pairing amounts in the same positions of amounts. Calories per unit
+    of every column are kept in calories.
+    """
+
+    def __init__(self, recipe_ids, recipe_names, ingredient_ids, calories, indptr, indices, amounts):
+        self.recipe_ids = recipe_ids
+        self.recipe_names = recipe_names
+        self.rows_by_name = {name: row for row, name in enumerate(recipe_names)}
+        self.ingredient_ids = ingredient_ids
+        self.calories = calories
+        self.indptr = indptr
+        self.indices = indices
+        self.amounts = amounts
+        self.row_sizes = np.diff(indptr)
+        # Row number of every stored entry, for row-wise sums with bincount
+        self.entry_rows = np.repeat(np.arange(len(recipe_ids)), self.row_sizes)
+
+    @classmethod
+    def load(cls):
+        recipes = db.session.query(Recipe.id, Recipe.name).order_by(Recipe.name).all()
+        recipe_ids = np.array([pk for pk, name in recipes], dtype=np.int64)
+        recipe_names = [name for pk, name in recipes]
+        ingredients = db.session.query(Ingredient.id, Ingredient.calories).order_by(Ingredient.id).all()
+        ingredient_ids = np.array([pk for pk, calories in ingredients], dtype=np.int64)
+        calories = np.array(
+            [calories if calories is not None else 0 for pk, calories in ingredients], dtype=np.float64
+        )
+
+        pairings = db.session.query(
+            Recingpairings.recipe_id, Recingpairings.ingredient_id, Recingpairings.amount
+        ).all()
+        pair_recipes = np.array([row[0] for row in pairings], dtype=np.int64)
+        pair_ingredients = np.array([row[1] for row in pairings], dtype=np.int64)
+        pair_amounts = np.array(
+            [row[2] if row[2] is not None else 0 for row in pairings], dtype=np.float64
+        )
+
+        # Map database ids to row and column positions
+        by_id = np.argsort(recipe_ids)
+        rows = by_id[np.searchsorted(recipe_ids, pair_recipes, sorter=by_id)]
+        columns = np.searchsorted(ingredient_ids, pair_ingredients)
+
+        order = np.lexsort((columns, rows))
+        indptr = np.zeros(len(recipe_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(recipe_ids)), out=indptr[1:])
+        return cls(
+            recipe_ids, recipe_names, ingredient_ids, calories,
+            indptr, columns[order], pair_amounts[order]
+        )
+
+    def column_vector(self, values, fill=0.0):
+        """
+        Turns a dict of ingredient id -> value into a dense vector over the
+        matrix columns. Ingredients that are not in the matrix are ignored.
+        """
+
+        vector = np.full(len(self.ingredient_ids), fill, dtype=np.float64)
+        if values:
+            ids = np.fromiter(values.keys(), dtype=np.int64, count=len(values))
+            positions = np.searchsorted(self.ingredient_ids, ids)
+            known = positions < len(self.ingredient_ids)
+            known[known] = self.ingredient_ids[positions[known]] == ids[known]
+            vector[positions[known]] = np.fromiter(values.values(), dtype=np.float64, count=len(values))[known]
+        return vector
+
+    def count_missing(self, have):
+        """
+        Counts for every recipe how many of its ingredients are not covered,
+        where have holds the available amount of every ingredient column.
+        """
+
+        covered = have[self.indices] >= self.amounts
+        return self.row_sizes - np.bincount(
+            self.entry_rows, weights=covered, minlength=len(self.recipe_ids)
+        ).astype(np.int64)
+
+    def missing_columns(self, row, have):
+        start, end = self.indptr[row], self.indptr[row + 1]
+        columns = self.indices[start:end]
+        return columns[have[columns] < self.amounts[start:end]]
+
+    def rows_of(self, names):
+        """
+        Looks up the row of every recipe name. Returns an array of rows for
+        the names that were found and a list of the names that weren't.
+        """
+
+        rows = []
+        unknown = []
+        for name in names:
+            row = self.rows_by_name.get(name)
+            if row is None:
+                unknown.append(name)
+            else:
+                rows.append(row)
+        return np.array(rows, dtype=np.int64), unknown
+
+    def totals(self, weights, rows=None):
+        """
+        Multiplies the matrix with a vector of per column weights, giving
+        sum(amount * weight) for every recipe, or only for the given rows.
+        The entries of a subset are gathered from their indptr ranges, so
+        the cost follows the size of the subset rather than the catalog.
+        """
+
+        if rows is None:
+            return np.bincount(
+                self.entry_rows, weights=self.amounts * weights[self.indices],
+                minlength=len(self.recipe_ids)
+            )
+
+        sizes = self.row_sizes[rows]
+        ends = np.cumsum(sizes)
+        positions = np.arange(ends[-1] if len(ends) else 0) + np.repeat(self.indptr[rows] - ends + sizes, sizes)
+        owners = np.repeat(np.arange(len(rows)), sizes)
+        return np.bincount(
+            owners, weights=self.amounts[positions] * weights[self.indices[positions]],
+            minlength=len(rows)
+        )
+
+    def calorie_totals(self, rows=None, scales=1.0):
+        """
+        Calories of the given recipe rows, or all of them, multiplied by a
+        serving scale that is either one number or one per row.
+        """
+
+        return self.totals(self.calories, rows) * scales
+
+
+class MatrixCache(object):
+
+    REVISIONS = ("recipe-names", "ingredient-names", "pairing", "calories")
+
+    def __init__(self):
+        self._matrix = None
+        self._versions = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            # Read before the rows, so a write committed while loading only
+            # makes the matrix look older than it is
+            versions = Revision.current(*self.REVISIONS)
+            if self._matrix is None or self._versions != versions:
+                self._matrix = RecipeMatrix.load()
+                self._versions = versions
+            return self._matrix
+
+
+def init_app(app):
+    app.extensions["recipe_matrix"] = MatrixCache()
+
+def get_recipe_matrix():
+    return current_app.extensions["recipe_matrix"].get()
+
+@click.command("nutrition-report")
+@click.option("--scale", default=1.0, help="Serving multiplier applied to every recipe")
+@click.option("--top", default=0, help="Only list this many recipes with the most calories")
+@with_appcontext
+def nutrition_report_command(scale, top):
+    """
+    Writes the calories of every recipe as CSV, computed from the recipe
+    matrix in one pass.
+    """
+
+    matrix = get_recipe_matrix()
+    totals = matrix.calorie_totals(scales=scale)
+    rows = np.arange(len(totals))
+    if top > 0:
+        rows = np.argsort(-totals, kind="stable")[:top]
+    writer = csv.writer(click.get_text_stream("stdout"))
+    writer.writerow(["recipe", "calories"])
+    for row in rows.tolist():
+        writer.writerow([matrix.recipe_names[row], round(float(totals[row]), 3)])
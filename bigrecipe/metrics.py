@@ -0,0 +1,196 @@
+import threading
+import time
+from functools import wraps
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from bigrecipe import db
+from bigrecipe.constants import *
+
+"""
+Per resource and method request metrics in the Prometheus text format:
+request counts, a latency histogram, SQL statements and the time spent in
+them, JSON serialization time and response bytes. With METRICS off nothing
+is registered, no hooks and no engine events. Serialization is timed by the
+JSON helpers in utils, which only look at a module flag when it is off.
+"""
+
+#Set once any app turns metrics on, so the serialization helpers can skip
+#all timing otherwise
+_enabled = False
+
+
+class RequestMetrics(object):
+    """
+    What one request has spent so far, kept on g for its duration.
+    """
+
+    __slots__ = ("start", "statements", "sql_seconds", "serialization_seconds")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.serialization_seconds = 0.0
+
+
+class MetricsRegistry(object):
+    """
+    Totals and latency bucket counts of every resource and method pair,
+    updated under a lock once per request.
+    """
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def record(self, resource, method, seconds, state, size):
+        key = resource, method
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {
+                    "count": 0, "buckets": [0] * len(self.buckets), "seconds": 0.0,
+                    "statements": 0, "sql_seconds": 0.0, "serialization_seconds": 0.0, "bytes": 0
+                }
+            series["count"] += 1
+            series["seconds"] += seconds
+            # Buckets are stored non-cumulative and summed on exposition
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series["buckets"][i] += 1
+                    break
+            series["statements"] += state.statements
+            series["sql_seconds"] += state.sql_seconds
+            series["serialization_seconds"] += state.serialization_seconds
+            series["bytes"] += size
+
+    def exposition(self):
+        """
+        Renders every series in the Prometheus text exposition format.
+        """
+
+        with self._lock:
+            series = sorted((key, dict(value, buckets=list(value["buckets"]))) for key, value in self._series.items())
+
+        def labels(resource, method, **extra):
+            pairs = [("resource", resource), ("method", method)] + list(extra.items())
+            return "{" + ",".join('{}="{}"'.format(name, value) for name, value in pairs) + "}"
+
+        lines = [
+            "# HELP bigrecipe_requests_total Requests handled",
+            "# TYPE bigrecipe_requests_total counter",
+        ]
+        lines.extend(
+            "bigrecipe_requests_total{} {}".format(labels(*key), value["count"]) for key, value in series
+        )
+        lines.append("# HELP bigrecipe_request_duration_seconds Time from the start of a request to its response")
+        lines.append("# TYPE bigrecipe_request_duration_seconds histogram")
+        for key, value in series:
+            total = 0
+            for bound, count in zip(self.buckets, value["buckets"]):
+                total += count
+                lines.append("bigrecipe_request_duration_seconds_bucket{} {}".format(labels(*key, le=repr(float(bound))), total))
+            lines.append("bigrecipe_request_duration_seconds_bucket{} {}".format(labels(*key, le="+Inf"), value["count"]))
+            lines.append("bigrecipe_request_duration_seconds_sum{} {!r}".format(labels(*key), value["seconds"]))
+            lines.append("bigrecipe_request_duration_seconds_count{} {}".format(labels(*key), value["count"]))
+        for name, field, kind, description in (
+            ("bigrecipe_sql_statements_total", "statements", "counter", "SQL statements executed"),
+            ("bigrecipe_sql_seconds_total", "sql_seconds", "counter", "Time spent executing SQL statements"),
+            ("bigrecipe_serialization_seconds_total", "serialization_seconds", "counter", "Time spent encoding JSON bodies"),
+            ("bigrecipe_response_bytes_total", "bytes", "counter", "Bytes of response bodies sent"),
+        ):
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, kind))
+            lines.extend("{}{} {!r}".format(name, labels(*key), value[field]) for key, value in series)
+        return "\n".join(lines) + "\n"
+
+
+def _state():
+    if has_app_context():
+        return g.get("request_metrics")
+    return None
+
+def timed_serialization(func):
+    """
+    Counts the time spent in func as serialization time of the current
+    request.
+    """
+
+    @wraps(func)
+    def timed(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+        state = _state()
+        if state is None:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            state.serialization_seconds += time.perf_counter() - start
+    return timed
+
+def _resource():
+    # Flask-RESTful views carry their Resource class, other routes are
+    # named by their endpoint
+    if request.endpoint is None:
+        return "unmatched"
+    view = current_app.view_functions.get(request.endpoint)
+    view_class = getattr(view, "view_class", None)
+    return view_class.__name__ if view_class is not None else request.endpoint
+
+def _start_request():
+    g.request_metrics = RequestMetrics()
+
+def _finish_request(response):
+    state = g.get("request_metrics")
+    if state is None:
+        return response
+    registry = current_app.extensions["metrics"]
+    resource, method = _resource(), request.method
+    if not response.is_streamed:
+        registry.record(resource, method, time.perf_counter() - state.start, state, response.calculate_content_length() or 0)
+        return response
+
+    # Streamed bodies are produced after this hook, so they are measured
+    # while they are sent and recorded when the response is closed
+    sent = [0]
+    chunks = response.iter_encoded()
+
+    def counted():
+        for chunk in chunks:
+            sent[0] += len(chunk)
+            yield chunk
+
+    response.response = counted()
+    # The stream keeps its request context, so the statements it runs still
+    # count towards the state on g
+    response.call_on_close(
+        lambda: registry.record(resource, method, time.perf_counter() - state.start, state, sent[0])
+    )
+    return response
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_start = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    state = _state()
+    if state is not None:
+        state.statements += 1
+        state.sql_seconds += time.perf_counter() - context._metrics_start
+
+def init_app(app):
+    global _enabled
+    if not app.config["METRICS"]:
+        return
+    _enabled = True
+    app.extensions["metrics"] = MetricsRegistry()
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(db.engine, "after_cursor_execute", _after_cursor_execute)
+
+def get_metrics():
+    return current_app.extensions.get("metrics")
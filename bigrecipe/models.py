@@ -1,6 +1,11 @@
 import click
+import secrets
+from itertools import chain
 from flask.cli import with_appcontext
+from sqlalchemy import bindparam, event, inspect, text
+from sqlalchemy.orm import Session
 from bigrecipe import db
+from bigrecipe.constants import IN_CLAUSE_CHUNK
 
 """
 Started out with the sensorhub project template,
@@ -9,14 +14,24 @@ other code is original
 """
 
 
+def _first_version():
+    """
+    Version of a new row. Rows start at a random version instead of 1, so a
+    name that is deleted and created again never repeats the ETags given out
+    for the old row. 52 bits leave room for increments and stay exact in
+    JSON numbers.
+    """
+
+    return secrets.randbits(52) + 1
+
 #Association table so amount can be added
 class Recingpairings(db.Model):
     recipe_id = db.Column(db.Integer, db.ForeignKey("recipe.id", ondelete='CASCADE'), primary_key=True)
     ingredient_id = db.Column(db.Integer, db.ForeignKey("ingredient.id", ondelete='CASCADE'), primary_key=True)
     amount = db.Column(db.Integer)
 
-    recipe = db.relationship("Recipe", back_populates="ingredients")
-    ingredient = db.relationship("Ingredient", back_populates="recipes")
+    recipe = db.relationship("Recipe", back_populates="ingredients", lazy="select")
+    ingredient = db.relationship("Ingredient", back_populates="recipes", lazy="select")
 
     @staticmethod
     def get_schema():
@@ -47,10 +62,20 @@ class Recipe(db.Model):
     name = db.Column(db.String, unique=True, nullable=False)
     description=db.Column(db.String(256), nullable=True)
     text=db.Column(db.String, nullable=False)
+    #Total calories of all paired ingredients, maintained incrementally by
+    #the pairing and ingredient handlers so it can be filtered and sorted on.
+    #Amounts and calories per unit are JSON numbers, so the total can be
+    #fractional. Changes to it bump the "calories" revision, not "recipe".
+    calories = db.Column(db.Float, nullable=False, default=0, server_default="0", index=True)
+    #Bumped on every change to the recipe, its calories or its pairings
+    version = db.Column(db.Integer, nullable=False, default=_first_version, server_default="1")
 
-    ingredients = db.relationship("Recingpairings", back_populates="recipe")
+    #Pairing collections can be large, so they must be loaded explicitly with
+    #a projected query or selectinload. Lazy loading them raises instead of
+    #silently emitting a query per recipe.
+    ingredients = db.relationship("Recingpairings", back_populates="recipe", lazy="raise_on_sql", passive_deletes=True)
 
-    drink = db.relationship("Drink", back_populates="recipes")
+    drink = db.relationship("Drink", back_populates="recipes", lazy="select")
 
     @staticmethod
     def get_schema():
@@ -73,14 +98,106 @@ class Recipe(db.Model):
         }
         return schema
 
+    @staticmethod
+    def add_calories(recipe_id, delta):
+        """
+        Adjusts the stored calorie total of a recipe by delta, in the current
+        transaction.
+        """
+
+        table = Recipe.__table__
+        db.session.execute(
+            table.update().where(table.c.id == recipe_id).values(
+                calories=table.c.calories + delta, version=table.c.version + 1
+            )
+        )
+        Revision.bump("calories")
+
+    @staticmethod
+    def recompute_calories(recipe_ids=None):
+        """
+        Recomputes the calorie total of every recipe, or of the given ones,
+        from their pairings.
+        """
+
+        statement = (
+            "UPDATE recipe SET version = version + 1, calories = COALESCE(("
+            "SELECT SUM(COALESCE(recingpairings.amount, 0) * COALESCE(ingredient.calories, 0)) "
+            "FROM recingpairings JOIN ingredient ON ingredient.id = recingpairings.ingredient_id "
+            "WHERE recingpairings.recipe_id = recipe.id), 0)"
+        )
+        if recipe_ids is None:
+            db.session.execute(text(statement))
+        else:
+            statement = text(statement + " WHERE id IN :ids").bindparams(bindparam("ids", expanding=True))
+            recipe_ids = list(recipe_ids)
+            for i in range(0, len(recipe_ids), IN_CLAUSE_CHUNK):
+                db.session.execute(statement, {"ids": recipe_ids[i:i + IN_CLAUSE_CHUNK]})
+        Revision.bump("calories")
+
+    @staticmethod
+    def get_import_schema():
+        schema = Recipe.get_schema()
+        props = schema["properties"]
+        props["ingredients"] = {
+            "description": "Ingredients of the recipe with their amounts",
+            "type": "array",
+            "items": {
+                "type": "object",
+                "required": ["ingredient", "amount"],
+                "properties": {
+                    "ingredient": {
+                        "description": "Ingredient's unique name",
+                        "type": "string"
+                    },
+                    "amount": {
+                        "description": "Amount of ingredient",
+                        "type": "number"
+                    }
+                }
+            }
+        }
+        return schema
+
+#Full-text search over recipes uses an external content FTS5 table, so the
+#text is stored only once. Triggers keep it in sync with the recipe table,
+#also for rows written with Core inserts.
+RECIPE_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS recipe_fts USING fts5("
+    "name, description, text, content='recipe', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS recipe_fts_insert AFTER INSERT ON recipe BEGIN "
+    "INSERT INTO recipe_fts(rowid, name, description, text) "
+    "VALUES (new.id, new.name, new.description, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS recipe_fts_delete AFTER DELETE ON recipe BEGIN "
+    "INSERT INTO recipe_fts(recipe_fts, rowid, name, description, text) "
+    "VALUES ('delete', old.id, old.name, old.description, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS recipe_fts_update AFTER UPDATE OF name, description, text ON recipe BEGIN "
+    "INSERT INTO recipe_fts(recipe_fts, rowid, name, description, text) "
+    "VALUES ('delete', old.id, old.name, old.description, old.text); "
+    "INSERT INTO recipe_fts(rowid, name, description, text) "
+    "VALUES (new.id, new.name, new.description, new.text); END",
+]
+
+@event.listens_for(Recipe.__table__, "after_create")
+def create_recipe_fts(target, connection, **kw):
+    if connection.dialect.name == "sqlite":
+        for statement in RECIPE_FTS_DDL:
+            connection.execute(text(statement))
+
+@event.listens_for(Recipe.__table__, "before_drop")
+def drop_recipe_fts(target, connection, **kw):
+    if connection.dialect.name == "sqlite":
+        connection.execute(text("DROP TABLE IF EXISTS recipe_fts"))
+
 class Ingredient(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, unique=True, nullable=False)
     unit = db.Column(db.String, nullable=False)
     calories = db.Column(db.Integer, nullable=True)
     description=db.Column(db.String(256), nullable=True)
+    version = db.Column(db.Integer, nullable=False, default=_first_version, server_default="1")
 
-    recipes = db.relationship("Recingpairings", back_populates="ingredient")
+    recipes = db.relationship("Recingpairings", back_populates="ingredient", lazy="raise_on_sql", passive_deletes=True)
 
     @staticmethod
     def get_schema():
@@ -108,13 +225,30 @@ class Ingredient(db.Model):
         return schema
 
 
+    @staticmethod
+    def change_calories(ingredient_id, delta):
+        """
+        Moves the calorie totals of every recipe using the ingredient by delta
+        calories per unit of the ingredient, in the current transaction.
+        """
+
+        db.session.execute(text(
+            "UPDATE recipe SET version = version + 1, calories = calories + :delta * ("
+            "SELECT COALESCE(amount, 0) FROM recingpairings "
+            "WHERE recipe_id = recipe.id AND ingredient_id = :ingredient_id) "
+            "WHERE id IN (SELECT recipe_id FROM recingpairings WHERE ingredient_id = :ingredient_id)"
+        ), {"delta": delta, "ingredient_id": ingredient_id})
+        Revision.bump("calories")
+
+
 class Drink(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, unique=True, nullable=False)
     alcohol = db.Column(db.Boolean, nullable=False, default=False)
     description=db.Column(db.String(512), nullable=True)
+    version = db.Column(db.Integer, nullable=False, default=_first_version, server_default="1")
 
-    recipes = db.relationship("Recipe", back_populates="drink")
+    recipes = db.relationship("Recipe", back_populates="drink", lazy="select")
 
     @staticmethod
     def get_schema():
@@ -141,11 +275,175 @@ class Drink(db.Model):
         }
         return schema
 
+#Version counter of every collection, for collection ETags. Kept in the
+#database so that all worker processes agree on it.
+class Revision(db.Model):
+    name = db.Column(db.String, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    NAMES = (
+        "recipe", "ingredient", "drink", "pairing", "calories",
+        "recipe-names", "ingredient-names", "drink-names",
+    )
+
+    @staticmethod
+    def bump(*names, session=None):
+        """
+        Increments the version of the named collections in the current
+        transaction of session, by default the app's session. The versions
+        before and after the transaction are remembered on the session, so
+        after a commit in-memory indexes can tell whether they are exactly
+        one transaction behind, see committed.
+        """
+
+        session = session or db.session
+        table = Revision.__table__
+        statement = table.update().where(table.c.name.in_(names)).values(
+            version=table.c.version + 1
+        ).returning(table.c.name, table.c.version)
+        changes = session.info.setdefault("revisions", {})
+        # The transaction holds the write lock from its first write, so the
+        # first bump of a name starts from the last committed version
+        for name, version in session.connection().execute(statement):
+            changes[name] = (changes[name][0] if name in changes else version - 1, version)
+
+    @staticmethod
+    def current(*names):
+        """
+        Returns a dict of the committed versions of the named collections.
+        """
+
+        return dict(
+            db.session.query(Revision.name, Revision.version).filter(Revision.name.in_(names))
+        )
+
+    @staticmethod
+    def committed(*names):
+        """
+        Returns a dict of name -> (before, after) versions for the named
+        collections bumped by the last transaction committed in the app's
+        session.
+        """
+
+        changes = db.session.info.get("committed_revisions", {})
+        return {name: changes[name] for name in names if name in changes}
+
+@event.listens_for(Revision.__table__, "after_create")
+def create_revisions(target, connection, **kw):
+    connection.execute(target.insert(), [{"name": name, "version": 1} for name in Revision.NAMES])
+
+_REVISIONS = {
+    Recipe: "recipe",
+    Ingredient: "ingredient",
+    Drink: "drink",
+    Recingpairings: "pairing",
+}
+
+#Bumped only when a row of the kind is created, deleted or renamed, for the
+#indexes that hold nothing but names and ids
+_NAME_REVISIONS = {
+    Recipe: "recipe-names",
+    Ingredient: "ingredient-names",
+    Drink: "drink-names",
+}
+
+@event.listens_for(Session, "before_flush")
+def _bump_row_versions(session, flush_context, instances):
+    for obj in session.dirty:
+        if type(obj) in (Recipe, Ingredient, Drink) and session.is_modified(obj):
+            obj.version = type(obj).version + 1
+
+@event.listens_for(Session, "after_flush")
+def _bump_revisions(session, flush_context):
+    """
+    Bumps the collection versions touched by the flush. Adding or removing
+    a pairing changes its recipe as well, so the recipe version goes up too.
+    """
+
+    names = set()
+    recipe_ids = set()
+    modified = [obj for obj in session.dirty if session.is_modified(obj)]
+    for obj in chain(session.new, session.deleted, modified):
+        if type(obj) in _REVISIONS:
+            names.add(_REVISIONS[type(obj)])
+        if type(obj) is Recingpairings:
+            recipe_ids.add(inspect(obj).dict.get("recipe_id"))
+    for obj in chain(session.new, session.deleted):
+        if type(obj) in _NAME_REVISIONS:
+            names.add(_NAME_REVISIONS[type(obj)])
+    for obj in modified:
+        if type(obj) in _NAME_REVISIONS and inspect(obj).attrs.name.history.has_changes():
+            names.add(_NAME_REVISIONS[type(obj)])
+    if not names:
+        return
+    Revision.bump(*names, session=session)
+    if recipe_ids:
+        table = Recipe.__table__
+        session.connection().execute(
+            table.update().where(table.c.id.in_(recipe_ids)).values(version=table.c.version + 1)
+        )
+
+@event.listens_for(Session, "after_commit")
+def _commit_revisions(session):
+    session.info["committed_revisions"] = session.info.pop("revisions", {})
+
+@event.listens_for(Session, "after_rollback")
+def _discard_revisions(session):
+    session.info.pop("revisions", None)
+
 @click.command("init-db")
 @with_appcontext
 def init_db_command():
     db.create_all()
 
+@click.command("upgrade-db")
+@with_appcontext
+def upgrade_db_command():
+    """
+    Brings a database made with an older version of the models up to date:
+    creates missing tables, adds missing columns and fills the derived data.
+    """
+
+    db.create_all()
+    inspector = inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = "ALTER TABLE {} ADD COLUMN {} {}".format(
+                    table.name, column.name, column.type.compile(connection.dialect)
+                )
+                if column.server_default is not None:
+                    ddl += " NOT NULL DEFAULT {}".format(column.server_default.arg)
+                connection.execute(text(ddl))
+                click.echo("Added column {}.{}".format(table.name, column.name))
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+        existing = {row.name for row in connection.execute(Revision.__table__.select())}
+        missing = [name for name in Revision.NAMES if name not in existing]
+        if missing:
+            connection.execute(
+                Revision.__table__.insert(), [{"name": name, "version": 1} for name in missing]
+            )
+        create_recipe_fts(Recipe.__table__, connection)
+        connection.execute(text("INSERT INTO recipe_fts(recipe_fts) VALUES ('rebuild')"))
+    Recipe.recompute_calories()
+    db.session.commit()
+
+@click.command("rebuild-search")
+@with_appcontext
+def rebuild_search_command():
+    """
+    Creates the recipe full-text index if the database predates it, and
+    refills it from the recipe table.
+    """
+
+    with db.engine.begin() as connection:
+        create_recipe_fts(Recipe.__table__, connection)
+        connection.execute(text("INSERT INTO recipe_fts(recipe_fts) VALUES ('rebuild')"))
+
 @click.command("testgen")
 @with_appcontext
 def generate_test_data():
@@ -242,5 +540,5 @@ def arbitrary_test():
     db_ingredient = Ingredient.query.first()
     db_ingredient = Ingredient.query.filter_by(id=2).first()
     print(db_ingredient.id)
-    print(Recipe.query.first().ingredients)
+    print(Recipe.query.options(db.selectinload(Recipe.ingredients)).first().ingredients)
     print(Recipe.query.join(Recingpairings).join(Ingredient).filter((Recingpairings.c.recipe_id == Recipe.id) & (Recingpairings.c.ingredient_id == db_ingredient.id)).all())
\ No newline at end of file
@@ -0,0 +1,44 @@
+from flask import Response, request, url_for
+from flask_restful import Resource
+from bigrecipe.autocomplete import KINDS, get_prefix_index
+from bigrecipe.etag import collection_etag, not_modified, tagged
+from bigrecipe.utils import BigrecipeBuilder, create_error_response, dumps, parse_page_limit
+from bigrecipe.constants import *
+
+
+class Autocomplete(Resource):
+
+    ITEM_ENDPOINTS = {
+        "recipe": ("api.recipeitem", "recipe"),
+        "ingredient": ("api.ingredientitem", "ingredient"),
+        "drink": ("api.drinkitem", "drink"),
+    }
+
+    def get(self):
+        try:
+            kind = request.args["kind"]
+            prefix = request.args.get("prefix", "")
+            limit = parse_page_limit(AUTOCOMPLETE_SIZE)
+        except (KeyError, ValueError):
+            return create_error_response(400, "Invalid query string value")
+        if kind not in KINDS:
+            return create_error_response(
+                400, "Invalid query string value",
+                "kind must be one of: {}".format(", ".join(KINDS))
+            )
+
+        etag = collection_etag(kind + "-names")
+        response = not_modified(etag)
+        if response:
+            return response
+
+        endpoint, arg = self.ITEM_ENDPOINTS[kind]
+        body = BigrecipeBuilder(items=[])
+        body.add_namespace("bigrec", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.autocomplete", kind=kind, prefix=prefix))
+        for name in get_prefix_index(kind).complete(prefix, limit):
+            item = BigrecipeBuilder(name=name)
+            item.add_control("self", url_for(endpoint, **{arg: name}))
+            body["items"].append(item)
+
+        return tagged(Response(dumps(body), 200, mimetype=MASON), etag)
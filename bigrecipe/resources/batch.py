@@ -0,0 +1,89 @@
+import json
+from urllib.parse import urlsplit
+from jsonschema import validate, ValidationError
+from flask import Response, current_app, request
+from flask_restful import Resource
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import HTTPException, NotFound
+from bigrecipe.models import Drink, Ingredient, Recipe
+from bigrecipe.cache import prefetch
+from bigrecipe.utils import BigrecipeBuilder, create_error_response, dumps_collection
+from bigrecipe.constants import *
+
+#Rows addressed by each URL argument, and the loader options their item
+#resources use
+_PREFETCH = {
+    "recipe": (Recipe, (joinedload(Recipe.drink),)),
+    "ingredient": (Ingredient, ()),
+    "drink": (Drink, ()),
+}
+
+
+class Batch(Resource):
+
+    def post(self):
+        if not request.json:
+            return create_error_response(
+                415, "Unsupported media type",
+                "Requests must be JSON"
+            )
+
+        try:
+            validate(request.json, BigrecipeBuilder._batch_schema())
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        # Route every path up front, a path that doesn't route gets the
+        # error it would have gotten on its own
+        adapter = current_app.create_url_adapter(request)
+        targets = []
+        for path in request.json["requests"]:
+            parts = urlsplit(path)
+            try:
+                endpoint, args = adapter.match(parts.path, method="GET")
+                if not endpoint.startswith("api."):
+                    raise NotFound()
+            except HTTPException as e:
+                endpoint, args = None, e
+            targets.append((path, parts, endpoint, args))
+
+        # Rows named by the paths are loaded with one query per kind, the
+        # handlers then find them in the session
+        names = {}
+        for path, parts, endpoint, args in targets:
+            if endpoint is not None:
+                for arg, value in args.items():
+                    if arg in _PREFETCH:
+                        names.setdefault(arg, []).append(value)
+        for arg, found in names.items():
+            model, options = _PREFETCH[arg]
+            prefetch(model, found, *options)
+
+        # Each path is handed to its view function directly, in a request
+        # context of its own
+        entries = []
+        for path, parts, endpoint, args in targets:
+            with current_app.test_request_context(parts.path, query_string=parts.query, method="GET"):
+                if endpoint is None:
+                    response = create_error_response(args.code, args.name, args.description)
+                else:
+                    response = current_app.make_response(current_app.view_functions[endpoint](**args))
+                entries.append(self._entry(path, response))
+
+        body = BigrecipeBuilder()
+        body.add_namespace("bigrec", LINK_RELATIONS_URL)
+        body.add_control_batch()
+        return Response(dumps_collection(body, entries), 200, mimetype=MASON)
+
+    @staticmethod
+    def _entry(path, response):
+        # JSON bodies are passed through as they are, without parsing them
+        data = response.get_data(as_text=True)
+        if not data:
+            data = "null"
+        elif not response.is_json:
+            data = json.dumps(data)
+        etag = response.get_etag()[0]
+        return '{{"path": {}, "status": {}, "etag": {}, "body": {}}}'.format(
+            json.dumps(path), response.status_code, json.dumps(etag), data
+        )
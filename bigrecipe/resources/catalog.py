@@ -0,0 +1,56 @@
+from flask import Response, request, stream_with_context, url_for
+from flask_restful import Resource
+from sqlalchemy.exc import IntegrityError
+from bigrecipe import db
+from bigrecipe.etag import collection_etag, not_modified, tagged
+from bigrecipe.models import Revision
+from bigrecipe.transfer import CatalogError, export_catalog, import_catalog
+from bigrecipe.utils import BigrecipeBuilder, create_error_response, dumps
+from bigrecipe.constants import *
+
+
+class Catalog(Resource):
+
+    def get(self):
+        # Any write bumps one of the revisions, so an unchanged catalog is
+        # answered without reading a single row
+        etag = collection_etag(*Revision.NAMES)
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+        return tagged(Response(stream_with_context(export_catalog()), 200, mimetype=NDJSON), etag)
+
+    def post(self):
+        if request.mimetype != NDJSON:
+            return create_error_response(
+                415, "Unsupported media type",
+                "Requests must be NDJSON"
+            )
+        policy = request.args.get("on_conflict", "fail")
+        if policy not in CONFLICT_POLICIES:
+            return create_error_response(
+                400, "Invalid query parameter",
+                "on_conflict must be one of {}".format(", ".join(CONFLICT_POLICIES))
+            )
+
+        # The body is read a line at a time instead of all at once
+        try:
+            counts = import_catalog(request.stream, policy)
+        except CatalogError as e:
+            if e.conflict:
+                return create_error_response(409, "Conflict", str(e))
+            return create_error_response(400, "Invalid NDJSON document", str(e))
+        except IntegrityError:
+            db.session.rollback()
+            return create_error_response(
+                409, "Conflict",
+                "The catalog conflicts with changes made while it was imported."
+            )
+
+        body = BigrecipeBuilder(items=[])
+        body.add_namespace("bigrec", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.catalog"))
+        body.add_control_import_catalog()
+        for kind, kind_counts in counts.items():
+            body["items"].append(BigrecipeBuilder(type=kind, **kind_counts))
+        return Response(dumps(body), 200, mimetype=MASON)
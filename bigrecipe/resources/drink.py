@@ -1,40 +1,121 @@
 import json
 from jsonschema import validate, ValidationError
-from flask import Response, request, url_for
+from flask import Response, request, stream_with_context, url_for
 from flask_restful import Resource
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only
 from bigrecipe.models import Drink, Recipe
 from bigrecipe import db
-from bigrecipe.utils import BigrecipeBuilder, create_error_response
+from bigrecipe.autocomplete import get_prefix_index
+from bigrecipe.cache import get_by_name, invalidate_name, prefetched
+from bigrecipe.etag import collection_etag, make_etag, not_modified, precondition_failed, row_etag, tagged
+from bigrecipe.response_cache import cache_response, cached_response, invalidate_responses, row_tag
+from bigrecipe.utils import (
+    BigrecipeBuilder, create_error_response, decode_cursor, dumps, dumps_collection, embedded_recipes, encode_cursor,
+    item_template, keyset_page, parse_embed, parse_fields, parse_flag, parse_page_limit, stream_collection
+)
 from bigrecipe.constants import *
 
 
 class DrinkCollection(Resource):
 
     def get(self):
+        try:
+            stream = parse_flag("stream")
+            sort = request.args.get("sort", "name")
+            if sort not in ("name", "alcohol"):
+                raise ValueError("unknown sort order")
+            after = request.args.get("after")
+            if after is not None:
+                after = self._decode_cursor(after, sort)
+            before = request.args.get("before")
+            if before is not None:
+                before = self._decode_cursor(before, sort)
+            limit = parse_page_limit(DRINK_PAGE_SIZE)
+            fields = parse_fields(DRINK_FIELDS)
+        except ValueError:
+            return create_error_response(400, "Invalid query string value")
+
+        etag = collection_etag("drink")
+        response = cached_response(etag) or not_modified(etag)
+        if response:
+            return response
+
+        keys = (Drink.alcohol, Drink.name) if sort == "alcohol" else Drink.name
+        columns = [getattr(Drink, field) for field in fields if field != "name"]
+        if sort == "alcohol" and "alcohol" not in fields:
+            columns.append(Drink.alcohol)
+        rows = db.session.query(Drink.id, Drink.name, *columns)
+
+        def page_uri(**kwargs):
+            if "limit" in request.args:
+                kwargs["limit"] = limit
+            return url_for(
+                "api.drinkcollection",
+                sort=request.args.get("sort"), fields=request.args.get("fields"), **kwargs
+            )
+
+        def cursor(row):
+            if sort == "alcohol":
+                return encode_cursor(json.dumps([row.alcohol, row.name]))
+            return encode_cursor(row.name)
+
         body = BigrecipeBuilder()
 
         body.add_namespace("bigrec", LINK_RELATIONS_URL)
-        body.add_control("self", url_for("api.drinkcollection"))
+        template = item_template("drink")
+
+        if stream:
+            body.add_control("self", page_uri(stream=request.args["stream"]))
+            body.add_control_add_drink()
+            order = keys if isinstance(keys, tuple) else (keys,)
+            items = (
+                self._render(template, row, fields)
+                for row in rows.order_by(*order).yield_per(STREAM_CHUNK_SIZE)
+            )
+            return tagged(Response(
+                stream_with_context(stream_collection(body, items)), 200, mimetype=MASON
+            ), etag)
+
+        rows, has_prev, has_next = keyset_page(rows, keys, limit, after=after, before=before)
+        body.add_control(
+            "self", page_uri(after=request.args.get("after"), before=request.args.get("before"))
+        )
         body.add_control_add_drink()
-        body["items"] = []
-        for db_drink in Drink.query.all():
-            if db_drink.description:
-                item = BigrecipeBuilder(
-                    name=db_drink.name,
-                    alcohol=db_drink.alcohol,
-                    description=db_drink.description
-                )
-            else:
-                item = BigrecipeBuilder(
-                    name=db_drink.name,
-                    alcohol=db_drink.alcohol,
-                )
-            item.add_control("self", url_for("api.drinkitem", drink=db_drink.name))
-            item.add_control("profile", DRINK_PROFILE)
-            body["items"].append(item)
+        if rows and has_prev:
+            body.add_control("prev", page_uri(before=cursor(rows[0])))
+        if rows and has_next:
+            body.add_control("next", page_uri(after=cursor(rows[-1])))
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        items = []
+        tags = ["drink"]
+        for row in rows:
+            items.append(self._render(template, row, fields))
+            tags.append(row_tag("drink", row.id))
+        if sort == "alcohol":
+            tags.append("alcohol")
+
+        return cache_response(tagged(Response(dumps_collection(body, items), 200, mimetype=MASON), etag), tags)
+
+    @staticmethod
+    def _decode_cursor(cursor, sort):
+        value = decode_cursor(cursor)
+        if sort == "alcohol":
+            value = json.loads(value)
+            if (
+                not isinstance(value, list) or len(value) != 2
+                or not isinstance(value[0], bool) or not isinstance(value[1], str)
+            ):
+                raise ValueError("invalid cursor")
+            value = tuple(value)
+        return value
+
+    @staticmethod
+    def _render(template, row, fields):
+        return template.render(row.name, [
+            (field, getattr(row, field)) for field in fields
+            if field != "name" and (field != "description" or row.description)
+        ])
 
     def post(self):
         if not request.json:
@@ -67,6 +148,9 @@ class DrinkCollection(Resource):
                 409, "Already exists",
                 "Drink with name '{}' already exists.".format(request.json["name"])
             )
+        with get_prefix_index("drink", build=False).updating() as index:
+            index.add(request.json["name"])
+        invalidate_responses("drink")
 
         return Response(status=201, headers={
             "Location": url_for("api.drinkitem", drink=request.json["name"])
@@ -76,18 +160,31 @@ class DrinkCollection(Resource):
 class DrinkItem(Resource):
 
     def get(self, drink):
-        db_drink = Drink.query.filter_by(name=drink).first()
+        try:
+            fields = parse_fields(DRINK_FIELDS)
+            embed = parse_embed(DRINK_EMBEDS)
+        except ValueError:
+            return create_error_response(400, "Invalid query string value")
+        etag = self._etag(drink, embed)
+        if etag is None:
+            return create_error_response(
+                404, "Not found",
+                "No drink was found with the name {}".format(drink)
+            )
+        response = not_modified(etag)
+        if response:
+            return response
+
+        db_drink = get_by_name(Drink, drink, load_only(*[getattr(Drink, field) for field in fields]))
         if db_drink is None:
             return create_error_response(
                 404, "Not found",
                 "No drink was found with the name {}".format(drink)
             )
 
-        body = BigrecipeBuilder(
-            name=db_drink.name,
-            alcohol=db_drink.alcohol,
-            description=db_drink.description
-        )
+        body = BigrecipeBuilder((field, getattr(db_drink, field)) for field in fields)
+        if "recipes" in embed:
+            body["recipes"] = embedded_recipes(Recipe.query.filter(Recipe.drink_id == db_drink.id))
         body.add_namespace("bigrec", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.drinkitem", drink=drink))
         body.add_control("profile", DRINK_PROFILE)
@@ -95,15 +192,29 @@ class DrinkItem(Resource):
         body.add_control_delete_drink(drink)
         body.add_control_modify_drink(drink)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return tagged(Response(dumps(body), 200, mimetype=MASON), etag)
+
+    @staticmethod
+    def _etag(drink, embed=()):
+        row = prefetched(Drink, drink)
+        if row is not None:
+            etag = make_etag(row.version)
+        else:
+            etag = row_etag(db.session.query(Drink.version).filter(Drink.name == drink))
+        if etag is not None and "recipes" in embed:
+            etag = make_etag(etag, collection_etag("recipe", "calories"))
+        return etag
 
     def put(self, drink):
-        db_drink = Drink.query.filter_by(name=drink).first()
+        db_drink = get_by_name(Drink, drink)
         if db_drink is None:
             return create_error_response(
                 404, "Not found",
                 "No drink was found with the name {}".format(drink)
             )
+        response = precondition_failed(self._etag(drink))
+        if response:
+            return response
 
         if not request.json:
             return create_error_response(
@@ -116,6 +227,10 @@ class DrinkItem(Resource):
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
+        invalidate_name(Drink, drink)
+        drink_id = db_drink.id
+        # Pages sorted by alcohol are reordered when it changes
+        tags = ["alcohol"] if db_drink.alcohol != request.json["alcohol"] else []
         db_drink.name = request.json["name"]
         db_drink.alcohol = request.json["alcohol"]
         try:
@@ -124,8 +239,10 @@ class DrinkItem(Resource):
             pass
 
         try:
-            if Recipe.query.filter_by(name=request.json["recipe"]).first():
-                db_drink.recipes.append(Recipe.query.filter_by(name=request.json["recipe"]).first())
+            db_recipe = get_by_name(Recipe, request.json["recipe"])
+            if db_recipe:
+                db_recipe.drink = db_drink
+                tags.append(row_tag("recipe", db_recipe.id))
         except KeyError:
             pass
 
@@ -136,18 +253,31 @@ class DrinkItem(Resource):
                 409, "Already exists",
                 "Drink with name '{}' already exists.".format(request.json["name"])
             )
+        with get_prefix_index("drink", build=False).updating() as index:
+            index.rename(drink, request.json["name"])
+        invalidate_responses(
+            "drink" if drink != request.json["name"] else row_tag("drink", drink_id),
+            *tags
+        )
 
         return Response(status=204)
 
     def delete(self, drink):
-        db_drink = Drink.query.filter_by(name=drink).first()
+        db_drink = get_by_name(Drink, drink)
         if db_drink is None:
             return create_error_response(
                 404, "Not found",
                 "No drink was found with the name {}".format(drink)
             )
+        response = precondition_failed(self._etag(drink))
+        if response:
+            return response
 
+        invalidate_name(Drink, drink)
         db.session.delete(db_drink)
         db.session.commit()
+        with get_prefix_index("drink", build=False).updating() as index:
+            index.remove(drink)
+        invalidate_responses("drink")
 
         return Response(status=204)
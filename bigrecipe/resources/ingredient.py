@@ -1,42 +1,129 @@
 import json
 from jsonschema import validate, ValidationError
-from flask import Response, request, url_for
+from flask import Response, request, stream_with_context, url_for
 from flask_restful import Resource
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
-from bigrecipe.models import Ingredient
+from sqlalchemy.orm import load_only
+from bigrecipe.models import Ingredient, Recipe, Recingpairings
 from bigrecipe import db
-from bigrecipe.utils import BigrecipeBuilder, create_error_response
+from bigrecipe.autocomplete import get_prefix_index
+from bigrecipe.cache import get_by_name, invalidate_name, prefetched
+from bigrecipe.etag import collection_etag, make_etag, not_modified, precondition_failed, row_etag, tagged
+from bigrecipe.response_cache import cache_response, cached_response, invalidate_responses, row_tag
+from bigrecipe.utils import (
+    BigrecipeBuilder, create_error_response, decode_cursor, dumps, dumps_collection, embedded_recipes, encode_cursor,
+    item_template, keyset_page, parse_embed, parse_fields, parse_flag, parse_page_limit, stream_collection
+)
 from bigrecipe.constants import *
 
 
 class IngredientCollection(Resource):
 
     def get(self):
+        try:
+            stream = parse_flag("stream")
+            sort = request.args.get("sort", "name")
+            if sort not in ("name", "calories"):
+                raise ValueError("unknown sort order")
+            after = request.args.get("after")
+            if after is not None:
+                after = self._decode_cursor(after, sort)
+            before = request.args.get("before")
+            if before is not None:
+                before = self._decode_cursor(before, sort)
+            limit = parse_page_limit(INGREDIENT_PAGE_SIZE)
+            fields = parse_fields(INGREDIENT_FIELDS)
+        except ValueError:
+            return create_error_response(400, "Invalid query string value")
+
+        etag = collection_etag("ingredient")
+        response = cached_response(etag) or not_modified(etag)
+        if response:
+            return response
+
+        # Ingredients without calories sort as if they had none
+        calories = func.coalesce(Ingredient.calories, 0)
+        keys = (calories, Ingredient.name) if sort == "calories" else Ingredient.name
+        columns = [getattr(Ingredient, field) for field in fields if field != "name"]
+        if sort == "calories" and "calories" not in fields:
+            columns.append(Ingredient.calories)
+        rows = db.session.query(Ingredient.id, Ingredient.name, *columns)
+
+        def page_uri(**kwargs):
+            if "limit" in request.args:
+                kwargs["limit"] = limit
+            return url_for(
+                "api.ingredientcollection",
+                sort=request.args.get("sort"), fields=request.args.get("fields"), **kwargs
+            )
+
+        def cursor(row):
+            if sort == "calories":
+                return encode_cursor(json.dumps([row.calories or 0, row.name]))
+            return encode_cursor(row.name)
+
         body = BigrecipeBuilder()
 
         body.add_namespace("bigrec", LINK_RELATIONS_URL)
-        body.add_control("self", url_for("api.ingredientcollection"))
+        template = item_template("ingredient")
+
+        if stream:
+            # The whole collection is sent in one response, fetched and
+            # written a chunk at a time so that nothing holds all of it.
+            # Streams are not cached.
+            body.add_control("self", page_uri(stream=request.args["stream"]))
+            body.add_control_add_ingredient()
+            order = keys if isinstance(keys, tuple) else (keys,)
+            items = (
+                self._render(template, row, fields)
+                for row in rows.order_by(*order).yield_per(STREAM_CHUNK_SIZE)
+            )
+            return tagged(Response(
+                stream_with_context(stream_collection(body, items)), 200, mimetype=MASON
+            ), etag)
+
+        rows, has_prev, has_next = keyset_page(rows, keys, limit, after=after, before=before)
+        body.add_control(
+            "self", page_uri(after=request.args.get("after"), before=request.args.get("before"))
+        )
         body.add_control_add_ingredient()
-        body["items"] = []
-        for db_ingredient in Ingredient.query.all():
-            if db_ingredient.calories:
-                item = BigrecipeBuilder(
-                    name=db_ingredient.name,
-                    unit=db_ingredient.unit,
-                    calories=db_ingredient.calories,
-                    description=db_ingredient.description
-                )
-            else:
-                    item = BigrecipeBuilder(
-                    name=db_ingredient.name,
-                    unit=db_ingredient.unit,
-                    description=db_ingredient.description
-                )
-            item.add_control("self", url_for("api.ingredientitem", ingredient=db_ingredient.name))
-            item.add_control("profile", INGREDIENT_PROFILE)
-            body["items"].append(item)
-
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        if rows and has_prev:
+            body.add_control("prev", page_uri(before=cursor(rows[0])))
+        if rows and has_next:
+            body.add_control("next", page_uri(after=cursor(rows[-1])))
+
+        items = []
+        tags = ["ingredient"]
+        for row in rows:
+            items.append(self._render(template, row, fields))
+            tags.append(row_tag("ingredient", row.id))
+        # Calorie changes reorder pages sorted by calories
+        if sort == "calories":
+            tags.append("calories")
+
+        return cache_response(tagged(Response(dumps_collection(body, items), 200, mimetype=MASON), etag), tags)
+
+    @staticmethod
+    def _decode_cursor(cursor, sort):
+        value = decode_cursor(cursor)
+        if sort == "calories":
+            value = json.loads(value)
+            if (
+                not isinstance(value, list) or len(value) != 2
+                or not isinstance(value[0], (int, float)) or isinstance(value[0], bool)
+                or not isinstance(value[1], str)
+            ):
+                raise ValueError("invalid cursor")
+            value = tuple(value)
+        return value
+
+    @staticmethod
+    def _render(template, row, fields):
+        return template.render(row.name, [
+            (field, getattr(row, field)) for field in fields
+            if field != "name" and (field != "calories" or row.calories)
+        ])
 
     def post(self):
         if not request.json:
@@ -72,6 +159,9 @@ class IngredientCollection(Resource):
                 409, "Already exists",
                 "Ingredient with name '{}' already exists.".format(request.json["name"])
             )
+        with get_prefix_index("ingredient", build=False).updating() as index:
+            index.add(request.json["name"])
+        invalidate_responses("ingredient")
 
         return Response(status=201, headers={
             "Location": url_for("api.ingredientitem", ingredient=request.json["name"])
@@ -81,19 +171,35 @@ class IngredientCollection(Resource):
 class IngredientItem(Resource):
 
     def get(self, ingredient):
-        db_ingredient = Ingredient.query.filter_by(name=ingredient).first()
-        if db_ingredient is None:
+        try:
+            fields = parse_fields(INGREDIENT_FIELDS)
+            embed = parse_embed(INGREDIENT_EMBEDS)
+        except ValueError:
+            return create_error_response(400, "Invalid query string value")
+        etag = self._etag(ingredient, embed)
+        if etag is None:
             return create_error_response(
                 404, "Not found",
                 "No ingredient was found with the name {}".format(ingredient)
             )
+        response = not_modified(etag)
+        if response:
+            return response
 
-        body = BigrecipeBuilder(
-            name=db_ingredient.name,
-            unit=db_ingredient.unit,
-            calories=db_ingredient.calories,
-            description=db_ingredient.description
+        db_ingredient = get_by_name(
+            Ingredient, ingredient, load_only(*[getattr(Ingredient, field) for field in fields])
         )
+        if db_ingredient is None:
+            return create_error_response(
+                404, "Not found",
+                "No ingredient was found with the name {}".format(ingredient)
+            )
+
+        body = BigrecipeBuilder((field, getattr(db_ingredient, field)) for field in fields)
+        if "recipes" in embed:
+            body["recipes"] = embedded_recipes(Recipe.query.join(
+                Recingpairings, Recingpairings.recipe_id == Recipe.id
+            ).filter(Recingpairings.ingredient_id == db_ingredient.id))
         body.add_namespace("bigrec", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.ingredientitem", ingredient=ingredient))
         body.add_control("profile", INGREDIENT_PROFILE)
@@ -102,15 +208,29 @@ class IngredientItem(Resource):
         body.add_control_modify_ingredient(ingredient)
         body.add_control_get_recipes(ingredient)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return tagged(Response(dumps(body), 200, mimetype=MASON), etag)
+
+    @staticmethod
+    def _etag(ingredient, embed=()):
+        row = prefetched(Ingredient, ingredient)
+        if row is not None:
+            etag = make_etag(row.version)
+        else:
+            etag = row_etag(db.session.query(Ingredient.version).filter(Ingredient.name == ingredient))
+        if etag is not None and "recipes" in embed:
+            etag = make_etag(etag, collection_etag("recipe", "pairing", "calories"))
+        return etag
 
     def put(self, ingredient):
-        db_ingredient = Ingredient.query.filter_by(name=ingredient).first()
+        db_ingredient = get_by_name(Ingredient, ingredient)
         if db_ingredient is None:
             return create_error_response(
                 404, "Not found",
                 "No ingredient was found with the name {}".format(ingredient)
             )
+        response = precondition_failed(self._etag(ingredient))
+        if response:
+            return response
 
         if not request.json:
             return create_error_response(
@@ -123,13 +243,25 @@ class IngredientItem(Resource):
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
-        db_ingredient.name = request.json["name"]
-        db_ingredient.unit = request.json["unit"]
+        # Move the recipe calorie totals before any other change is pending,
+        # so this statement can't flush a conflicting rename
+        ingredient_id = db_ingredient.id
+        recipe_tags = []
         try:
             calories = request.json["calories"]
+            delta = (calories or 0) - (db_ingredient.calories or 0)
+            if delta:
+                Ingredient.change_calories(ingredient_id, delta)
+                recipe_tags = ["calories"] + [
+                    row_tag("recipe", pk) for (pk,) in
+                    db.session.query(Recingpairings.recipe_id).filter_by(ingredient_id=ingredient_id)
+                ]
             db_ingredient.calories=calories
         except KeyError:
             pass
+        invalidate_name(Ingredient, ingredient)
+        db_ingredient.name = request.json["name"]
+        db_ingredient.unit = request.json["unit"]
         try:
             description = request.json["description"]
             db_ingredient.description=description
@@ -143,23 +275,36 @@ class IngredientItem(Resource):
                 409, "Already exists",
                 "Ingredient with name '{}' already exists.".format(request.json["name"])
             )
+        with get_prefix_index("ingredient", build=False).updating() as index:
+            index.rename(ingredient, request.json["name"])
+        invalidate_responses(
+            "ingredient" if ingredient != request.json["name"] else row_tag("ingredient", ingredient_id),
+            *recipe_tags
+        )
 
         return Response(status=204)
 
     def delete(self, ingredient):
-        db_ingredient = Ingredient.query.filter_by(name=ingredient).first()
+        db_ingredient = get_by_name(Ingredient, ingredient)
         if db_ingredient is None:
             return create_error_response(
                 404, "Not found",
                 "No ingredient was found with the name {}".format(ingredient)
             )
-        if db_ingredient.recipes:
+        response = precondition_failed(self._etag(ingredient))
+        if response:
+            return response
+        if db.session.query(Recingpairings.query.filter_by(ingredient_id=db_ingredient.id).exists()).scalar():
             return create_error_response(
                 403, "Forbidden",
                 "Can't delete ingredient with paired recipes."
             )
         else:
+            invalidate_name(Ingredient, ingredient)
             db.session.delete(db_ingredient)
             db.session.commit()
+            with get_prefix_index("ingredient", build=False).updating() as index:
+                index.remove(ingredient)
+            invalidate_responses("ingredient")
 
             return Response(status=204)
\ No newline at end of file
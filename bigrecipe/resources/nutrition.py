@@ -0,0 +1,49 @@
+import numpy as np
+from jsonschema import validate, ValidationError
+from flask import Response, request, url_for
+from flask_restful import Resource
+from bigrecipe.matrix import get_recipe_matrix
+from bigrecipe.utils import BigrecipeBuilder, create_error_response, dumps
+from bigrecipe.constants import *
+
+
+class NutritionReport(Resource):
+
+    def post(self):
+        if not request.json:
+            return create_error_response(
+                415, "Unsupported media type",
+                "Requests must be JSON"
+            )
+
+        try:
+            validate(request.json, BigrecipeBuilder._nutrition_schema())
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        # All requested recipes are totalled with one product over the
+        # matrix, unknown names are reported back instead of failing the batch
+        matrix = get_recipe_matrix()
+        wanted = request.json["recipes"]
+        rows, unknown = matrix.rows_of(item["recipe"] for item in wanted)
+        scales = np.array(
+            [item.get("scale", 1) for item in wanted if item["recipe"] in matrix.rows_by_name],
+            dtype=np.float64
+        )
+        totals = matrix.calorie_totals(rows, scales)
+
+        body = BigrecipeBuilder(items=[], unknown=unknown)
+        body.add_namespace("bigrec", LINK_RELATIONS_URL)
+        body.add_control_nutrition()
+        body.add_control("collection", url_for("api.recipecollection"))
+        for row, scale, calories in zip(rows.tolist(), scales.tolist(), totals.tolist()):
+            item = BigrecipeBuilder(
+                name=matrix.recipe_names[row],
+                scale=scale,
+                calories=calories
+            )
+            item.add_control("self", url_for("api.recipeitem", recipe=matrix.recipe_names[row]))
+            item.add_control("profile", RECIPE_PROFILE)
+            body["items"].append(item)
+
+        return Response(dumps(body), 200, mimetype=MASON)
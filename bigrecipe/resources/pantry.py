@@ -0,0 +1,79 @@
+import numpy as np
+from jsonschema import validate, ValidationError
+from flask import Response, request, url_for
+from flask_restful import Resource
+from bigrecipe.models import Ingredient, Recipe
+from bigrecipe import db
+from bigrecipe.cache import lookup_id
+from bigrecipe.matrix import get_recipe_matrix
+from bigrecipe.utils import BigrecipeBuilder, create_error_response, dumps, parse_page_limit, query_in_chunks
+from bigrecipe.constants import *
+
+
+class PantryMatch(Resource):
+
+    def post(self):
+        if not request.json:
+            return create_error_response(
+                415, "Unsupported media type",
+                "Requests must be JSON"
+            )
+
+        try:
+            validate(request.json, BigrecipeBuilder._pantry_schema())
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        try:
+            limit = parse_page_limit(PANTRY_PAGE_SIZE)
+        except ValueError:
+            return create_error_response(400, "Invalid query string value")
+        max_missing = request.json.get("max_missing", PANTRY_MAX_MISSING)
+
+        # Amount available per ingredient id, unlimited if no amount is given
+        pantry = {}
+        for item in request.json["ingredients"]:
+            pk = lookup_id(Ingredient, item["ingredient"])
+            if pk is not None:
+                pantry[pk] = item.get("amount", np.inf)
+
+        # Score the pantry against every recipe at once. Recipes without
+        # ingredients would match any pantry, so they are left out.
+        matrix = get_recipe_matrix()
+        have = matrix.column_vector(pantry)
+        missing = matrix.count_missing(have)
+        rows = np.flatnonzero((missing <= max_missing) & (matrix.row_sizes > 0))
+        # Rows are in name order already, a stable sort keeps it within ties
+        rows = rows[np.argsort(missing[rows], kind="stable")][:limit]
+
+        missing_ids = {
+            row: matrix.ingredient_ids[matrix.missing_columns(row, have)].tolist()
+            for row in rows.tolist()
+        }
+        names = dict(query_in_chunks(
+            db.session.query(Ingredient.id, Ingredient.name), Ingredient.id,
+            {pk for ids in missing_ids.values() for pk in ids}
+        ))
+        descriptions = dict(query_in_chunks(
+            db.session.query(Recipe.id, Recipe.description), Recipe.id,
+            matrix.recipe_ids[rows].tolist()
+        ))
+
+        body = BigrecipeBuilder(items=[])
+        body.add_namespace("bigrec", LINK_RELATIONS_URL)
+        body.add_control_match_pantry()
+        body.add_control("collection", url_for("api.recipecollection"))
+        for row in rows.tolist():
+            recipe_id = int(matrix.recipe_ids[row])
+            item = BigrecipeBuilder(
+                name=matrix.recipe_names[row],
+                missing=int(missing[row]),
+                missing_ingredients=sorted(names[pk] for pk in missing_ids[row] if pk in names)
+            )
+            if descriptions.get(recipe_id):
+                item["description"] = descriptions[recipe_id]
+            item.add_control("self", url_for("api.recipeitem", recipe=matrix.recipe_names[row]))
+            item.add_control("profile", RECIPE_PROFILE)
+            body["items"].append(item)
+
+        return Response(dumps(body), 200, mimetype=MASON)
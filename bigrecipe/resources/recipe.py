@@ -2,73 +2,200 @@ import json
 from jsonschema import validate, ValidationError
 from flask import Response, request, url_for
 from flask_restful import Resource
+from sqlalchemy import bindparam, false, text
 from sqlalchemy.exc import IntegrityError
-from bigrecipe.models import Ingredient, Recipe, Recingpairings
+from sqlalchemy.orm import joinedload, load_only, selectinload
+from bigrecipe.models import Drink, Ingredient, Recipe, Recingpairings, Revision
 from bigrecipe import db
-from bigrecipe.utils import BigrecipeBuilder, create_error_response
+from bigrecipe.autocomplete import get_prefix_index
+from bigrecipe.cache import get_by_name, invalidate_name, lookup_id, prefetched
+from bigrecipe.etag import collection_etag, make_etag, not_modified, precondition_failed, row_etag, tagged
+from bigrecipe.index import get_recipe_index
+from bigrecipe.response_cache import cache_response, cached_response, invalidate_responses, row_tag
+from bigrecipe.similar import get_similar_index
+from bigrecipe.utils import (
+    BigrecipeBuilder, create_error_response, decode_cursor, dumps, dumps_collection, embedded_item, encode_cursor,
+    item_template, keyset_page, parse_embed, parse_fields, parse_page_limit, query_in_chunks
+)
 from bigrecipe.constants import *
 
 
 class RecipeCollection(Resource):
 
     def get(self):
-        
         try:
-            start = int(request.args.get("start", 0))
-            ingredient = str(request.args.get("ingredient"))
+            sort = request.args.get("sort", "name")
+            if sort not in ("name", "calories"):
+                raise ValueError("unknown sort order")
+            start = request.args.get("start")
+            if start is not None:
+                start = int(start)
+            after = request.args.get("after")
+            if after is not None:
+                after = self._decode_cursor(after, sort)
+            before = request.args.get("before")
+            if before is not None:
+                before = self._decode_cursor(before, sort)
+            min_calories = request.args.get("min_calories")
+            if min_calories is not None:
+                min_calories = float(min_calories)
+            max_calories = request.args.get("max_calories")
+            if max_calories is not None:
+                max_calories = float(max_calories)
+            limit = parse_page_limit(RECIPE_PAGE_SIZE)
+            ingredients = request.args.getlist("ingredient")
+            excludes = request.args.getlist("exclude")
+            fields = parse_fields(RECIPE_FIELDS, RECIPE_LIST_FIELDS)
+            embed = parse_embed(RECIPE_EMBEDS)
         except ValueError:
             return create_error_response(400, "Invalid query string value")
 
-        db_ingredient = Ingredient.query.filter_by(name=ingredient).first()
-
-        if db_ingredient is None:
-            remaining = Recipe.query.order_by("name").offset(start)
+        revisions = ["recipe"]
+        if "calories" in fields or sort == "calories" or min_calories is not None or max_calories is not None:
+            revisions.append("calories")
+        if ingredients or excludes or "ingredients" in embed:
+            revisions.extend(("pairing", "ingredient"))
+        if "drink" in embed:
+            revisions.append("drink")
+        etag = collection_etag(*revisions)
+        response = cached_response(etag) or not_modified(etag)
+        if response:
+            return response
+
+        # A recipe can't contain an ingredient that doesn't exist
+        include_ids = [lookup_id(Ingredient, name) for name in ingredients]
+        exclude_ids = [pk for pk in (lookup_id(Ingredient, name) for name in excludes) if pk is not None]
+        by_calories = sort == "calories" or min_calories is not None or max_calories is not None
+        # Only the columns of the chosen fields and the cursor are read
+        columns = [getattr(Recipe, field) for field in fields]
+        if sort == "calories":
+            columns.append(Recipe.calories)
+        # Related rows are fetched for the whole page at once, one query per
+        # relationship however long the page is
+        options = []
+        if "ingredients" in embed:
+            options.append(selectinload(Recipe.ingredients).joinedload(
+                Recingpairings.ingredient
+            ).load_only(Ingredient.name, Ingredient.unit))
+        if "drink" in embed:
+            columns.append(Recipe.drink_id)
+            options.append(selectinload(Recipe.drink).load_only(Drink.name, Drink.alcohol, Drink.description))
+        options.append(load_only(*columns))
+
+        if (ingredients or excludes) and not by_calories:
+            # Filters are answered from the inverted index, the database is
+            # only asked for the rows on the resulting page.
+            if None in include_ids:
+                names, has_prev, has_next = [], False, False
+            else:
+                names, has_prev, has_next = get_recipe_index().page(
+                    include_ids, exclude_ids, limit, after=after, before=before, start=start
+                )
+            rows = []
+            if names:
+                rows = Recipe.query.options(*options).filter(Recipe.name.in_(names)).order_by(Recipe.name).all()
         else:
-            remaining = Recipe.query.join(Recingpairings).join(Ingredient).filter((Recingpairings.recipe_id == Recipe.id)
-            & (Recingpairings.ingredient_id == db_ingredient.id)).order_by("name").offset(start)
+            remaining = Recipe.query.options(*options)
+            if None in include_ids:
+                remaining = remaining.filter(false())
+            for pk in include_ids:
+                remaining = remaining.filter(Recipe.ingredients.any(ingredient_id=pk))
+            for pk in exclude_ids:
+                remaining = remaining.filter(~Recipe.ingredients.any(ingredient_id=pk))
+            if min_calories is not None:
+                remaining = remaining.filter(Recipe.calories >= min_calories)
+            if max_calories is not None:
+                remaining = remaining.filter(Recipe.calories <= max_calories)
+
+            keys = (Recipe.calories, Recipe.name) if sort == "calories" else Recipe.name
+            if start is not None:
+                # Offset based paging is kept for old clients, but it still
+                # hands out cursors for the following pages.
+                order = keys if isinstance(keys, tuple) else (keys,)
+                rows = remaining.order_by(*order).offset(start).limit(limit + 1).all()
+                has_prev, has_next = start > 0, len(rows) > limit
+                rows = rows[:limit]
+            else:
+                rows, has_prev, has_next = keyset_page(remaining, keys, limit, after=after, before=before)
 
-        body = BigrecipeBuilder(
-            items=[]
-        )
-        body.add_namespace("bigrec", LINK_RELATIONS_URL)
-        body.add_control("self", url_for("api.recipecollection"))
-        body.add_control_add_recipe()
+        def page_uri(**kwargs):
+            if "limit" in request.args:
+                kwargs["limit"] = limit
+            for arg in ("sort", "min_calories", "max_calories", "fields", "embed"):
+                kwargs[arg] = request.args.get(arg)
+            return url_for("api.recipecollection", ingredient=ingredients or None, exclude=excludes or None, **kwargs)
 
-        if db_ingredient:
-            base_uri = url_for("api.recipecollection", ingredient=ingredient)
-            body.add_control("bigrec:ingredient", url_for("api.ingredientitem", ingredient=ingredient))
-        else:
-            base_uri = url_for("api.recipecollection")
-        if start >= 2 and db_ingredient:
-            body.add_control("self", base_uri + "&start={}".format(start))
-            body.add_control("prev", base_uri + "&start={}".format(start - RECIPE_PAGE_SIZE))
-        elif start >= 2:
-            body.add_control("self", base_uri + "?start={}".format(start))
-            body.add_control("prev", base_uri + "?start={}".format(start - RECIPE_PAGE_SIZE))
-        else:
-            body.add_control("self", base_uri)
-        if remaining.count() > 2 and db_ingredient:
-            body.add_control("next", base_uri + "&start={}".format(start + RECIPE_PAGE_SIZE))
-        elif remaining.count() > 2:
-            body.add_control("next", base_uri + "?start={}".format(start + RECIPE_PAGE_SIZE))
-
-        for rec in remaining.limit(RECIPE_PAGE_SIZE):
-            if rec.description:
-                item = BigrecipeBuilder(
-                    name=rec.name,
-                    description=rec.description,
-                    text=rec.text
-                )
-            else:
-                item = BigrecipeBuilder(
-                    name=rec.name,
-                    text=rec.text
-                    )
-            item.add_control("self", url_for("api.recipeitem", recipe=rec.name))
-            item.add_control("profile", RECIPE_PROFILE)
-            body["items"].append(item)
+        def cursor(rec):
+            if sort == "calories":
+                return encode_cursor(json.dumps([rec.calories, rec.name]))
+            return encode_cursor(rec.name)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        body = BigrecipeBuilder()
+        body.add_namespace("bigrec", LINK_RELATIONS_URL)
+        body.add_control(
+            "self",
+            page_uri(
+                start=request.args.get("start"),
+                after=request.args.get("after"),
+                before=request.args.get("before")
+            )
+        )
+        body.add_control_add_recipe()
+        body.add_control_import_recipes()
+        body.add_control_search_recipes()
+
+        if len(ingredients) == 1 and include_ids[0] is not None:
+            body.add_control("bigrec:ingredient", url_for("api.ingredientitem", ingredient=ingredients[0]))
+        if rows and has_prev:
+            body.add_control("prev", page_uri(before=cursor(rows[0])))
+        if rows and has_next:
+            body.add_control("next", page_uri(after=cursor(rows[-1])))
+
+        template = item_template("recipe")
+        items = []
+        # Pages that are filtered or sorted by calories can change whenever
+        # any total changes, filtered pages whenever pairings do. Pages with
+        # embedded items also change with them.
+        tags = ["recipe"] + [row_tag("recipe", rec.id) for rec in rows]
+        if by_calories:
+            tags.append("calories")
+        if ingredients or excludes or "ingredients" in embed:
+            tags.extend(("pairing", "ingredient"))
+        if "drink" in embed:
+            tags.append("drink")
+        for rec in rows:
+            values = [
+                (field, getattr(rec, field)) for field in fields
+                if field != "name" and (field != "description" or rec.description)
+            ]
+            if "ingredients" in embed:
+                pairings = sorted(rec.ingredients, key=lambda pairing: pairing.ingredient.name)
+                values.append(("ingredients", [
+                    _embedded_ingredient(pairing.ingredient.name, pairing.ingredient.unit, pairing.amount)
+                    for pairing in pairings
+                ]))
+                tags.extend(row_tag("ingredient", pairing.ingredient_id) for pairing in pairings)
+            if "drink" in embed:
+                values.append(("drink", _embedded_drink(rec.drink)))
+                if rec.drink is not None:
+                    tags.append(row_tag("drink", rec.drink_id))
+            items.append(template.render(rec.name, values))
+
+        return cache_response(tagged(Response(dumps_collection(body, items), 200, mimetype=MASON), etag), tags)
+
+    @staticmethod
+    def _decode_cursor(cursor, sort):
+        value = decode_cursor(cursor)
+        if sort == "calories":
+            value = json.loads(value)
+            if (
+                not isinstance(value, list) or len(value) != 2
+                or not isinstance(value[0], (int, float)) or isinstance(value[0], bool)
+                or not isinstance(value[1], str)
+            ):
+                raise ValueError("invalid cursor")
+            value = tuple(value)
+        return value
 
     def post(self):
         if not request.json:
@@ -101,25 +228,65 @@ class RecipeCollection(Resource):
                 409, "Already exists",
                 "Recipe with name '{}' already exists.".format(request.json["name"])
             )
+        with get_recipe_index(build=False).updating() as index:
+            index.add_recipe(recipe.id, recipe.name)
+        with get_prefix_index("recipe", build=False).updating() as index:
+            index.add(request.json["name"])
+        invalidate_responses("recipe")
 
         return Response(status=201, headers={
             "Location": url_for("api.recipeitem", recipe=request.json["name"])
         })
 
+def _embedded_ingredient(name, unit, amount):
+    return embedded_item("ingredient", name, [("unit", unit), ("amount", amount)])
+
+def _embedded_drink(drink):
+    if drink is None:
+        return None
+    fields = [("alcohol", drink.alcohol)]
+    if drink.description:
+        fields.append(("description", drink.description))
+    return embedded_item("drink", drink.name, fields)
+
+
 class RecipeItem(Resource):
 
     def get(self, recipe):
-        db_recipe = Recipe.query.filter_by(name=recipe).first()
-        if db_recipe is None:
+        try:
+            fields = parse_fields(RECIPE_FIELDS)
+            embed = parse_embed(RECIPE_EMBEDS)
+        except ValueError:
+            return create_error_response(400, "Invalid query string value")
+        etag = self._etag(recipe, embed)
+        if etag is None:
             return create_error_response(
                 404, "Not found",
                 "No recipe was found with the name {}".format(recipe)
             )
-        body = BigrecipeBuilder(
-            name=db_recipe.name,
-            description=db_recipe.description,
-            text=db_recipe.text
+        response = not_modified(etag)
+        if response:
+            return response
+
+        db_recipe = get_by_name(
+            Recipe, recipe, joinedload(Recipe.drink),
+            load_only(*[getattr(Recipe, field) for field in fields])
         )
+        if db_recipe is None:
+            return create_error_response(
+                404, "Not found",
+                "No recipe was found with the name {}".format(recipe)
+            )
+        body = BigrecipeBuilder((field, getattr(db_recipe, field)) for field in fields)
+        if "ingredients" in embed:
+            body["ingredients"] = [
+                _embedded_ingredient(name, unit, amount) for name, unit, amount in
+                db.session.query(Ingredient.name, Ingredient.unit, Recingpairings.amount).join(
+                    Recingpairings, Recingpairings.ingredient_id == Ingredient.id
+                ).filter(Recingpairings.recipe_id == db_recipe.id).order_by(Ingredient.name)
+            ]
+        if "drink" in embed:
+            body["drink"] = _embedded_drink(db_recipe.drink)
         body.add_namespace("bigrec", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.recipeitem", recipe=recipe))
         body.add_control("profile", RECIPE_PROFILE)
@@ -127,18 +294,41 @@ class RecipeItem(Resource):
         body.add_control_delete_recipe(recipe)
         body.add_control_modify_recipe(recipe)
         body.add_control_get_recingpairings(recipe)
+        body.add_control_get_similar(recipe)
         if db_recipe.drink:
             body.add_control_get_drink(db_recipe.drink.name)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return tagged(Response(dumps(body), 200, mimetype=MASON), etag)
+
+    @staticmethod
+    def _etag(recipe, embed=()):
+        # The representation names the recipe's drink, so the drink's
+        # version is part of the tag. Pairing changes bump the recipe
+        # version, embedded ingredients need the ingredient revision too.
+        row = prefetched(Recipe, recipe)
+        if row is not None:
+            # Loaded by a batch together with its drink
+            etag = make_etag(row.version, row.drink.version if row.drink is not None else None)
+            if "ingredients" in embed:
+                etag = make_etag(etag, collection_etag("ingredient"))
+            return etag
+        query = db.session.query(Recipe.version, Drink.version).outerjoin(
+            Drink, Drink.id == Recipe.drink_id
+        ).filter(Recipe.name == recipe)
+        if "ingredients" in embed:
+            query = query.add_columns(Revision.version).join(Revision, Revision.name == "ingredient")
+        return row_etag(query)
 
     def put(self, recipe):
-        db_recipe = Recipe.query.filter_by(name=recipe).first()
+        db_recipe = get_by_name(Recipe, recipe)
         if db_recipe is None:
             return create_error_response(
                 404, "Not found",
                 "No recipe was found with the name {}".format(recipe)
             )
+        response = precondition_failed(self._etag(recipe))
+        if response:
+            return response
 
         if not request.json:
             return create_error_response(
@@ -151,6 +341,8 @@ class RecipeItem(Resource):
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
+        invalidate_name(Recipe, recipe)
+        recipe_id = db_recipe.id
         db_recipe.name = request.json["name"]
         db_recipe.text = request.json["text"]
         try:
@@ -165,51 +357,179 @@ class RecipeItem(Resource):
                 409, "Already exists",
                 "Recipe with name '{}' already exists.".format(request.json["name"])
             )
+        with get_recipe_index(build=False).updating() as index:
+            index.rename_recipe(recipe_id, recipe, request.json["name"])
+        with get_prefix_index("recipe", build=False).updating() as index:
+            index.rename(recipe, request.json["name"])
+        # A rename can move the recipe to another page, other edits only
+        # change the pages it is on
+        invalidate_responses("recipe" if recipe != request.json["name"] else row_tag("recipe", recipe_id))
 
         return Response(status=204)
 
     def delete(self, recipe):
-        db_recipe = Recipe.query.filter_by(name=recipe).first()
+        db_recipe = get_by_name(Recipe, recipe)
         if db_recipe is None:
             return create_error_response(
                 404, "Not found",
                 "No recipe was found with the name {}".format(recipe)
             )
+        response = precondition_failed(self._etag(recipe))
+        if response:
+            return response
 
-        if db_recipe.ingredients:
+        if db.session.query(Recingpairings.query.filter_by(recipe_id=db_recipe.id).exists()).scalar():
             return create_error_response(
                 403, "Forbidden",
                 "Can't delete recipe with paired ingredients."
             )
         else:
+            invalidate_name(Recipe, recipe)
+            recipe_id = db_recipe.id
             db.session.delete(db_recipe)
             db.session.commit()
+            with get_recipe_index(build=False).updating() as index:
+                index.remove_recipe(recipe_id, recipe)
+            with get_prefix_index("recipe", build=False).updating() as index:
+                index.remove(recipe)
+            invalidate_responses("recipe")
 
             return Response(status=204)
 
+class RecipeSearch(Resource):
+
+    # Ranks all matches, but only returns ids for one page after the cursor.
+    # Lower bm25 scores are better matches.
+    PAGE_SQL = text(
+        "SELECT id, rank FROM ("
+        "SELECT recipe_fts.rowid AS id, bm25(recipe_fts) AS rank "
+        "FROM recipe_fts WHERE recipe_fts MATCH :match) "
+        "WHERE :after_rank IS NULL OR rank > :after_rank "
+        "OR (rank = :after_rank AND id > :after_id) "
+        "ORDER BY rank, id LIMIT :limit"
+    )
+    ROWS_SQL = text(
+        "SELECT recipe.id, recipe.name, recipe.description, "
+        "snippet(recipe_fts, -1, '<mark>', '</mark>', '...', 12) "
+        "FROM recipe_fts JOIN recipe ON recipe.id = recipe_fts.rowid "
+        "WHERE recipe_fts MATCH :match AND recipe_fts.rowid IN :ids"
+    ).bindparams(bindparam("ids", expanding=True))
+
+    def get(self):
+        try:
+            query = request.args["q"]
+            after_rank = after_id = None
+            after = request.args.get("after")
+            if after is not None:
+                after_rank, after_id = decode_cursor(after).rsplit(":", 1)
+                after_rank, after_id = float(after_rank), int(after_id)
+            limit = parse_page_limit(SEARCH_PAGE_SIZE)
+        except (KeyError, ValueError):
+            return create_error_response(400, "Invalid query string value")
+
+        # Every word is quoted, so user input can't use FTS5 query syntax
+        terms = query.split()
+        if not terms:
+            return create_error_response(400, "Invalid query string value", "No search terms given")
+        match = " ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+        etag = collection_etag("recipe")
+        response = not_modified(etag)
+        if response:
+            return response
+
+        page = db.session.execute(self.PAGE_SQL, {
+            "match": match, "after_rank": after_rank, "after_id": after_id, "limit": limit + 1
+        }).all()
+        has_next = len(page) > limit
+        page = page[:limit]
+        rows = {}
+        if page:
+            rows = {
+                row[0]: row for row in
+                db.session.execute(self.ROWS_SQL, {"match": match, "ids": [row[0] for row in page]})
+            }
+
+        def page_uri(**kwargs):
+            if "limit" in request.args:
+                kwargs["limit"] = limit
+            return url_for("api.recipesearch", q=query, **kwargs)
+
+        body = BigrecipeBuilder(items=[])
+        body.add_namespace("bigrec", LINK_RELATIONS_URL)
+        body.add_control("self", page_uri(after=after))
+        body.add_control("collection", url_for("api.recipecollection"))
+        body.add_control_search_recipes()
+        if has_next:
+            body.add_control("next", page_uri(after=encode_cursor("{!r}:{}".format(page[-1][1], page[-1][0]))))
+
+        for recipe_id, rank in page:
+            if recipe_id not in rows:
+                continue
+            recipe_id, name, description, snippet = rows[recipe_id]
+            item = BigrecipeBuilder(
+                name=name,
+                snippet=snippet,
+                rank=rank
+            )
+            if description:
+                item["description"] = description
+            item.add_control("self", url_for("api.recipeitem", recipe=name))
+            item.add_control("profile", RECIPE_PROFILE)
+            body["items"].append(item)
+
+        return tagged(Response(dumps(body), 200, mimetype=MASON), etag)
+
 class RecipeIngredientPairing(Resource):
 
     def get(self, recipe):
-        db_recipe = Recipe.query.filter_by(name=recipe).first()
-        if db_recipe is None:
+        etag = self._etag(recipe)
+        if etag is None:
+            return create_error_response(
+                404, "Not found",
+                "No recipe was found with the name {}".format(recipe)
+            )
+        response = not_modified(etag)
+        if response:
+            return response
+
+        # One projected query for the recipe and all of its pairings. The
+        # outer joins keep the recipe row even when it has no ingredients.
+        rows = db.session.query(
+            Recipe.name, Ingredient.name, Ingredient.unit, Recingpairings.amount
+        ).outerjoin(
+            Recingpairings, Recingpairings.recipe_id == Recipe.id
+        ).outerjoin(
+            Ingredient, Ingredient.id == Recingpairings.ingredient_id
+        ).filter(Recipe.name == recipe).order_by(Ingredient.name).all()
+        if not rows:
             return create_error_response(
                 404, "Not found",
                 "No recipe was found with the name {}".format(recipe)
             )
         ingamt={}
-        for i in Recingpairings.query.join(Recipe).join(Ingredient).filter((Recingpairings.recipe_id == db_recipe.id)).order_by("name").all():
-            q = Ingredient.query.filter_by(id = i.ingredient_id).first()
-            ingamt[q.name] = i.amount, q.unit
+        for recipe_name, ingredient_name, unit, amount in rows:
+            if ingredient_name is not None:
+                ingamt[ingredient_name] = amount, unit
         body = BigrecipeBuilder(
             ingredients = ingamt,
-            recipe = db_recipe.name
+            recipe = rows[0][0]
         )
         body.add_namespace("bigrec", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.recipeingredientpairing", recipe=recipe))
         body.add_control_add_pairing(recipe)
         body.add_control_get_recipe(recipe)
         body.add_control_delete_pairing(recipe)
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return tagged(Response(dumps(body), 200, mimetype=MASON), etag)
+
+    @staticmethod
+    def _etag(recipe):
+        # Pairing changes bump the recipe version, ingredient renames and
+        # unit changes only show in the ingredient collection's version
+        return row_etag(
+            db.session.query(Recipe.version, Revision.version).join(
+                Revision, Revision.name == "ingredient"
+            ).filter(Recipe.name == recipe)
+        )
 
     def post(self, recipe):
         if not request.json:
@@ -222,19 +542,37 @@ class RecipeIngredientPairing(Resource):
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
+        # The ids are written, so ids remembered from before another
+        # process reused them must not be trusted
+        recid = lookup_id(Recipe, request.json["recipe"], verify=True)
+        ingid = lookup_id(Ingredient, request.json["ingredient"], verify=True)
+        if recid is None or ingid is None:
+            return create_error_response(
+                404, "Not found",
+                "No such recipe or ingredient was found"
+            )
+
         recingpairing = Recingpairings(
             amount=request.json["amount"],
-            recipe=Recipe.query.filter_by(name=request.json["recipe"]).first(),
-            ingredient=Ingredient.query.filter_by(name=request.json["ingredient"]).first()
+            recipe_id=recid,
+            ingredient_id=ingid
             )
+        calories = db.session.query(Ingredient.calories).filter_by(id=ingid).scalar() or 0
+        delta = request.json["amount"] * calories
         try:
             db.session.add(recingpairing)
+            Recipe.add_calories(recid, delta)
             db.session.commit()
         except IntegrityError:
             return create_error_response(
                 409, "Already exists",
                 "Pairing for ingredient'{}' already exists.".format(request.json["ingredient"])
             )
+        with get_recipe_index(build=False).updating() as index:
+            index.add_pairing(recid, ingid)
+        with get_similar_index(build=False).updating() as index:
+            index.add_ingredient(recid, ingid)
+        invalidate_responses(row_tag("recipe", recid), "pairing", *(("calories",) if delta else ()))
 
         return Response(status=201, headers={
             "Location": url_for("api.recipeingredientpairing", recipe=request.json["recipe"])
@@ -248,21 +586,170 @@ class RecipeIngredientPairing(Resource):
             return create_error_response(
                 404, "No such pairing found"
             )
-        try:
-            recid = Recipe.query.filter_by(name=db_recipe_name).first().id
-            ingid = Ingredient.query.filter_by(name=db_ingredient_name).first().id
-        except AttributeError:
+        recid = lookup_id(Recipe, db_recipe_name, verify=True)
+        ingid = lookup_id(Ingredient, db_ingredient_name, verify=True)
+        if recid is None or ingid is None:
             return create_error_response(
                 404, "No such pairing found"
             )
-        db_pairing = Recingpairings.query.filter((Recingpairings.recipe_id == recid) & (Recingpairings.ingredient_id == ingid)).first()
+        db_pairing = db.session.get(Recingpairings, (recid, ingid))
         if db_pairing is None:
             return create_error_response(
                 404, "Not found",
                 "No pairing was found with the input {}".format(db_recipe_name)+"{}".format(db_ingredient_name)
             )
+        response = precondition_failed(self._etag(db_recipe_name))
+        if response:
+            return response
 
+        calories = db.session.query(Ingredient.calories).filter_by(id=ingid).scalar() or 0
+        delta = -(db_pairing.amount or 0) * calories
+        Recipe.add_calories(recid, delta)
         db.session.delete(db_pairing)
         db.session.commit()
+        with get_recipe_index(build=False).updating() as index:
+            index.remove_pairing(recid, ingid)
+        similar_index = get_similar_index(build=False)
+        if similar_index.built:
+            ingredient_ids = [
+                pk for (pk,) in db.session.query(Recingpairings.ingredient_id).filter_by(recipe_id=recid)
+            ]
+            with similar_index.updating() as index:
+                index.set_ingredients(recid, ingredient_ids)
+        invalidate_responses(row_tag("recipe", recid), "pairing", *(("calories",) if delta else ()))
+
+        return Response(status=204)
+
+class RecipeImport(Resource):
+
+    def post(self):
+        if request.mimetype == NDJSON:
+            try:
+                batch = [
+                    json.loads(line) for line in request.get_data(as_text=True).splitlines()
+                    if line.strip()
+                ]
+            except ValueError as e:
+                return create_error_response(400, "Invalid NDJSON document", str(e))
+        elif request.is_json:
+            batch = request.get_json(silent=True)
+        else:
+            return create_error_response(
+                415, "Unsupported media type",
+                "Requests must be JSON or NDJSON"
+            )
+        if not isinstance(batch, list):
+            return create_error_response(
+                400, "Invalid JSON document",
+                "Request body must be an array of recipes"
+            )
 
-        return Response(status=204)
\ No newline at end of file
+        # Validate the whole batch before touching the database
+        schema = Recipe.get_import_schema()
+        report = [None] * len(batch)
+        pending = {}
+        for index, item in enumerate(batch):
+            try:
+                validate(item, schema)
+            except ValidationError as e:
+                report[index] = "invalid", e.message
+                continue
+            names = [pairing["ingredient"] for pairing in item.get("ingredients", [])]
+            if len(set(names)) != len(names):
+                report[index] = "invalid", "Recipe lists the same ingredient more than once."
+            elif item["name"] in pending:
+                report[index] = "conflict", "Recipe with name '{}' appears twice in the batch.".format(item["name"])
+            else:
+                pending[item["name"]] = index
+
+        for (name,) in query_in_chunks(db.session.query(Recipe.name), Recipe.name, list(pending)):
+            report[pending.pop(name)] = "conflict", "Recipe with name '{}' already exists.".format(name)
+
+        # Resolve every ingredient name used in the batch at once
+        ingredient_names = {
+            pairing["ingredient"]
+            for name in pending
+            for pairing in batch[pending[name]].get("ingredients", [])
+        }
+        ingredient_ids = {}
+        ingredient_calories = {}
+        for name, pk, calories in query_in_chunks(
+            db.session.query(Ingredient.name, Ingredient.id, Ingredient.calories), Ingredient.name, ingredient_names
+        ):
+            ingredient_ids[name] = pk
+            ingredient_calories[name] = calories or 0
+        for name in list(pending):
+            missing = [
+                pairing["ingredient"] for pairing in batch[pending[name]].get("ingredients", [])
+                if pairing["ingredient"] not in ingredient_ids
+            ]
+            if missing:
+                report[pending.pop(name)] = "invalid", "Unknown ingredients: {}".format(", ".join(missing))
+
+        if pending:
+            db.session.execute(Recipe.__table__.insert(), [
+                {
+                    "name": name,
+                    "description": batch[index].get("description"),
+                    "text": batch[index]["text"],
+                    "calories": sum(
+                        pairing["amount"] * ingredient_calories[pairing["ingredient"]]
+                        for pairing in batch[index].get("ingredients", [])
+                    )
+                }
+                for name, index in pending.items()
+            ])
+            recipe_ids = dict(query_in_chunks(
+                db.session.query(Recipe.name, Recipe.id), Recipe.name, list(pending)
+            ))
+            pairings = [
+                {
+                    "recipe_id": recipe_ids[name],
+                    "ingredient_id": ingredient_ids[pairing["ingredient"]],
+                    "amount": pairing["amount"]
+                }
+                for name, index in pending.items()
+                for pairing in batch[index].get("ingredients", [])
+            ]
+            if pairings:
+                db.session.execute(Recingpairings.__table__.insert(), pairings)
+            # Core inserts don't go through the flush events
+            Revision.bump("recipe", "recipe-names", "pairing")
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                return create_error_response(
+                    409, "Conflict",
+                    "The batch conflicts with changes made while it was imported."
+                )
+            with get_recipe_index(build=False).updating() as recipe_index, \
+                    get_prefix_index("recipe", build=False).updating() as prefix_index:
+                for name, index in pending.items():
+                    recipe_index.add_recipe(recipe_ids[name], name)
+                    prefix_index.add(name)
+                    report[index] = "created", None
+                for pairing in pairings:
+                    recipe_index.add_pairing(pairing["recipe_id"], pairing["ingredient_id"])
+            new_sets = {}
+            for pairing in pairings:
+                new_sets.setdefault(pairing["recipe_id"], []).append(pairing["ingredient_id"])
+            with get_similar_index(build=False).updating() as similar_index:
+                for recipe_id, ingredient_ids in new_sets.items():
+                    similar_index.set_ingredients(recipe_id, ingredient_ids)
+            invalidate_responses("recipe", "pairing")
+
+        body = BigrecipeBuilder(items=[])
+        body.add_namespace("bigrec", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.recipeimport"))
+        body.add_control("collection", url_for("api.recipecollection"))
+        for item, (status, message) in zip(batch, report):
+            name = item.get("name") if isinstance(item, dict) else None
+            result = BigrecipeBuilder(name=name, status=status)
+            if message:
+                result["message"] = message
+            if status == "created":
+                result.add_control("self", url_for("api.recipeitem", recipe=name))
+            body["items"].append(result)
+
+        return Response(dumps(body), 200, mimetype=MASON)
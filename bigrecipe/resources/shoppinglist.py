@@ -0,0 +1,62 @@
+from jsonschema import validate, ValidationError
+from flask import Response, request, url_for
+from flask_restful import Resource
+from sqlalchemy import case, func
+from bigrecipe.models import Ingredient, Recipe, Recingpairings
+from bigrecipe import db
+from bigrecipe.utils import BigrecipeBuilder, create_error_response, dumps, query_in_chunks
+from bigrecipe.constants import *
+
+
+class ShoppingList(Resource):
+
+    def post(self):
+        if not request.json:
+            return create_error_response(
+                415, "Unsupported media type",
+                "Requests must be JSON"
+            )
+
+        try:
+            validate(request.json, BigrecipeBuilder._shopping_list_schema())
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        # Serving multiplier per recipe, a recipe listed twice is cooked twice
+        wanted = {}
+        for item in request.json["recipes"]:
+            wanted[item["recipe"]] = wanted.get(item["recipe"], 0) + item.get("scale", 1)
+        ids = dict(query_in_chunks(db.session.query(Recipe.name, Recipe.id), Recipe.name, wanted))
+        scales = {ids[name]: scale for name, scale in wanted.items() if name in ids}
+
+        # Sum the scaled amounts per ingredient in the database. Every recipe
+        # binds three parameters, so the chunks are a third of the usual size.
+        totals = {}
+        recipe_ids = list(scales)
+        size = IN_CLAUSE_CHUNK // 3
+        for i in range(0, len(recipe_ids), size):
+            chunk = recipe_ids[i:i + size]
+            scale = case({pk: scales[pk] for pk in chunk}, value=Recingpairings.recipe_id)
+            rows = db.session.query(
+                Ingredient.name, Ingredient.unit,
+                func.sum(func.coalesce(Recingpairings.amount, 0) * scale)
+            ).join(
+                Ingredient, Ingredient.id == Recingpairings.ingredient_id
+            ).filter(
+                Recingpairings.recipe_id.in_(chunk)
+            ).group_by(Ingredient.id, Ingredient.name, Ingredient.unit)
+            for name, unit, amount in rows:
+                totals[unit, name] = totals.get((unit, name), 0) + amount
+
+        units = {}
+        for unit, name in sorted(totals):
+            units.setdefault(unit, {})[name] = totals[unit, name]
+
+        body = BigrecipeBuilder(
+            units=units,
+            unknown=[name for name in wanted if name not in ids]
+        )
+        body.add_namespace("bigrec", LINK_RELATIONS_URL)
+        body.add_control_shopping_list()
+        body.add_control("collection", url_for("api.recipecollection"))
+        return Response(dumps(body), 200, mimetype=MASON)
@@ -0,0 +1,48 @@
+from flask import Response, url_for
+from flask_restful import Resource
+from bigrecipe.models import Recipe
+from bigrecipe import db
+from bigrecipe.cache import lookup_id
+from bigrecipe.etag import collection_etag, not_modified, tagged
+from bigrecipe.similar import most_similar
+from bigrecipe.utils import BigrecipeBuilder, create_error_response, dumps, parse_page_limit, query_in_chunks
+from bigrecipe.constants import *
+
+
+class SimilarRecipes(Resource):
+
+    def get(self, recipe):
+        try:
+            limit = parse_page_limit(SIMILAR_SIZE)
+        except ValueError:
+            return create_error_response(400, "Invalid query string value")
+        recipe_id = lookup_id(Recipe, recipe)
+        if recipe_id is None:
+            return create_error_response(
+                404, "Not found",
+                "No recipe was found with the name {}".format(recipe)
+            )
+
+        etag = collection_etag("recipe", "pairing")
+        response = not_modified(etag)
+        if response:
+            return response
+
+        scored = most_similar(recipe_id, limit)
+        names = dict(query_in_chunks(
+            db.session.query(Recipe.id, Recipe.name), Recipe.id, [pk for score, pk in scored]
+        ))
+
+        body = BigrecipeBuilder(items=[])
+        body.add_namespace("bigrec", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.similarrecipes", recipe=recipe))
+        body.add_control_get_recipe(recipe)
+        for similarity, pk in scored:
+            if pk not in names:
+                continue
+            item = BigrecipeBuilder(name=names[pk], similarity=similarity)
+            item.add_control("self", url_for("api.recipeitem", recipe=names[pk]))
+            item.add_control("profile", RECIPE_PROFILE)
+            body["items"].append(item)
+
+        return tagged(Response(dumps(body), 200, mimetype=MASON), etag)
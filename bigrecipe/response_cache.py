@@ -0,0 +1,176 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import Response, current_app, g, request
+from bigrecipe.etag import not_modified, tagged
+from bigrecipe.constants import *
+
+"""
+Server side cache for the serialized bodies of collection GETs. Entries are
+keyed by path and normalized query string and carry tags naming what they
+contain: a collection ("recipe") for anything that depends on which rows
+exist and in what order, and single rows ("recipe:12") for the items on the
+page. Write handlers evict by tag after they commit. Writes made by other
+processes don't evict anything here, so an entry is only served while the
+ETag it was stored with matches the one computed from the revision table
+for the request, and a TTL bounds how long unused entries are kept.
+
+A GET may read its rows before a write commits and finish after the write
+has evicted its tags, so every eviction bumps a generation and a body is
+only stored if the generation hasn't moved since its request missed.
+"""
+
+
+class ResponseCache(object):
+    """
+    A thread safe LRU of response bodies bounded by their total size, with
+    an index from tags to the keys of the entries carrying them.
+    """
+
+    def __init__(self, maxbytes, ttl):
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._keys_by_tag = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, etag=None):
+        """
+        Returns the body and ETag stored under key, or None. An expired entry
+        is dropped, and so is one stored under another ETag than the given
+        one, as its collection has been written since.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[3] < time.monotonic() or etag not in (None, entry[1])):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, key, body, etag, tags, generation=None):
+        """
+        Stores a body, unless generation is given and something has been
+        evicted since it was read.
+        """
+
+        if len(body) > self.maxbytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = body, etag, tags, time.monotonic() + self.ttl
+            self.size += len(body)
+            for tag in tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            while self.size > self.maxbytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, *tags):
+        with self._lock:
+            self.generation += 1
+            for tag in tags:
+                for key in list(self._keys_by_tag.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._keys_by_tag.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "maxbytes": self.maxbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+    def _remove(self, key):
+        body, etag, tags, expires = self._entries.pop(key)
+        self.size -= len(body)
+        for tag in tags:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+
+def init_app(app):
+    if app.config["RESPONSE_CACHE"]:
+        app.extensions["response_cache"] = ResponseCache(
+            app.config["RESPONSE_CACHE_BYTES"], app.config["RESPONSE_CACHE_TTL"]
+        )
+
+def get_response_cache():
+    """
+    Returns the response cache of the current app, or None if it is
+    switched off.
+    """
+
+    return current_app.extensions.get("response_cache")
+
+def _request_key():
+    return request.path, tuple(sorted(request.args.items(multi=True)))
+
+def cached_response(etag):
+    """
+    Returns the cached response for the current request if it was stored
+    under etag, the current ETag of the collection, or None on a miss. A
+    client that already has the cached body gets a 304. On a miss the
+    generation is remembered for cache_response, as the handler reads its
+    rows after this.
+    """
+
+    cache = get_response_cache()
+    if cache is None:
+        return None
+    g.response_cache_generation = cache.generation
+    entry = cache.get(_request_key(), etag)
+    if entry is None:
+        return None
+    return not_modified(etag) or tagged(Response(entry[0], 200, mimetype=MASON), etag)
+
+def cache_response(response, tags):
+    """
+    Stores a successful response for the current request under the given
+    tags, and returns it. Nothing is stored if an eviction happened since
+    cached_response missed, as the rows may predate that write.
+    """
+
+    cache = get_response_cache()
+    if cache is not None and response.status_code == 200:
+        cache.put(
+            _request_key(), response.get_data(), response.get_etag()[0], frozenset(tags),
+            g.pop("response_cache_generation", None)
+        )
+    return response
+
+def invalidate_responses(*tags):
+    cache = get_response_cache()
+    if cache is not None:
+        cache.invalidate(*tags)
+
+def row_tag(kind, pk):
+    return "{}:{}".format(kind, pk)
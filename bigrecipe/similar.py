@@ -0,0 +1,316 @@
+import json
+import os
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+from bigrecipe import db
+from bigrecipe.index import VersionedIndex
+from bigrecipe.matrix import get_recipe_matrix
+from bigrecipe.models import Recingpairings, Revision
+from bigrecipe.utils import query_in_chunks
+from bigrecipe.constants import *
+
+"""
+Similar recipe lookups by Jaccard similarity of ingredient sets. Every recipe
+with ingredients gets a MinHash signature, and recipes whose signatures agree
+on a whole band of hash values share an LSH bucket, so the candidates for a
+recipe are found without comparing it against the whole catalog. Only the
+candidates are then scored exactly.
+
+The signatures are written to NumPy files in the instance folder by the
+build-similar command only, together with the revisions they were built at.
+Every server process maps them copy-on-write, so its own updates stay in its
+memory and the files are never written by more than one process. Like the
+other indexes, the signatures are computed again in memory when the files
+are missing or the revisions have moved on since. Signatures only depend on
+pairings, so only the pairing revision counts, and the processes apply their
+own pairing writes in place.
+"""
+
+_PRIME = (1 << 31) - 1
+#Larger than any hash value, marks recipes without ingredients
+_EMPTY = _PRIME
+_A, _B = np.random.RandomState(MINHASH_SEED).randint(
+    1, _PRIME, size=(2, MINHASH_SIZE)
+).astype(np.int64)
+_BAND_ROWS = MINHASH_SIZE // LSH_BANDS
+
+
+def minhash(ingredient_ids):
+    """
+    Computes the MinHash signature of one set of ingredient ids.
+    """
+
+    ids = np.asarray(ingredient_ids, dtype=np.int64)
+    if not len(ids):
+        return np.full(MINHASH_SIZE, _EMPTY, dtype=np.uint32)
+    return ((_A[:, None] * ids + _B[:, None]) % _PRIME).min(axis=1).astype(np.uint32)
+
+
+class SimilarIndex(VersionedIndex):
+    """
+    Recipe ids and their signatures live in two arrays of the same length,
+    one slot per recipe with ingredients, as a recipe without any has no
+    similar recipes. Slots of recipes that lost their last ingredient have
+    id -1 and are reused. The arrays double in size when they run out of
+    free slots.
+    """
+
+    def __init__(self, path):
+        super().__init__("pairing")
+        self._ids_path = path + ".ids.npy"
+        self._signatures_path = path + ".signatures.npy"
+        self._versions_path = path + ".versions.json"
+        self._ids = None
+        self._signatures = None
+        self._slots = {}
+        self._free = []
+        self._buckets = []
+
+    def ensure_current(self):
+        if not self.built:
+            self.load()
+        super().ensure_current()
+
+    def load(self):
+        """
+        Maps the signature files if they exist. Returns whether they could
+        be used.
+        """
+
+        with self._lock:
+            if self.built:
+                return True
+            try:
+                # Read before the arrays, as a build that is being saved
+                # replaces the versions last
+                with open(self._versions_path) as f:
+                    saved = json.load(f)
+                size, versions = saved["size"], saved["versions"]
+                ids = np.load(self._ids_path, mmap_mode="c")
+                signatures = np.load(self._signatures_path, mmap_mode="c")
+            except (OSError, ValueError, KeyError):
+                return False
+            if ids.shape != (size,) or signatures.shape != (size, MINHASH_SIZE):
+                return False
+            self._open(ids, signatures, versions)
+            return True
+
+    def build(self):
+        """
+        Computes the signatures of every recipe in the recipe matrix. The
+        arrays are only kept in memory, see save.
+        """
+
+        versions = Revision.current(*self.revisions)
+        matrix = get_recipe_matrix()
+
+        # Hash values of every matrix column, then the minimum over the
+        # columns of each row, a block of rows at a time to bound memory
+        column_hashes = (
+            (matrix.ingredient_ids[:, None] * _A + _B) % _PRIME
+        ).astype(np.uint32)
+        signatures = np.full((len(matrix.recipe_ids), MINHASH_SIZE), _EMPTY, dtype=np.uint32)
+        for start in range(0, len(matrix.recipe_ids), 10000):
+            end = min(start + 10000, len(matrix.recipe_ids))
+            rows = start + np.flatnonzero(matrix.row_sizes[start:end] > 0)
+            if not len(rows):
+                continue
+            first, last = matrix.indptr[start], matrix.indptr[end]
+            signatures[rows] = np.minimum.reduceat(
+                column_hashes[matrix.indices[first:last]], matrix.indptr[rows] - first
+            )
+
+        paired = matrix.row_sizes > 0
+        signatures = signatures[paired]
+        # Leave some free slots, which also keeps the files from being empty
+        ids = np.full(max(len(signatures), 16), -1, dtype=np.int64)
+        ids[:len(signatures)] = matrix.recipe_ids[paired]
+        padded = np.full((len(ids), MINHASH_SIZE), _EMPTY, dtype=np.uint32)
+        padded[:len(signatures)] = signatures
+        with self._lock:
+            self._open(ids, padded, versions)
+
+    def save(self):
+        """
+        Writes the signatures to the instance folder, replacing any older
+        files. Only the build-similar command and other commands that own
+        the instance folder call this, never a server process.
+        """
+
+        with self._lock:
+            # Written next to the old files and swapped in, so a crash never
+            # leaves half a file behind. Processes that mapped the old files
+            # keep reading them until they load again.
+            for path, array in ((self._ids_path, self._ids), (self._signatures_path, self._signatures)):
+                with open(path + ".tmp", "wb") as f:
+                    np.save(f, array)
+                os.replace(path + ".tmp", path)
+            with open(self._versions_path + ".tmp", "w") as f:
+                json.dump({"size": len(self._ids), "versions": self.versions}, f)
+            os.replace(self._versions_path + ".tmp", self._versions_path)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def set_ingredients(self, recipe_id, ingredient_ids):
+        if len(ingredient_ids):
+            self._set_signature(recipe_id, minhash(ingredient_ids))
+        else:
+            self.remove_recipe(recipe_id)
+
+    def add_ingredient(self, recipe_id, ingredient_id):
+        # The minimum only ever goes down when an ingredient is added
+        with self._lock:
+            if not self._writable:
+                return
+            slot = self._slots.get(recipe_id)
+            signature = minhash([ingredient_id])
+            if slot is not None:
+                signature = np.minimum(signature, self._signatures[slot])
+            self._set_signature(recipe_id, signature)
+
+    def remove_recipe(self, recipe_id):
+        with self._lock:
+            if not self._writable or recipe_id not in self._slots:
+                return
+            slot = self._slots.pop(recipe_id)
+            self._unbucket(recipe_id, self._signatures[slot])
+            self._ids[slot] = -1
+            self._signatures[slot] = _EMPTY
+            self._free.append(slot)
+
+    def candidates(self, recipe_id):
+        """
+        Finds the recipes that share at least one LSH bucket with the given
+        recipe, not including the recipe itself.
+        """
+
+        with self._lock:
+            slot = self._slots.get(recipe_id)
+            if slot is None:
+                return set()
+            found = set()
+            for band, key in enumerate(self._band_keys(self._signatures[slot])):
+                found.update(self._buckets[band].get(key, ()))
+            found.discard(recipe_id)
+            return found
+
+    def _set_signature(self, recipe_id, signature):
+        with self._lock:
+            if not self._writable:
+                return
+            slot = self._slots.get(recipe_id)
+            if slot is None:
+                if not self._free:
+                    self._grow()
+                slot = self._free.pop()
+                self._slots[recipe_id] = slot
+                self._ids[slot] = recipe_id
+            else:
+                self._unbucket(recipe_id, self._signatures[slot])
+            self._signatures[slot] = signature
+            self._bucket(recipe_id, signature)
+
+    def _band_keys(self, signature):
+        if signature[0] == _EMPTY:
+            return []
+        return [
+            signature[band * _BAND_ROWS:(band + 1) * _BAND_ROWS].tobytes()
+            for band in range(LSH_BANDS)
+        ]
+
+    def _bucket(self, recipe_id, signature):
+        for band, key in enumerate(self._band_keys(signature)):
+            self._buckets[band].setdefault(key, set()).add(recipe_id)
+
+    def _unbucket(self, recipe_id, signature):
+        for band, key in enumerate(self._band_keys(signature)):
+            bucket = self._buckets[band].get(key)
+            if bucket is not None:
+                bucket.discard(recipe_id)
+                if not bucket:
+                    del self._buckets[band][key]
+
+    def _grow(self):
+        size = len(self._ids)
+        ids = np.full(max(2 * size, 16), -1, dtype=np.int64)
+        signatures = np.full((len(ids), MINHASH_SIZE), _EMPTY, dtype=np.uint32)
+        ids[:size] = self._ids
+        signatures[:size] = self._signatures
+        self._ids = ids
+        self._signatures = signatures
+        # Slots are handed out from the end of the list, lowest first
+        self._free = list(range(len(ids) - 1, size - 1, -1))
+
+    def _open(self, ids, signatures, versions):
+        self._ids = ids
+        self._signatures = signatures
+        self._slots = {}
+        self._free = []
+        self._buckets = [{} for band in range(LSH_BANDS)]
+        for slot, recipe_id in enumerate(ids.tolist()):
+            if recipe_id < 0:
+                self._free.append(slot)
+            else:
+                self._slots[recipe_id] = slot
+                self._bucket(recipe_id, signatures[slot])
+        # Slots are handed out from the end of the list, lowest first
+        self._free.reverse()
+        self.versions = versions
+
+
+def init_app(app):
+    path = app.config.get("SIMILAR_INDEX_PATH") or os.path.join(app.instance_path, "similar")
+    app.extensions["similar_index"] = SimilarIndex(path)
+
+def get_similar_index(build=True):
+    """
+    Returns the similar recipe index of the current app, brought up to date
+    with the database first. Writers pass build=False and apply their own
+    changes in an updating() block, as an index that isn't current will be
+    rebuilt anyway.
+    """
+
+    index = current_app.extensions["similar_index"]
+    if build:
+        index.ensure_current()
+    return index
+
+def most_similar(recipe_id, limit):
+    """
+    Scores the LSH candidates of a recipe by their exact Jaccard similarity
+    with it. Returns up to limit (similarity, recipe id) pairs, most similar
+    first.
+    """
+
+    candidates = get_similar_index().candidates(recipe_id)
+    if not candidates:
+        return []
+    sets = {}
+    for pk, ingredient_id in query_in_chunks(
+        db.session.query(Recingpairings.recipe_id, Recingpairings.ingredient_id),
+        Recingpairings.recipe_id, candidates | {recipe_id}
+    ):
+        sets.setdefault(pk, set()).add(ingredient_id)
+    own = sets.pop(recipe_id, set())
+    scored = [
+        (len(own & ingredients) / len(own | ingredients), pk)
+        for pk, ingredients in sets.items()
+    ]
+    scored.sort(key=lambda pair: (-pair[0], pair[1]))
+    return scored[:limit]
+
+@click.command("build-similar")
+@with_appcontext
+def build_similar_command():
+    """
+    Computes the MinHash signatures of every recipe and writes them to the
+    instance folder.
+    """
+
+    index = current_app.extensions["similar_index"]
+    index.build()
+    index.save()
+    click.echo("Indexed {} recipes".format(len(index)))
@@ -0,0 +1,161 @@
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+from bigrecipe import db
+
+"""
+SQLite connection profiles. The default profile leaves SQLite's settings as
+they are. The production profile is meant for serving with several threads
+or worker processes: in WAL mode readers don't wait for a writer to commit,
+the busy timeout makes writers queue up instead of failing with "database is
+locked", and the page cache and memory map keep hot pages out of read calls.
+The pragmas are set on every new connection, the pool keeps enough of them
+open for each serving thread to have one.
+"""
+
+PROFILES = {
+    "default": {},
+    "production": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "foreign_keys": "ON",
+        "busy_timeout": 5000,
+        #Negative sizes are in KiB, 64 MiB of page cache per connection
+        "cache_size": -64000,
+        "mmap_size": 256 * 1024 * 1024,
+    },
+}
+
+
+def _is_file_uri(uri):
+    return uri.startswith("sqlite:///") and ":memory:" not in uri
+
+def profile_pragmas(app):
+    """
+    Returns the pragmas of the app's SQLite profile, with any overrides from
+    the SQLITE_PRAGMAS setting applied.
+    """
+
+    pragmas = dict(PROFILES[app.config["SQLITE_PROFILE"]])
+    pragmas.update(app.config["SQLITE_PRAGMAS"])
+    return pragmas
+
+def set_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute("PRAGMA {}={}".format(name, value))
+    cursor.close()
+
+def configure_engine(app):
+    """
+    Adds the pool settings of the production profile to the engine options.
+    Must run before the database extension is set up.
+    """
+
+    if app.config["SQLITE_PROFILE"] not in PROFILES:
+        raise ValueError("Unknown SQLite profile {}".format(app.config["SQLITE_PROFILE"]))
+    if app.config["SQLITE_PROFILE"] != "production" or not _is_file_uri(app.config["SQLALCHEMY_DATABASE_URI"]):
+        return
+    options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+    options.setdefault("pool_size", app.config["SQLITE_POOL_SIZE"])
+    options.setdefault("max_overflow", 0)
+    # Connections are cheap to keep, a thread waiting for one is not
+    options.setdefault("pool_timeout", 10)
+
+def init_app(app):
+    pragmas = profile_pragmas(app)
+    if not pragmas or not app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        return
+    with app.app_context():
+        event.listen(db.engine, "connect", lambda connection, record: set_pragmas(connection, pragmas))
+
+def _copy_database(source, path, journal_mode):
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(path)
+    try:
+        src.backup(dst)
+        # WAL mode sticks to the file, so the copy is put in the mode the
+        # profile expects
+        dst.execute("PRAGMA journal_mode={}".format(journal_mode))
+    finally:
+        dst.close()
+        src.close()
+
+def _bench(path, pragmas, seconds, readers):
+    engine = create_engine("sqlite:///" + path, pool_size=readers + 1, max_overflow=0)
+    if pragmas:
+        event.listen(engine, "connect", lambda connection, record: set_pragmas(connection, pragmas))
+    with engine.connect() as connection:
+        ids = [pk for (pk,) in connection.execute(text("SELECT id FROM recipe"))]
+        names = [name for (name,) in connection.execute(text("SELECT name FROM recipe"))]
+    if not ids:
+        raise click.ClickException("The database has no recipes to read")
+
+    counts = {"reads": 0, "writes": 0, "errors": 0}
+    lock = threading.Lock()
+    stop = time.monotonic() + seconds
+
+    def count(key):
+        with lock:
+            counts[key] += 1
+
+    def read():
+        while time.monotonic() < stop:
+            try:
+                with engine.connect() as connection:
+                    connection.execute(
+                        text("SELECT id, name, description, calories FROM recipe "
+                             "WHERE name >= :name ORDER BY name LIMIT 50"),
+                        {"name": random.choice(names)}
+                    ).fetchall()
+                count("reads")
+            except OperationalError:
+                count("errors")
+
+    def write():
+        while time.monotonic() < stop:
+            try:
+                with engine.begin() as connection:
+                    connection.execute(
+                        text("UPDATE recipe SET version = version + 1 WHERE id = :id"),
+                        {"id": random.choice(ids)}
+                    )
+                count("writes")
+            except OperationalError:
+                count("errors")
+
+    threads = [threading.Thread(target=read) for i in range(readers)]
+    threads.append(threading.Thread(target=write))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+    return counts
+
+@click.command("bench-sqlite")
+@click.option("--seconds", default=5.0, help="How long each profile is run")
+@click.option("--readers", default=4, help="Number of reader threads")
+@with_appcontext
+def bench_sqlite_command(seconds, readers):
+    """
+    Measures read throughput while a writer thread keeps committing, on a
+    copy of the database, with the default and the production profile.
+    """
+
+    source = db.engine.url.database
+    for profile, journal_mode in (("default", "DELETE"), ("production", "WAL")):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "bench.db")
+            _copy_database(source, path, journal_mode)
+            counts = _bench(path, PROFILES[profile], seconds, readers)
+        click.echo("{}: {:.0f} reads/s, {:.0f} writes/s, {} errors".format(
+            profile, counts["reads"] / seconds, counts["writes"] / seconds, counts["errors"]
+        ))
@@ -40,7 +40,7 @@ function followLink(event, a, renderer) {
 
 function recipeRow(item) {
     let link = "<a href='" +
-        item["@controls"].self.href +
+        item["@controls"].self.href + "?embed=ingredients,drink" +
         "' onClick='followLink(event, this, renderRecipe)'>show</a>";
 
     return "<tr><td>" + item.name +
@@ -193,7 +193,12 @@ function renderRecipeForm(ctrl) {
     form.append("<h1>" + name + "</h1>");
     form.append("<label>" + description + "</label>" + "<br>");
     form.append(text);
-    if (drink) {
+    if (ctrl.drink) {
+        form.append("<br><br><a href='" +
+            ctrl.drink["@controls"].self.href +
+            "' onClick='followLink(event, this, renderDrink)'>Drink Recommendation: " +
+            ctrl.drink.name + "</a>");
+    } else if (drink) {
         form.append("<br><br><a href='" +
             drink.href +
             "' onClick='followLink(event, this, renderDrink)'>Drink Recommendation</a>");
@@ -418,7 +423,11 @@ function renderRecipe(body) {
     $(".resulttable tbody").empty();
     $("div.notification").empty();
     renderRecipeForm(body);
-    getResource(body["@controls"]["bigrec:ingredients"].href, renderRecIngPairings);
+    if (body.ingredients) {
+        renderEmbeddedIngredients(body.ingredients);
+    } else {
+        getResource(body["@controls"]["bigrec:ingredients"].href, renderRecIngPairings);
+    }
     $("input[name='name']").val(body.name);
     $("input[name='text']").val(body.text);
 }
@@ -566,8 +575,8 @@ function searchRecipe(event) {
     event.preventDefault();
 
     let form = $("div.form form"); //DIV1 IN CSS, DON'T KNOW IF WRAPPING WORKS
-    //renderMsg($("input[name='ingredient']").val());
-    getResource(form.attr("url") + $("input[name='recipe']").val(), renderRecipe);
+    let query = encodeURIComponent($("input[name='recipe']").val());
+    getResource(form.attr("url").replace("{query}", query), renderSearchResults);
 }
 function searchIngredient(event) {
     event.preventDefault();
@@ -590,7 +599,7 @@ function renderRecSearchForm(ctrl) {
     form.attr("url", ctrl.href);
     form.submit(searchRecipe);
     form.append("<h1>Search</h1>");
-    form.append("<label>Search by name</label>");
+    form.append("<label>Search recipes</label>");
     form.append("<input type='text' name='recipe'>");
     form.append("<input type='submit' name='submit' value='Search'>");
     $("div.form").html(form);
@@ -618,7 +627,7 @@ function renderDrSearchForm(ctrl) {
     $("div.form").html(form);
 }
 
-function renderRecipes(body) {
+function renderPageControls(body, renderer) {
     let tablectrl = $("div.tablecontrols");
     tablectrl.empty();
     let prev = body["@controls"].prev;
@@ -626,7 +635,7 @@ function renderRecipes(body) {
     if (prev) {
         tablectrl.append(
             "<a href='" + prev.href +
-            "' onClick='followLink(event, this, renderRecipes)'>prev</a>"
+            "' onClick='followLink(event, this, " + renderer.name + ")'>prev</a>"
         );
     }
     if (prev && next) {
@@ -635,9 +644,13 @@ function renderRecipes(body) {
     if (next) {
         tablectrl.append(
             "<a href='" + next.href +
-            "' onClick='followLink(event, this, renderRecipes)'>next</a>"
+            "' onClick='followLink(event, this, " + renderer.name + ")'>next</a>"
         );
     }
+}
+
+function renderRecipes(body) {
+    renderPageControls(body, renderRecipes);
     $("div.navigation").empty();
     $("div.navigation").html(
         "<a href='" +
@@ -652,12 +665,41 @@ function renderRecipes(body) {
     body.items.forEach(function (item) {
         tbody.append(recipeRow(item));
     });
-    renderRecSearchForm(body["@controls"]["self"]);
+    renderRecSearchForm(body["@controls"]["bigrec:search"]);
 }
 
-function renderIngredients(body) {
+function renderSearchResults(body) {
     let tablectrl = $("div.tablecontrols");
     tablectrl.empty();
+    let next = body["@controls"].next;
+    if (next) {
+        tablectrl.append(
+            "<a href='" + next.href +
+            "' onClick='followLink(event, this, renderSearchResults)'>next</a>"
+        );
+    }
+    $("div.navigation").html(
+        "<a href='" +
+        body["@controls"].collection.href +
+        "' onClick='followLink(event, this, renderRecipes)'>back</a>"
+    );
+    $(".resulttable thead").html(
+        "<h1>Search results</h1><tr><th>Name</th><th>Match</th><th>Link</th></tr>"
+    );
+    let tbody = $(".resulttable tbody");
+    tbody.empty();
+    body.items.forEach(function (item) {
+        tbody.append(recipeRow({
+            "name": item.name,
+            "description": item.snippet,
+            "@controls": item["@controls"]
+        }));
+    });
+    renderRecSearchForm(body["@controls"]["bigrec:search"]);
+}
+
+function renderIngredients(body) {
+    renderPageControls(body, renderIngredients);
     $("div.navigation").empty();
     $("div.navigation").html(
         "<a href='" +
@@ -676,8 +718,7 @@ function renderIngredients(body) {
 }
 
 function renderDrinks(body) {
-    let tablectrl = $("div.tablecontrols");
-    tablectrl.empty();
+    renderPageControls(body, renderDrinks);
     $("div.navigation").empty();
     $("div.navigation").html(
         "<a href='" +
@@ -708,6 +749,18 @@ function renderRecIngPairings(body) {
     }
 }
 
+function renderEmbeddedIngredients(items) {
+    $("div.tablecontrols").empty();
+    $(".resulttable thead").html(
+        "<h1>Ingredients</h1><tr><th>Name</th><th>Amount</th><th>Units</th></tr>"
+    );
+    let tbody = $(".resulttable tbody");
+    tbody.empty();
+    items.forEach(function (item) {
+        tbody.append(pairingRow(item.name, item.amount, item.unit));
+    });
+}
+
 $(document).ready(function () {
     $("div.choice").html(
         "<a href='" +
@@ -0,0 +1,442 @@
+import json
+import time
+from functools import lru_cache
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam
+from sqlalchemy.exc import IntegrityError
+from bigrecipe import db
+from bigrecipe.autocomplete import KINDS, get_prefix_index
+from bigrecipe.models import Drink, Ingredient, Recipe, Recingpairings, Revision
+from bigrecipe.response_cache import get_response_cache
+from bigrecipe.similar import get_similar_index
+from bigrecipe.utils import query_in_chunks
+from bigrecipe.constants import *
+
+"""
+Export and import of the whole catalog as NDJSON, one row per line with its
+kind in "type". Rows refer to each other by name, so a file can be loaded
+into any database. An export lists ingredients, drinks, recipes and pairings
+in that order, reading each table with yield_per. An import reads lines as
+they come and writes them with Core executemany a batch at a time, so memory
+stays flat however long the file is. The whole import is one transaction:
+a line that can't be imported rolls all of it back.
+"""
+
+_EXPORTS = {
+    "ingredient": lambda: db.session.query(
+        Ingredient.name, Ingredient.unit, Ingredient.calories, Ingredient.description
+    ).order_by(Ingredient.id),
+    "drink": lambda: db.session.query(
+        Drink.name, Drink.alcohol, Drink.description
+    ).order_by(Drink.id),
+    "recipe": lambda: db.session.query(
+        Recipe.name, Recipe.description, Recipe.text, Drink.name.label("drink")
+    ).select_from(Recipe).outerjoin(Drink, Drink.id == Recipe.drink_id).order_by(Recipe.id),
+    "pairing": lambda: db.session.query(
+        Recipe.name.label("recipe"), Ingredient.name.label("ingredient"), Recingpairings.amount
+    ).select_from(Recingpairings).join(Recipe, Recipe.id == Recingpairings.recipe_id).join(
+        Ingredient, Ingredient.id == Recingpairings.ingredient_id
+    ).order_by(Recingpairings.recipe_id, Recingpairings.ingredient_id),
+}
+
+
+class CatalogError(ValueError):
+    """
+    A line that can't be imported, either because it is invalid or because
+    it conflicts with an existing row under the fail policy.
+    """
+
+    def __init__(self, line, message, conflict=False):
+        super().__init__("Line {}: {}".format(line, message))
+        self.conflict = conflict
+
+
+def export_catalog(size=STREAM_CHUNK_SIZE):
+    """
+    Yields the catalog as NDJSON text, size lines at a time. Columns that are
+    null are left out of their line.
+    """
+
+    for kind, query in _EXPORTS.items():
+        chunk = []
+        for row in query().yield_per(size):
+            item = {"type": kind}
+            for key, value in row._mapping.items():
+                if value is not None:
+                    item[key] = value
+            chunk.append(json.dumps(item))
+            if len(chunk) >= size:
+                yield "\n".join(chunk) + "\n"
+                chunk = []
+        if chunk:
+            yield "\n".join(chunk) + "\n"
+
+#Python types of the JSON schema types the model schemas use
+_TYPES = {
+    "string": str,
+    "number": (int, float),
+    "boolean": bool,
+}
+
+@lru_cache(maxsize=None)
+def _schemas():
+    """
+    Returns the required properties and the types of all properties of each
+    kind of line, taken from the model schemas. The schemas are flat, so
+    lines are checked against them directly, which is many times faster
+    than running a validator on every line.
+    """
+
+    recipe = Recipe.get_schema()
+    recipe["properties"]["drink"] = {
+        "description": "Name of the drink served with the recipe",
+        "type": "string"
+    }
+    schemas = {
+        "ingredient": Ingredient.get_schema(),
+        "drink": Drink.get_schema(),
+        "recipe": recipe,
+        "pairing": Recingpairings.get_schema(),
+    }
+    return {
+        kind: (
+            schema["required"],
+            {name: _TYPES[prop["type"]] for name, prop in schema["properties"].items()}
+        )
+        for kind, schema in schemas.items()
+    }
+
+def _check(item):
+    """
+    Returns why a line doesn't match the schema of its kind, or None if it
+    does.
+    """
+
+    required, types = _schemas()[item["type"]]
+    for name in required:
+        if name not in item:
+            return "'{}' is a required property".format(name)
+    for name, value in item.items():
+        expected = types.get(name)
+        if expected is None:
+            continue
+        # bool is an int in Python but not a number in JSON
+        if not isinstance(value, expected) or (isinstance(value, bool) and expected is not bool):
+            return "{} is not a valid {}".format(json.dumps(value), name)
+    return None
+
+class CatalogImporter(object):
+    """
+    Imports NDJSON lines into the current session. Lines are buffered and
+    written in batches, every kind in the order the kinds depend on each
+    other, so a line may refer to rows anywhere before it in the same or an
+    earlier batch. Rows whose key already exists, a name or a recipe and
+    ingredient pair, are skipped, overwritten or fail the import, depending
+    on the policy.
+    """
+
+    def __init__(self, policy, batch_size=TRANSFER_BATCH_SIZE):
+        if policy not in CONFLICT_POLICIES:
+            raise ValueError("unknown conflict policy")
+        self.policy = policy
+        self.batch_size = batch_size
+        self.counts = {
+            kind: {"created": 0, "overwritten": 0, "skipped": 0} for kind in _EXPORTS
+        }
+        self._pending = {kind: [] for kind in _EXPORTS}
+        self._size = 0
+        self._lines = 0
+        # Recipes whose pairings changed, and new names, for the derived data
+        self._touched = set()
+        self._names = {kind: [] for kind in KINDS}
+        self._recompute_all = False
+
+    def feed(self, lines):
+        for line in lines:
+            self._lines += 1
+            if isinstance(line, bytes):
+                line = line.decode("utf-8")
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError as e:
+                raise CatalogError(self._lines, "invalid JSON, {}".format(e))
+            if not isinstance(item, dict) or not isinstance(item.get("type"), str) or item["type"] not in self._pending:
+                raise CatalogError(self._lines, "type must be one of {}".format(", ".join(self._pending)))
+            error = _check(item)
+            if error is not None:
+                raise CatalogError(self._lines, error)
+            self._pending[item["type"]].append((self._lines, item))
+            self._size += 1
+            if self._size >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        self._write_named(Ingredient, "ingredient", lambda line, item: {
+            "name": item["name"],
+            "unit": item["unit"],
+            "calories": item.get("calories"),
+            "description": item.get("description"),
+        })
+        self._write_named(Drink, "drink", lambda line, item: {
+            "name": item["name"],
+            "alcohol": item["alcohol"],
+            "description": item.get("description"),
+        })
+        drink_ids = dict(query_in_chunks(
+            db.session.query(Drink.name, Drink.id), Drink.name,
+            {item["drink"] for line, item in self._pending["recipe"] if "drink" in item}
+        ))
+
+        def recipe_values(line, item):
+            if "drink" in item and item["drink"] not in drink_ids:
+                raise CatalogError(line, "unknown drink '{}'".format(item["drink"]))
+            return {
+                "name": item["name"],
+                "description": item.get("description"),
+                "text": item["text"],
+                "drink_id": drink_ids.get(item.get("drink")),
+            }
+
+        overwritten = self._write_named(Recipe, "recipe", recipe_values)
+        if overwritten:
+            # An overwritten recipe gets the pairings of the file, not the
+            # ones it had
+            table = Recingpairings.__table__
+            for i in range(0, len(overwritten), IN_CLAUSE_CHUNK):
+                db.session.execute(table.delete().where(table.c.recipe_id.in_(overwritten[i:i + IN_CLAUSE_CHUNK])))
+            self._touched.update(overwritten)
+        self._write_pairings()
+        self._size = 0
+
+    def finish(self):
+        """
+        Writes what is left, brings the stored calorie totals and collection
+        versions up to date and commits. Returns the counts of created,
+        overwritten and skipped rows of every kind.
+        """
+
+        self.flush()
+        if self._recompute_all:
+            Recipe.recompute_calories()
+        elif self._touched:
+            Recipe.recompute_calories(self._touched)
+        # Core writes don't go through the flush events
+        written = {
+            kind for kind, counts in self.counts.items()
+            if counts["created"] or counts["overwritten"]
+        }
+        written.update(kind + "-names" for kind in KINDS if self.counts[kind]["created"])
+        if self._touched:
+            written.add("pairing")
+        if written:
+            Revision.bump(*written)
+        db.session.commit()
+        if written:
+            self._refresh_derived()
+        return self.counts
+
+    def _resolve(self, line, name, ids, kind):
+        try:
+            return ids[name]
+        except KeyError:
+            raise CatalogError(line, "unknown {} '{}'".format(kind, name))
+
+    def _deduplicate(self, kind, rows, key):
+        # Later lines win under overwrite, earlier ones under skip
+        unique = {}
+        for line, item in rows:
+            if key(item) in unique:
+                if self.policy == "fail":
+                    raise CatalogError(line, "{} appears twice".format(kind), conflict=True)
+                self.counts[kind]["skipped"] += 1
+                if self.policy == "skip":
+                    continue
+            unique[key(item)] = line, item
+        return unique
+
+    def _write_named(self, model, kind, values):
+        """
+        Writes the pending rows of a kind with a unique name. Returns the ids
+        of the rows that were overwritten.
+        """
+
+        rows = self._pending[kind]
+        if not rows:
+            return []
+        self._pending[kind] = []
+        unique = self._deduplicate(kind, rows, lambda item: item["name"])
+        existing = dict(query_in_chunks(db.session.query(model.name, model.id), model.name, list(unique)))
+
+        inserts = []
+        updates = []
+        for name, (line, item) in unique.items():
+            row = values(line, item)
+            if name not in existing:
+                inserts.append(row)
+            elif self.policy == "fail":
+                raise CatalogError(line, "{} '{}' already exists".format(kind, name), conflict=True)
+            elif self.policy == "skip":
+                self.counts[kind]["skipped"] += 1
+            else:
+                row["_id"] = existing[name]
+                updates.append(row)
+
+        table = model.__table__
+        if inserts:
+            db.session.execute(table.insert(), inserts)
+            self.counts[kind]["created"] += len(inserts)
+            self._names[kind].extend(row["name"] for row in inserts)
+        if updates:
+            db.session.execute(
+                table.update().where(table.c.id == bindparam("_id")).values(version=table.c.version + 1),
+                updates
+            )
+            self.counts[kind]["overwritten"] += len(updates)
+            if model is Ingredient:
+                self._recompute_all = True
+        return [row["_id"] for row in updates]
+
+    def _write_pairings(self):
+        rows = self._pending["pairing"]
+        if not rows:
+            return
+        self._pending["pairing"] = []
+        unique = self._deduplicate("pairing", rows, lambda item: (item["recipe"], item["ingredient"]))
+        recipe_ids = dict(query_in_chunks(
+            db.session.query(Recipe.name, Recipe.id), Recipe.name, {recipe for recipe, ingredient in unique}
+        ))
+        ingredient_ids = dict(query_in_chunks(
+            db.session.query(Ingredient.name, Ingredient.id), Ingredient.name,
+            {ingredient for recipe, ingredient in unique}
+        ))
+        existing = set(query_in_chunks(
+            db.session.query(Recingpairings.recipe_id, Recingpairings.ingredient_id),
+            Recingpairings.recipe_id, set(recipe_ids.values())
+        ))
+
+        inserts = []
+        updates = []
+        for (recipe, ingredient), (line, item) in unique.items():
+            row = {
+                "recipe_id": self._resolve(line, recipe, recipe_ids, "recipe"),
+                "ingredient_id": self._resolve(line, ingredient, ingredient_ids, "ingredient"),
+                "amount": item["amount"],
+            }
+            if (row["recipe_id"], row["ingredient_id"]) not in existing:
+                inserts.append(row)
+            elif self.policy == "fail":
+                raise CatalogError(line, "pairing of '{}' and '{}' already exists".format(recipe, ingredient), conflict=True)
+            elif self.policy == "skip":
+                self.counts["pairing"]["skipped"] += 1
+                continue
+            else:
+                updates.append({"_recipe_id": row["recipe_id"], "_ingredient_id": row["ingredient_id"], "amount": row["amount"]})
+            self._touched.add(row["recipe_id"])
+
+        table = Recingpairings.__table__
+        if inserts:
+            db.session.execute(table.insert(), inserts)
+            self.counts["pairing"]["created"] += len(inserts)
+        if updates:
+            db.session.execute(
+                table.update().where(
+                    (table.c.recipe_id == bindparam("_recipe_id")) & (table.c.ingredient_id == bindparam("_ingredient_id"))
+                ),
+                updates
+            )
+            self.counts["pairing"]["overwritten"] += len(updates)
+
+    def _refresh_derived(self):
+        """
+        Brings the in-memory indexes and caches up to date with a committed
+        import. New names and signatures are added one by one when there are
+        few of them, otherwise the index is left to be rebuilt on its next
+        use, as is the recipe index, since overwritten recipes lose pairings.
+        """
+
+        cache = get_response_cache()
+        if cache is not None:
+            cache.clear()
+        for kind, names in self._names.items():
+            if len(names) <= IN_CLAUSE_CHUNK:
+                with get_prefix_index(kind, build=False).updating() as index:
+                    for name in names:
+                        index.add(name)
+
+        similar_index = get_similar_index(build=False)
+        if not self._touched or len(self._touched) > IN_CLAUSE_CHUNK or not similar_index.built:
+            return
+        sets = {recipe_id: [] for recipe_id in self._touched}
+        for recipe_id, ingredient_id in query_in_chunks(
+            db.session.query(Recingpairings.recipe_id, Recingpairings.ingredient_id),
+            Recingpairings.recipe_id, self._touched
+        ):
+            sets[recipe_id].append(ingredient_id)
+        with similar_index.updating() as index:
+            for recipe_id, ingredient_ids in sets.items():
+                index.set_ingredients(recipe_id, ingredient_ids)
+
+def import_catalog(lines, policy):
+    """
+    Imports NDJSON lines with the given conflict policy and commits. Rolls
+    back and raises CatalogError if a line can't be imported.
+    """
+
+    importer = CatalogImporter(policy)
+    try:
+        importer.feed(lines)
+        return importer.finish()
+    except CatalogError:
+        db.session.rollback()
+        raise
+
+def _total(counts):
+    return sum(sum(kind.values()) for kind in counts.values())
+
+@click.command("export")
+@click.argument("output", type=click.File("w", encoding="utf-8", lazy=True), default="-")
+@with_appcontext
+def export_command(output):
+    """
+    Writes the whole catalog as NDJSON to a file, or to stdout.
+    """
+
+    start = time.perf_counter()
+    lines = 0
+    for chunk in export_catalog():
+        output.write(chunk)
+        lines += chunk.count("\n")
+    output.flush()
+    elapsed = time.perf_counter() - start
+    click.echo("Exported {} rows in {:.1f} s ({:.0f} rows/s)".format(
+        lines, elapsed, lines / elapsed if elapsed else 0
+    ), err=True)
+
+@click.command("import")
+@click.argument("source", type=click.File("r", encoding="utf-8"), default="-")
+@click.option("--on-conflict", default="fail", type=click.Choice(CONFLICT_POLICIES),
+              help="What to do with rows whose names already exist")
+@with_appcontext
+def import_command(source, on_conflict):
+    """
+    Loads an NDJSON catalog from a file, or from stdin, in one transaction.
+    """
+
+    start = time.perf_counter()
+    try:
+        counts = import_catalog(source, on_conflict)
+    except CatalogError as e:
+        raise click.ClickException(str(e))
+    except IntegrityError:
+        db.session.rollback()
+        raise click.ClickException("The catalog conflicts with changes made while it was imported.")
+    elapsed = time.perf_counter() - start
+    for kind, kind_counts in counts.items():
+        click.echo("{}: {created} created, {overwritten} overwritten, {skipped} skipped".format(kind, **kind_counts))
+    total = _total(counts)
+    click.echo("Imported {} rows in {:.1f} s ({:.0f} rows/s)".format(
+        total, elapsed, total / elapsed if elapsed else 0
+    ))
@@ -1,6 +1,11 @@
+import base64
 import json
-from flask import Response, request, url_for
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+from flask import Response, current_app, request, url_for
+from sqlalchemy import tuple_
 from bigrecipe.constants import *
+from bigrecipe.metrics import timed_serialization
 from bigrecipe.models import *
 
 class MasonBuilder(dict):
@@ -90,7 +95,26 @@ class BigrecipeBuilder(MasonBuilder):
             method="POST",
             encoding="json",
             title="Add a new Recipe",
-            schema=Recipe.get_schema()
+            schema=model_schema(Recipe)
+        )
+
+    def add_control_import_recipes(self):
+        self.add_control(
+            "bigrec:import-recipes",
+            url_for("api.recipeimport"),
+            method="POST",
+            encoding="json",
+            title="Add many Recipes with their Ingredients at once",
+            schema=self._import_schema()
+        )
+
+    def add_control_search_recipes(self):
+        self.add_control(
+            "bigrec:search",
+            url_for("api.recipesearch") + "?q={query}",
+            isHrefTemplate=True,
+            title="Full-text search over Recipe names, descriptions and texts",
+            schema=self._search_schema()
         )
 
     def add_control_add_pairing(self, recipe):
@@ -100,7 +124,7 @@ class BigrecipeBuilder(MasonBuilder):
             method="POST",
             encoding="json",
             title="Add a new Ingredient to Recipe",
-            schema=Recingpairings.get_schema()
+            schema=model_schema(Recingpairings)
         )
 
     def add_control_add_ingredient(self):
@@ -110,7 +134,7 @@ class BigrecipeBuilder(MasonBuilder):
             method="POST",
             encoding="json",
             title="Add a new Ingredient",
-            schema=Ingredient.get_schema()
+            schema=model_schema(Ingredient)
         )
 
     def add_control_add_drink(self):
@@ -120,7 +144,7 @@ class BigrecipeBuilder(MasonBuilder):
             method="POST",
             encoding="json",
             title="Add a new Drink",
-            schema=Drink.get_schema()
+            schema=model_schema(Drink)
         )
 
     def add_control_get_recipe(self, recipe):
@@ -174,7 +198,7 @@ class BigrecipeBuilder(MasonBuilder):
             method="PUT",
             encoding="json",
             title="Edit this recipe",
-            schema=Recipe.get_schema()
+            schema=model_schema(Recipe)
         )
 
     def add_control_modify_ingredient(self, ingredient):
@@ -184,7 +208,7 @@ class BigrecipeBuilder(MasonBuilder):
             method="PUT",
             encoding="json",
             title="Edit this ingredient",
-            schema=Ingredient.get_schema()
+            schema=model_schema(Ingredient)
         )
 
     def add_control_modify_drink(self, drink):
@@ -194,7 +218,7 @@ class BigrecipeBuilder(MasonBuilder):
             method="PUT",
             encoding="json",
             title="Edit this drink",
-            schema=Drink.get_schema()
+            schema=model_schema(Drink)
         )
 
     def add_control_get_recingpairings(self, recipe):
@@ -205,6 +229,13 @@ class BigrecipeBuilder(MasonBuilder):
             isHrefTemplate=True,
         )
 
+    def add_control_get_similar(self, recipe):
+        self.add_control(
+            "bigrec:similar",
+            url_for("api.similarrecipes", recipe=recipe),
+            title="Recipes with the most similar Ingredients"
+        )
+
     def add_control_get_recipes(self, ingredient):
         base_uri = url_for("api.recipecollection", ingredient=ingredient)
         uri = base_uri + "?start={index}"
@@ -215,7 +246,66 @@ class BigrecipeBuilder(MasonBuilder):
             schema=self._paginator_schema()
         )
 
+    def add_control_match_pantry(self):
+        self.add_control(
+            "bigrec:pantry",
+            url_for("api.pantrymatch"),
+            method="POST",
+            encoding="json",
+            title="Find Recipes that can be cooked with these Ingredients",
+            schema=self._pantry_schema()
+        )
+
+    def add_control_nutrition(self):
+        self.add_control(
+            "bigrec:nutrition",
+            url_for("api.nutritionreport"),
+            method="POST",
+            encoding="json",
+            title="Calculate Calories for a batch of Recipes",
+            schema=self._nutrition_schema()
+        )
+
+    def add_control_shopping_list(self):
+        self.add_control(
+            "bigrec:shopping-list",
+            url_for("api.shoppinglist"),
+            method="POST",
+            encoding="json",
+            title="Sum up the Ingredients needed for a batch of Recipes",
+            schema=self._shopping_list_schema()
+        )
+
+    def add_control_batch(self):
+        self.add_control(
+            "bigrec:batch",
+            url_for("api.batch"),
+            method="POST",
+            encoding="json",
+            title="Get many Resources in one Request",
+            schema=self._batch_schema()
+        )
+
+    def add_control_import_catalog(self):
+        self.add_control(
+            "bigrec:import-catalog",
+            url_for("api.catalog") + "?on_conflict={policy}",
+            isHrefTemplate=True,
+            method="POST",
+            encoding="raw",
+            title="Load an NDJSON catalog, policy is one of " + ", ".join(CONFLICT_POLICIES)
+        )
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _import_schema():
+        return freeze({
+            "type": "array",
+            "items": Recipe.get_import_schema()
+        })
+
     @staticmethod
+    @lru_cache(maxsize=None)
     def _paginator_schema():
         schema = {
             "type": "object",
@@ -228,11 +318,417 @@ class BigrecipeBuilder(MasonBuilder):
             "type": "integer",
             "default": "0"
         }
-        return schema
+        return freeze(schema)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _search_schema():
+        schema = {
+            "type": "object",
+            "properties": {},
+            "required": ["query"]
+        }
+        props = schema["properties"]
+        props["query"] = {
+            "description": "Words that must all appear in the recipe",
+            "type": "string"
+        }
+        return freeze(schema)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _pantry_schema():
+        schema = {
+            "type": "object",
+            "required": ["ingredients"]
+        }
+        props = schema["properties"] = {}
+        props["ingredients"] = {
+            "description": "Ingredients in the pantry, with the amount available if it is limited",
+            "type": "array",
+            "items": {
+                "type": "object",
+                "required": ["ingredient"],
+                "properties": {
+                    "ingredient": {
+                        "description": "Ingredient's unique name",
+                        "type": "string"
+                    },
+                    "amount": {
+                        "description": "Available amount of ingredient",
+                        "type": "number"
+                    }
+                }
+            }
+        }
+        props["max_missing"] = {
+            "description": "Also list recipes lacking at most this many ingredients",
+            "type": "integer",
+            "minimum": 0,
+            "default": PANTRY_MAX_MISSING
+        }
+        return freeze(schema)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _nutrition_schema():
+        schema = {
+            "type": "object",
+            "required": ["recipes"]
+        }
+        props = schema["properties"] = {}
+        props["recipes"] = {
+            "description": "Recipes to calculate, each with an optional serving multiplier",
+            "type": "array",
+            "maxItems": NUTRITION_BATCH_SIZE,
+            "items": {
+                "type": "object",
+                "required": ["recipe"],
+                "properties": {
+                    "recipe": {
+                        "description": "Recipe's unique name",
+                        "type": "string"
+                    },
+                    "scale": {
+                        "description": "Serving multiplier for the recipe",
+                        "type": "number",
+                        "minimum": 0,
+                        "default": 1
+                    }
+                }
+            }
+        }
+        return freeze(schema)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _shopping_list_schema():
+        # Same request body as the nutrition batch
+        return BigrecipeBuilder._nutrition_schema()
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _batch_schema():
+        schema = {
+            "type": "object",
+            "required": ["requests"]
+        }
+        props = schema["properties"] = {}
+        props["requests"] = {
+            "description": "API paths to GET, with their query strings",
+            "type": "array",
+            "maxItems": BATCH_SIZE,
+            "items": {
+                "type": "string"
+            }
+        }
+        return freeze(schema)
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError("{} is read-only".format(type(self).__name__))
+
+class FrozenDict(dict):
+    """
+    A dict that refuses to be changed, for values that are built once and
+    then shared by every response. It is still a dict, so json encodes it
+    and jsonschema accepts it without any help.
+    """
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+class FrozenList(list):
+    """
+    The list counterpart of FrozenDict.
+    """
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+def freeze(value):
+    """
+    Returns a read-only copy of a JSON-like value.
+    """
+
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(item) for item in value)
+    return value
+
+@lru_cache(maxsize=None)
+def model_schema(model):
+    """
+    Returns the JSON schema of a model class, built on first use and then
+    shared by every control that carries it, frozen so that no caller can
+    change it for the others.
+    """
+
+    return freeze(model.get_schema())
+
+
+class RouteTemplate(object):
+    """
+    The URL of an endpoint with a single name argument, split around the
+    argument once so that building a link takes a quote and two
+    concatenations instead of a url_for call. Names are quoted with the URL
+    map's default converter, like url_for does.
+    """
+
+    _PLACEHOLDER = "bigrecipe-route-argument"
+
+    def __init__(self, endpoint, arg):
+        href = url_for(endpoint, **{arg: self._PLACEHOLDER})
+        self.prefix, self.suffix = href.split(self._PLACEHOLDER)
+        self._to_url = current_app.url_map.converters["default"](current_app.url_map).to_url
+
+    def __call__(self, value):
+        return self.prefix + self._to_url(value) + self.suffix
+
+
+class ItemTemplate(object):
+    """
+    Serializes the items of one kind of collection straight to JSON text.
+    The controls that every item shares are encoded once, for every item only
+    its fields and self link are.
+    """
+
+    def __init__(self, endpoint, arg, profile):
+        self.href = RouteTemplate(endpoint, arg)
+        self._tail = '}, "profile": ' + json.dumps({"href": profile}) + "}}"
+        self._keys = {}
+
+    @timed_serialization
+    def render(self, name, fields):
+        """
+        Renders one item with the given name. fields is a sequence of (key,
+        value) pairs that follow the name in the given order.
+        """
+
+        parts = ['{"name": ', _encode(name)]
+        for key, value in fields:
+            try:
+                parts.append(self._keys[key])
+            except KeyError:
+                parts.append(self._keys.setdefault(key, ", " + json.dumps(key) + ": "))
+            parts.append(_encode(value))
+        parts.append(', "@controls": {"self": {"href": ')
+        parts.append(_encode(self.href(name)))
+        parts.append(self._tail)
+        return "".join(parts)
+
+
+def _encode(value):
+    if isinstance(value, str):
+        return encode_basestring_ascii(value)
+    return json.dumps(value)
+
+ITEM_ROUTES = {
+    "recipe": ("api.recipeitem", "recipe", RECIPE_PROFILE),
+    "ingredient": ("api.ingredientitem", "ingredient", INGREDIENT_PROFILE),
+    "drink": ("api.drinkitem", "drink", DRINK_PROFILE),
+}
+
+def item_template(kind):
+    """
+    Returns the item template of one kind of collection for the current
+    app, compiling it on first use.
+    """
+
+    templates = current_app.extensions.setdefault("item_templates", {})
+    if kind not in templates:
+        templates[kind] = ItemTemplate(*ITEM_ROUTES[kind])
+    return templates[kind]
+
+@timed_serialization
+def dumps(body):
+    """
+    Encodes a response body, counted as serialization time in the request
+    metrics.
+    """
+
+    return json.dumps(body)
+
+@timed_serialization
+def dumps_collection(body, items):
+    """
+    Serializes a collection body around items that are already JSON text.
+    The items come first, where BigrecipeBuilder(items=[]) puts them.
+    """
+
+    rest = json.dumps(body)
+    head = '{"items": [' + ", ".join(items) + "]"
+    return head + "}" if rest == "{}" else head + ", " + rest[1:]
+
+def stream_collection(body, items, size=STREAM_CHUNK_SIZE):
+    """
+    Like dumps_collection, but yields the JSON text in chunks of size items
+    so that a collection of any length can be sent with constant memory.
+    """
+
+    rest = json.dumps(body)
+    yield '{"items": ['
+    separator = ""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield separator + ", ".join(chunk)
+            separator = ", "
+            chunk = []
+    if chunk:
+        yield separator + ", ".join(chunk)
+    yield "]}" if rest == "{}" else "], " + rest[1:]
+
+def encode_cursor(value):
+    """
+    Turns a sort key value into an opaque, URL safe pagination cursor.
+
+    : param str value: value of the sort column for the row the cursor points to
+    """
+
+    return base64.urlsafe_b64encode(value.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
+    """
+    Reverses encode_cursor. Raises ValueError if the cursor is malformed.
+
+    : param str cursor: cursor from an ?after= or ?before= query parameter
+    """
+
+    padded = cursor + "=" * (-len(cursor) % 4)
+    return base64.b64decode(padded.encode("ascii"), altchars=b"-_", validate=True).decode("utf-8")
+
+def parse_page_limit(default, maximum=MAX_PAGE_SIZE):
+    """
+    Reads the ?limit= query parameter of a paginated request. Raises
+    ValueError if the value is not a positive integer, and clamps it to the
+    server side maximum.
+    """
+
+    limit = int(request.args.get("limit", default))
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    return min(limit, maximum)
+
+def keyset_page(query, column, limit, after=None, before=None):
+    """
+    Fetches one page of rows by seeking on a unique, indexed column instead of
+    using OFFSET. One extra row is fetched to find out whether another page
+    exists in the paging direction, so no COUNT queries are needed.
+
+    Returns a tuple of (rows, has_prev, has_next), rows in ascending order.
+
+    : param query: query that selects the rows to page through
+    : param column: unique column the pages are ordered by, or a tuple of
+        columns that are unique together
+    : param int limit: page size
+    : param after: return rows that sort after this value (a tuple for
+        multiple columns)
+    : param before: return rows that sort before this value
+    """
+
+    columns = column if isinstance(column, tuple) else (column,)
+    key = tuple_(*columns) if len(columns) > 1 else columns[0]
+
+    if before is not None:
+        rows = query.filter(key < before).order_by(*[c.desc() for c in columns]).limit(limit + 1).all()
+        has_prev = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        return rows, has_prev, True
+
+    if after is not None:
+        query = query.filter(key > after)
+    rows = query.order_by(*columns).limit(limit + 1).all()
+    return rows[:limit], after is not None, len(rows) > limit
+
+def parse_flag(name):
+    """
+    Reads a boolean query parameter. Raises ValueError for anything other
+    than true/false or 1/0.
+    """
+
+    value = request.args.get(name, "false").lower()
+    if value not in ("true", "false", "1", "0"):
+        raise ValueError("{} must be true or false".format(name))
+    return value in ("true", "1")
+
+def parse_fields(available, default=None):
+    """
+    Reads the ?fields= query parameter, a comma separated list of the item
+    fields the client wants. Returns the chosen fields in the order of
+    available, always including name, or default (all available fields)
+    when the parameter is missing. Raises ValueError for unknown fields.
+    """
+
+    value = request.args.get("fields")
+    if value is None:
+        return tuple(default or available)
+    wanted = set(field.strip() for field in value.split(",") if field.strip())
+    if not wanted <= set(available):
+        raise ValueError("unknown field")
+    wanted.add("name")
+    return tuple(field for field in available if field in wanted)
+
+def parse_embed(available):
+    """
+    Reads the ?embed= query parameter, a comma separated list of related
+    resources to nest in each item. Returns them as a set, empty when the
+    parameter is missing. Raises ValueError for unknown names.
+    """
+
+    embed = set(name.strip() for name in request.args.get("embed", "").split(",") if name.strip())
+    if not embed <= set(available):
+        raise ValueError("unknown embed")
+    return embed
+
+def embedded_item(kind, name, fields):
+    """
+    Builds a related item to nest inside another one, with the self and
+    profile controls it has in its own collection.
+
+    : param str kind: recipe, ingredient or drink
+    : param fields: (key, value) pairs that follow the name
+    """
+
+    item = BigrecipeBuilder(name=name)
+    item.update(fields)
+    item.add_control("self", item_template(kind).href(name))
+    item.add_control("profile", ITEM_ROUTES[kind][2])
+    return item
+
+def embedded_recipes(query):
+    """
+    Nests the recipes selected by query, at most EMBED_SIZE of them in name
+    order, with the fields they have in the recipe collection.
+    """
+
+    rows = query.with_entities(
+        Recipe.name, Recipe.description, Recipe.calories
+    ).order_by(Recipe.name).limit(EMBED_SIZE)
+    return [
+        embedded_item(
+            "recipe", name,
+            ([("description", description)] if description else []) + [("calories", calories)]
+        )
+        for name, description, calories in rows
+    ]
+
+def query_in_chunks(query, column, values, size=IN_CLAUSE_CHUNK):
+    """
+    Runs query filtered with column IN values, splitting long value lists so
+    that each statement stays under SQLite's bound parameter limit. Yields
+    the result rows of every chunk.
+    """
+
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield from query.filter(column.in_(values[i:i + size]))
 
 def create_error_response(status_code, title, message=None):
     resource_url = request.path
     body = MasonBuilder(resource_url=resource_url)
     body.add_error(title, message)
     body.add_control("profile", href=ERROR_PROFILE)
-    return Response(json.dumps(body), status_code, mimetype=MASON)
+    return Response(dumps(body), status_code, mimetype=MASON)
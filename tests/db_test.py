@@ -1,13 +1,16 @@
+import glob
+import json
 import os
 import pytest
 import tempfile
 import time
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
-from sqlalchemy.exc import IntegrityError, StatementError, SQLAlchemyError
+from sqlalchemy import event, text
+from sqlalchemy.exc import IntegrityError, InvalidRequestError, StatementError, SQLAlchemyError
+from sqlalchemy.orm import selectinload
 
 from bigrecipe import create_app, db
-from bigrecipe.models import Recipe, Ingredient, Drink, Recingpairings
+from bigrecipe.models import Recipe, Ingredient, Drink, Recingpairings, Revision
 
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
@@ -115,6 +118,80 @@ def test_create_instances(app):
     
       
 
+def test_pairing_collections_not_lazy(app):
+    """
+    Tests that the pairing collections of recipes and ingredients can't be
+    lazy loaded by accident, and that they load fine when asked for explicitly.
+    """
+    
+    with app.app_context():
+        db.session.add(_get_recingpairing())
+        db.session.commit()
+        db.session.expunge_all()
+
+        db_recipe = Recipe.query.first()
+        with pytest.raises(InvalidRequestError):
+            db_recipe.ingredients
+        db_ingredient = Ingredient.query.first()
+        with pytest.raises(InvalidRequestError):
+            db_ingredient.recipes
+
+        db.session.expunge_all()
+        db_recipe = Recipe.query.options(selectinload(Recipe.ingredients)).first()
+        assert db_recipe.ingredients[0].amount == 4
+
+def test_versions(app):
+    """
+    Tests that row versions go up when a row or its pairings change, and that
+    every write bumps the version of the collections it touched.
+    """
+    
+    def revisions():
+        return dict(db.session.query(Revision.name, Revision.version))
+
+    with app.app_context():
+        assert set(revisions().values()) == {1}
+        recipe = _get_recipe()
+        db.session.add(recipe)
+        db.session.commit()
+        first = recipe.version
+        assert revisions()["recipe"] == 2
+
+        recipe.text = "Eat it raw."
+        db.session.commit()
+        assert recipe.version == first + 1
+        db.session.add(Recingpairings(recipe=recipe, ingredient=_get_ingredient(), amount=1))
+        db.session.commit()
+        assert recipe.version == first + 2
+        assert revisions() == {
+            "recipe": 3, "ingredient": 2, "drink": 1, "pairing": 2, "calories": 1,
+            "recipe-names": 2, "ingredient-names": 2, "drink-names": 1,
+        }
+        Recipe.add_calories(recipe.id, 2)
+        db.session.commit()
+        assert recipe.version == first + 3
+        # calorie totals have their own revision, so indexes over names and
+        # pairings don't go stale when they change
+        assert revisions()["recipe"] == 3
+        assert revisions()["calories"] == 2
+        # only creates, deletes and renames move the name revisions
+        recipe.name = "Renamed Stew"
+        db.session.commit()
+        assert revisions()["recipe-names"] == 3
+
+        # a row made again under the same name doesn't start where the old
+        # one did
+        drink = Drink(name="again", alcohol=False)
+        db.session.add(drink)
+        db.session.commit()
+        old = drink.version
+        db.session.delete(drink)
+        db.session.commit()
+        drink = Drink(name="again", alcohol=False)
+        db.session.add(drink)
+        db.session.commit()
+        assert drink.version != old
+
 def test_recipe_ondelete_drink(app):
     """
     Tests that recipe's drink foreign key is set to null when the drink
@@ -412,4 +489,209 @@ def test_deployment_columns(app):
             db.session.commit()
     
         db.session.rollback()
-"""
\ No newline at end of file
+"""
+def test_rebuild_search(app):
+    """
+    Tests that the rebuild-search command refills the recipe full-text index
+    from the recipe table.
+    """
+    
+    with app.app_context():
+        db.session.add(_get_recipe())
+        db.session.commit()
+        db.session.execute(text("INSERT INTO recipe_fts(recipe_fts) VALUES ('delete-all')"))
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["rebuild-search"])
+    assert result.exit_code == 0
+
+    with app.app_context():
+        found = db.session.execute(text("SELECT rowid FROM recipe_fts WHERE recipe_fts MATCH 'stew'")).all()
+        assert len(found) == 1
+
+def test_sqlite_profile():
+    """
+    Tests that the production SQLite profile sets its pragmas on every
+    connection and sizes the pool, and that the benchmark runs with it.
+    """
+
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SQLITE_PROFILE": "production",
+        "SQLITE_PRAGMAS": {"cache_size": -1000},
+        "SQLITE_POOL_SIZE": 3,
+        "TESTING": True
+    })
+    try:
+        with app.app_context():
+            db.create_all()
+            db.session.add(_get_recipe())
+            db.session.commit()
+            assert db.session.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+            assert db.session.execute(text("PRAGMA synchronous")).scalar() == 1
+            assert db.session.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+            assert db.session.execute(text("PRAGMA cache_size")).scalar() == -1000
+            assert db.engine.pool.size() == 3
+
+        result = app.test_cli_runner().invoke(args=["bench-sqlite", "--seconds", "0.2", "--readers", "2"])
+        assert result.exit_code == 0
+        assert result.output.startswith("default: ")
+        assert "production: " in result.output
+        with app.app_context():
+            db.engine.dispose()
+    finally:
+        os.close(db_fd)
+        for path in glob.glob(db_fname + "*"):
+            os.unlink(path)
+    with pytest.raises(ValueError):
+        create_app({"SQLITE_PROFILE": "fast", "TESTING": True})
+
+def test_gen_data(app):
+    """
+    Tests that gen-data fills the database deterministically, with stored
+    calorie totals that match the pairings, and refuses a non-empty one.
+    """
+
+    args = ["gen-data", "--recipes", "50", "--ingredients", "30", "--pairings-per-recipe", "2-4", "--batch-size", "20"]
+    result = app.test_cli_runner().invoke(args=args)
+    assert result.exit_code == 0
+    assert "Inserted 50 recipes" in result.output
+
+    with app.app_context():
+        rows = db.session.execute(text("SELECT id, name, text, calories, drink_id FROM recipe ORDER BY id")).all()
+        pairings = db.session.execute(text(
+            "SELECT recipe_id, COUNT(*) FROM recingpairings GROUP BY recipe_id"
+        )).all()
+        assert len(rows) == 50
+        assert all(2 <= count <= 4 for recipe_id, count in pairings) and len(pairings) == 50
+        assert Ingredient.query.count() == 30
+        assert Drink.query.count() == 1
+        stored = [row.calories for row in rows]
+        Recipe.recompute_calories()
+        db.session.commit()
+        assert [calories for (calories,) in db.session.execute(text("SELECT calories FROM recipe ORDER BY id"))] == stored
+
+        # same seed, same data
+        for table in ("recingpairings", "recipe", "ingredient", "drink"):
+            db.session.execute(text("DELETE FROM {}".format(table)))
+        db.session.commit()
+    result = app.test_cli_runner().invoke(args=args)
+    assert result.exit_code == 0
+    with app.app_context():
+        again = db.session.execute(text("SELECT id, name, text, calories, drink_id FROM recipe ORDER BY id")).all()
+        assert again == rows
+
+    result = app.test_cli_runner().invoke(args=args)
+    assert result.exit_code != 0
+    result = app.test_cli_runner().invoke(args=["gen-data", "--pairings-per-recipe", "5-2"])
+    assert result.exit_code != 0
+
+def test_benchmark(app, tmp_path):
+    """
+    Tests that the benchmark runs every scenario on a seeded copy, writes
+    its results and reports regressions against a baseline.
+    """
+
+    app.instance_path = str(tmp_path)
+    output = str(tmp_path / "results.json")
+    args = ["benchmark", "--scales", "100", "--iterations", "2", "--warmup", "0", "--output", output]
+    result = app.test_cli_runner().invoke(args=args)
+    assert result.exit_code == 0
+    assert os.path.exists(str(tmp_path / "bench-100-42.db"))
+    with open(output) as f:
+        results = json.load(f)
+    scenarios = results["scales"]["100"]
+    assert "recipe_item_get" in scenarios and "batch" in scenarios
+    assert all(summary["p50_ms"] <= summary["max_ms"] for summary in scenarios.values())
+    assert scenarios["recipe_item_get"]["queries"] >= 1
+
+    # the benchmark runs on its own databases, not the app's
+    with app.app_context():
+        assert Recipe.query.count() == 0
+    baseline = str(tmp_path / "baseline.json")
+    results["scales"]["100"]["recipe_item_get"]["queries"] = 0
+    with open(baseline, "w") as f:
+        json.dump(results, f)
+    result = app.test_cli_runner().invoke(args=args + ["--baseline", baseline, "--threshold", "100"])
+    assert result.exit_code == 1
+    assert "Seeding" not in result.output
+    assert "REGRESSION 100 recipe_item_get: queries" in result.output
+
+    result = app.test_cli_runner().invoke(args=["benchmark", "--scales", "many"])
+    assert result.exit_code != 0
+
+def test_export_import(app, tmp_path):
+    """
+    Tests that a catalog exported with the CLI imports into an empty
+    database as the same catalog, and that the conflict policy applies.
+    """
+
+    result = app.test_cli_runner().invoke(args=["gen-data", "--recipes", "30", "--ingredients", "20"])
+    assert result.exit_code == 0
+    path = str(tmp_path / "catalog.ndjson")
+    result = app.test_cli_runner().invoke(args=["export", path])
+    assert result.exit_code == 0
+    with open(path) as f:
+        exported = f.read()
+    assert len(exported.splitlines()) > 50
+
+    db_fd, db_fname = tempfile.mkstemp()
+    other = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname, "TESTING": True})
+    try:
+        with other.app_context():
+            db.create_all()
+        result = other.test_cli_runner().invoke(args=["import", path])
+        assert result.exit_code == 0
+        assert "recipe: 30 created" in result.output
+        result = other.test_cli_runner().invoke(args=["export"])
+        assert result.exit_code == 0
+        assert result.stdout == exported
+        with app.app_context():
+            calories = db.session.execute(text("SELECT name, calories FROM recipe ORDER BY name")).all()
+        with other.app_context():
+            assert db.session.execute(text("SELECT name, calories FROM recipe ORDER BY name")).all() == calories
+
+        result = other.test_cli_runner().invoke(args=["import", path])
+        assert result.exit_code != 0
+        assert "already exists" in result.output
+        result = other.test_cli_runner().invoke(args=["import", path, "--on-conflict", "skip"])
+        assert result.exit_code == 0
+        assert "recipe: 0 created, 0 overwritten, 30 skipped" in result.output
+        with other.app_context():
+            db.engine.dispose()
+    finally:
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+def test_import_race(app, tmp_path):
+    """
+    Tests that an import that loses a name to a concurrent write rolls back
+    and fails with a message instead of a traceback.
+    """
+
+    path = str(tmp_path / "catalog.ndjson")
+    with open(path, "w") as f:
+        f.write('{"type": "ingredient", "name": "late", "unit": "g"}\n')
+
+    def insert_first(conn, cursor, statement, parameters, context, executemany):
+        # Another writer commits the same name right before the import does
+        if statement.startswith("INSERT INTO ingredient") and not inserted:
+            inserted.append(True)
+            with app.app_context():
+                with db.engine.begin() as connection:
+                    connection.execute(text("INSERT INTO ingredient (name, unit) VALUES ('late', 'g')"))
+
+    inserted = []
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", insert_first)
+    try:
+        result = app.test_cli_runner().invoke(args=["import", path])
+    finally:
+        event.remove(engine, "before_cursor_execute", insert_first)
+    assert inserted
+    assert result.exit_code == 1
+    assert "conflicts with changes made while it was imported" in result.output
+    with app.app_context():
+        assert Ingredient.query.count() == 1
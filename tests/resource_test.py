@@ -1,16 +1,29 @@
+import glob
 import json
 import os
 import pytest
 import tempfile
 import time
 from datetime import datetime
+from flask import url_for
 from jsonschema import validate
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError, StatementError
 
 from bigrecipe import create_app, db
-from bigrecipe.models import Recipe, Ingredient, Drink, Recingpairings
+from bigrecipe.autocomplete import get_prefix_index
+from bigrecipe.cache import NameCache
+from bigrecipe.response_cache import ResponseCache, get_response_cache
+from bigrecipe.utils import (
+    BigrecipeBuilder, RouteTemplate, dumps_collection, encode_cursor, item_template, model_schema,
+    stream_collection
+)
+from bigrecipe.constants import BATCH_SIZE, INGREDIENT_PROFILE
+from bigrecipe.index import get_recipe_index
+from bigrecipe.matrix import get_recipe_matrix
+from bigrecipe.models import Recipe, Ingredient, Drink, Recingpairings, Revision
+from bigrecipe.similar import get_similar_index
 
 
 
@@ -27,6 +40,7 @@ def client():
     db_fd, db_fname = tempfile.mkstemp()
     config = {
         "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SIMILAR_INDEX_PATH": db_fname + "-similar",
         "TESTING": True
     }
     
@@ -40,6 +54,8 @@ def client():
     
     os.close(db_fd)
     os.unlink(db_fname)
+    for fname in glob.glob(db_fname + "-similar*"):
+        os.unlink(fname)
 
 def _populate_db():
     for i in range(1, 4):
@@ -292,6 +308,59 @@ def _check_control_post_method_drink(ctrl, client, obj):
     resp = client.post(href, json=body)
     assert resp.status_code == 201
 
+def _check_control_post_method_pantry(ctrl, client, obj):
+    """
+    Checks the pantry matching POST control. The control must carry a schema
+    that a valid pantry validates against, and using it must give 200.
+    """
+    
+    ctrl_obj = obj["@controls"][ctrl]
+    href = ctrl_obj["href"]
+    method = ctrl_obj["method"].lower()
+    encoding = ctrl_obj["encoding"].lower()
+    schema = ctrl_obj["schema"]
+    assert method == "post"
+    assert encoding == "json"
+    body = {"ingredients": [{"ingredient": "ingredient-1", "amount": 1}]}
+    validate(body, schema)
+    resp = client.post(href, json=body)
+    assert resp.status_code == 200
+
+def _check_control_post_method_recipe_batch(ctrl, client, obj):
+    """
+    Checks the POST control of a recipe batch. The control must carry a schema
+    that a valid batch validates against, and using it must give 200.
+    """
+    
+    ctrl_obj = obj["@controls"][ctrl]
+    href = ctrl_obj["href"]
+    method = ctrl_obj["method"].lower()
+    encoding = ctrl_obj["encoding"].lower()
+    schema = ctrl_obj["schema"]
+    assert method == "post"
+    assert encoding == "json"
+    body = {"recipes": [{"recipe": "recipe-1", "scale": 2}]}
+    validate(body, schema)
+    resp = client.post(href, json=body)
+    assert resp.status_code == 200
+
+def _check_control_post_method_batch(ctrl, client, obj):
+    """
+    Checks the POST control of the batch GET resource.
+    """
+    
+    ctrl_obj = obj["@controls"][ctrl]
+    href = ctrl_obj["href"]
+    method = ctrl_obj["method"].lower()
+    encoding = ctrl_obj["encoding"].lower()
+    schema = ctrl_obj["schema"]
+    assert method == "post"
+    assert encoding == "json"
+    body = {"requests": ["/api/recipes/recipe-1/"]}
+    validate(body, schema)
+    resp = client.post(href, json=body)
+    assert resp.status_code == 200
+
 class TestRecipeCollection(object):
     
     RESOURCE_URL = "/api/recipes/"
@@ -329,8 +398,230 @@ class TestRecipeCollection(object):
         valid.pop("text")
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 400
+
+    def test_get_paginated(self, client):
+        # walk forward through every page with the next controls
+        names = []
+        href = self.RESOURCE_URL
+        while href:
+            resp = client.get(href)
+            assert resp.status_code == 200
+            body = json.loads(resp.data)
+            names.extend(item["name"] for item in body["items"])
+            href = body["@controls"].get("next", {}).get("href")
+        assert names == ["recipe-1", "recipe-2", "recipe-3", "recipe-x"]
+        assert "next" not in body["@controls"]
+
+        # and back again with prev
+        resp = client.get(body["@controls"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert [item["name"] for item in body["items"]] == ["recipe-1", "recipe-2"]
+        assert "prev" not in body["@controls"]
+
+        # per request limit, clamped to the server maximum
+        resp = client.get(self.RESOURCE_URL + "?limit=3")
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 3
+        assert "limit=3" in body["@controls"]["next"]["href"]
+        resp = client.get(self.RESOURCE_URL + "?limit=100000")
+        assert len(json.loads(resp.data)["items"]) == 4
+
+        # ingredient filtered listing
+        resp = client.get(self.RESOURCE_URL + "?ingredient=ingredient-2")
+        body = json.loads(resp.data)
+        assert [item["name"] for item in body["items"]] == ["recipe-2"]
+        assert "next" not in body["@controls"]
+        _check_control_get_method("bigrec:ingredient", client, body)
+
+        # legacy offset paging still works
+        resp = client.get(self.RESOURCE_URL + "?start=2")
+        body = json.loads(resp.data)
+        assert [item["name"] for item in body["items"]] == ["recipe-3", "recipe-x"]
+        _check_control_get_method("prev", client, body)
+
+        resp = client.get(self.RESOURCE_URL + "?limit=0")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?after=%%%")
+        assert resp.status_code == 400
+
+    def test_get_filtered(self, client):
+        def names(query):
+            resp = client.get(self.RESOURCE_URL + query)
+            assert resp.status_code == 200
+            return [item["name"] for item in json.loads(resp.data)["items"]]
+
+        # build the index before writing so that the updates are exercised
+        assert names("?ingredient=ingredient-1&ingredient=ingredient-2") == []
+        resp = client.post("/api/recipes/recipe-2/ingredients/", json=_get_pairing_json())
+        assert resp.status_code == 201
+        assert names("?ingredient=ingredient-1&ingredient=ingredient-2") == ["recipe-2"]
+        assert names("?ingredient=ingredient-1") == ["recipe-1", "recipe-2"]
+        assert names("?ingredient=ingredient-1&exclude=ingredient-2") == ["recipe-1"]
+        assert names("?ingredient=not-ingredient") == []
+
+        # exclude only, paged through next controls
+        resp = client.get(self.RESOURCE_URL + "?exclude=ingredient-1")
+        body = json.loads(resp.data)
+        assert [item["name"] for item in body["items"]] == ["recipe-3", "recipe-x"]
+        assert "next" not in body["@controls"]
+        assert names("?exclude=ingredient-3&limit=1") == ["recipe-1"]
+        resp = client.get(self.RESOURCE_URL + "?exclude=ingredient-3&limit=1")
+        resp = client.get(json.loads(resp.data)["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [item["name"] for item in body["items"]] == ["recipe-2"]
+        assert "exclude=ingredient-3" in body["@controls"]["prev"]["href"]
+
+        # renames and pairing removals are reflected
+        resp = client.delete("/api/recipes/recipe-2/ingredients/", json=_get_pairing_json())
+        assert resp.status_code == 204
+        resp = client.put("/api/recipes/recipe-1/", json={"name": "recipe-0", "text": "t"})
+        assert resp.status_code == 204
+        assert names("?ingredient=ingredient-1") == ["recipe-0"]
+        # the writes above were applied in place, not by rebuilding
+        with client.application.app_context():
+            index = get_recipe_index(build=False)
+            assert index.versions == Revision.current("recipe-names", "pairing")
+        # writes that change neither names nor pairings don't make it stale
+        resp = client.put("/api/recipes/recipe-0/", json={"name": "recipe-0", "text": "stir"})
+        assert resp.status_code == 204
+        resp = client.put("/api/ingredients/ingredient-1/", json={"name": "ingredient-1", "unit": "u", "calories": 3})
+        assert resp.status_code == 204
+        with client.application.app_context():
+            assert index.versions == Revision.current("recipe-names", "pairing")
+
+        # a write made through another app on the same database is seen, even
+        # on a page in this app's response cache
+        other = create_app(dict(client.application.config, TESTING=True)).test_client()
+        resp = other.post(
+            "/api/recipes/recipe-3/ingredients/",
+            json={"recipe": "recipe-3", "ingredient": "ingredient-1", "amount": 1}
+        )
+        assert resp.status_code == 201
+        assert names("?ingredient=ingredient-1") == ["recipe-0", "recipe-3"]
         
         
+class TestRecipeCalories(object):
+
+    def test_totals(self, client):
+        def calories(name):
+            resp = client.get("/api/recipes/{}/".format(name))
+            return json.loads(resp.data)["calories"]
+
+        def listing(query):
+            resp = client.get("/api/recipes/" + query)
+            assert resp.status_code == 200
+            return [(item["name"], item["calories"]) for item in json.loads(resp.data)["items"]]
+
+        resp = client.put("/api/ingredients/ingredient-2/", json={"name": "ingredient-2", "unit": "u", "calories": 10})
+        assert resp.status_code == 204
+        assert calories("recipe-2") == 20
+        resp = client.post("/api/recipes/recipe-1/ingredients/", json={
+            "recipe": "recipe-1", "ingredient": "ingredient-2", "amount": 3
+        })
+        assert resp.status_code == 201
+        assert calories("recipe-1") == 30
+        etag = client.get("/api/recipes/").headers["ETag"]
+        name_only = client.get("/api/recipes/?fields=name").headers["ETag"]
+        resp = client.put("/api/ingredients/ingredient-2/", json={"name": "ingredient-2", "unit": "u", "calories": 5})
+        assert resp.status_code == 204
+        assert calories("recipe-1") == 15
+        assert calories("recipe-2") == 10
+        # the totals have their own revision, which pages without them ignore
+        assert client.get("/api/recipes/").headers["ETag"] != etag
+        assert client.get("/api/recipes/?fields=name").headers["ETag"] == name_only
+
+        batch = [{"name": "bulk", "text": "t", "ingredients": [{"ingredient": "ingredient-2", "amount": 2}]}]
+        resp = client.post("/api/bulk/recipes/", json=batch)
+        assert resp.status_code == 200
+        assert calories("bulk") == 10
+
+        # filtered and sorted without touching the pairings
+        assert listing("?sort=calories&limit=10") == [
+            ("recipe-3", 0), ("recipe-x", 0), ("bulk", 10), ("recipe-2", 10), ("recipe-1", 15)
+        ]
+        assert listing("?max_calories=10&min_calories=1") == [("bulk", 10), ("recipe-2", 10)]
+        assert listing("?max_calories=20&ingredient=ingredient-2") == [("bulk", 10), ("recipe-1", 15)]
+        resp = client.get("/api/recipes/?sort=calories&min_calories=1")
+        body = json.loads(resp.data)
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [item["name"] for item in body["items"]] == ["recipe-1"]
+        resp = client.get(body["@controls"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert [item["name"] for item in body["items"]] == ["bulk", "recipe-2"]
+
+        resp = client.delete("/api/recipes/recipe-1/ingredients/", json={
+            "recipe": "recipe-1", "ingredient": "ingredient-2"
+        })
+        assert resp.status_code == 204
+        assert calories("recipe-1") == 0
+
+        # fractional amounts give fractional totals
+        resp = client.post("/api/recipes/recipe-1/ingredients/", json={
+            "recipe": "recipe-1", "ingredient": "ingredient-2", "amount": 0.5
+        })
+        assert resp.status_code == 201
+        assert calories("recipe-1") == 2.5
+        assert listing("?min_calories=2.2&max_calories=2.8") == [("recipe-1", 2.5)]
+
+        resp = client.get("/api/recipes/?sort=size")
+        assert resp.status_code == 400
+        resp = client.get("/api/recipes/?max_calories=lots")
+        assert resp.status_code == 400
+        for cursor in ('[[1], "x"]', '[1, 2]', '[true, "x"]'):
+            resp = client.get("/api/recipes/?sort=calories&after=" + encode_cursor(cursor))
+            assert resp.status_code == 400
+
+
+class TestRecipeSearch(object):
+
+    RESOURCE_URL = "/api/recipes/search"
+
+    def test_get(self, client):
+        resp = client.get("/api/recipes/")
+        ctrl = json.loads(resp.data)["@controls"]["bigrec:search"]
+        assert ctrl["isHrefTemplate"]
+        resp = client.get(ctrl["href"].replace("{query}", "text"))
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        assert len(body["items"]) == 4
+        for item in body["items"]:
+            assert "<mark>text</mark>" in item["snippet"]
+            _check_control_get_method("self", client, item)
+
+        # cursor paging over the ranked results
+        names = []
+        href = self.RESOURCE_URL + "?q=text&limit=3"
+        while href:
+            body = json.loads(client.get(href).data)
+            names.extend(item["name"] for item in body["items"])
+            href = body["@controls"].get("next", {}).get("href")
+        assert sorted(names) == ["recipe-1", "recipe-2", "recipe-3", "recipe-x"]
+
+        # the index follows inserts, updates and deletes
+        resp = client.put("/api/recipes/recipe-1/", json={"name": "recipe-1", "text": "spicy stew"})
+        assert resp.status_code == 204
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=spicy stew").data)
+        assert [item["name"] for item in body["items"]] == ["recipe-1"]
+        resp = client.post("/api/recipes/", json={"name": "new", "text": "mild stew"})
+        assert resp.status_code == 201
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=stew").data)
+        assert sorted(item["name"] for item in body["items"]) == ["new", "recipe-1"]
+        resp = client.delete("/api/recipes/new/")
+        assert resp.status_code == 204
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=mild").data)
+        assert body["items"] == []
+
+        # query syntax in user input is treated as plain words
+        resp = client.get(self.RESOURCE_URL + '?q=" OR NEAR(')
+        assert resp.status_code == 200
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?q=text&after=bad")
+        assert resp.status_code == 400
+
+
 class TestRecipeItem(object):
     
     RESOURCE_URL = "/api/recipes/recipe-1/"
@@ -375,6 +666,8 @@ class TestRecipeItem(object):
 
     #Testing not-paired recipe deletion
     def test_delete(self, client):
+        resp = client.delete("/api/recipes/recipe-1/")
+        assert resp.status_code == 403
         resp = client.delete("/api/recipes/recipe-x/")
         assert resp.status_code == 204
         resp = client.delete("/api/recipes/recipe-x/")
@@ -391,6 +684,8 @@ class TestRecingpairings(object):
         resp = client.get(self.RESOURCE_URL)
         assert resp.status_code == 200
         body = json.loads(resp.data)
+        assert body["recipe"] == "recipe-1"
+        assert body["ingredients"] == {"ingredient-1": [1, "u"]}
         _check_namespace(client, body)
         _check_control_get_method("bigrec:recipe", client, body)
         _check_control_post_method_pairing("bigrec:add-pairing", client, body)
@@ -398,6 +693,312 @@ class TestRecingpairings(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
         
+class TestRecipeImport(object):
+
+    RESOURCE_URL = "/api/bulk/recipes/"
+
+    def test_post(self, client):
+        resp = client.get("/api/recipes/")
+        body = json.loads(resp.data)
+        ctrl = body["@controls"]["bigrec:import-recipes"]
+        assert ctrl["href"] == self.RESOURCE_URL
+        assert ctrl["method"].lower() == "post"
+        batch = [
+            {
+                "name": "bulk-1", "text": "bulk text",
+                "ingredients": [
+                    {"ingredient": "ingredient-1", "amount": 3},
+                    {"ingredient": "ingredient-2", "amount": 5}
+                ]
+            },
+            {"name": "bulk-2", "text": "bulk text", "description": "short"},
+            {"name": "recipe-1", "text": "already there"},
+            {"name": "bulk-1", "text": "twice in batch"},
+            {"name": "bulk-3"},
+            {"name": "bulk-4", "text": "t", "ingredients": [{"ingredient": "nothing", "amount": 1}]}
+        ]
+        validate(batch[:2], ctrl["schema"])
+
+        # test with wrong content type
+        resp = client.post(ctrl["href"], data=json.dumps(batch))
+        assert resp.status_code == 415
+
+        resp = client.post(ctrl["href"], json=batch)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["status"] for item in body["items"]] == [
+            "created", "created", "conflict", "conflict", "invalid", "invalid"
+        ]
+        _check_control_get_method("self", client, body["items"][0])
+        resp = client.get("/api/recipes/bulk-1/ingredients/")
+        body = json.loads(resp.data)
+        assert body["ingredients"] == {"ingredient-1": [3, "u"], "ingredient-2": [5, "u"]}
+        resp = client.get("/api/recipes/bulk-4/")
+        assert resp.status_code == 404
+
+        # the same batch as NDJSON only conflicts now
+        lines = "\n".join(json.dumps(item) for item in batch[:2])
+        resp = client.post(ctrl["href"], data=lines, content_type="application/x-ndjson")
+        body = json.loads(resp.data)
+        assert [item["status"] for item in body["items"]] == ["conflict", "conflict"]
+
+        resp = client.post(ctrl["href"], json={"name": "not-a-list"})
+        assert resp.status_code == 400
+
+class TestPantryMatch(object):
+
+    RESOURCE_URL = "/api/pantry/"
+
+    def test_post(self, client):
+        resp = client.get("/api/")
+        ctrl = json.loads(resp.data)["@controls"]["bigrec:pantry"]
+        assert ctrl["href"] == self.RESOURCE_URL
+
+        def match(pantry, **kwargs):
+            body = {"ingredients": pantry}
+            body.update(kwargs)
+            resp = client.post(self.RESOURCE_URL, json=body)
+            assert resp.status_code == 200
+            body = json.loads(resp.data)
+            return [(item["name"], item["missing"]) for item in body["items"]]
+
+        pantry = [{"ingredient": "ingredient-1"}, {"ingredient": "ingredient-2", "amount": 1}]
+        assert match(pantry, max_missing=0) == [("recipe-1", 0)]
+        assert match(pantry, max_missing=1) == [("recipe-1", 0), ("recipe-2", 1), ("recipe-3", 1)]
+        pantry[1]["amount"] = 2
+        assert match(pantry, max_missing=0) == [("recipe-1", 0), ("recipe-2", 0)]
+
+        resp = client.post(self.RESOURCE_URL, json={"ingredients": pantry, "max_missing": 1})
+        body = json.loads(resp.data)
+        _check_control_post_method_pantry("bigrec:pantry", client, body)
+        assert body["items"][2]["missing_ingredients"] == ["ingredient-3"]
+        _check_control_get_method("self", client, body["items"][0])
+
+        # new pairings are seen by the next match
+        resp = client.post("/api/recipes/recipe-2/ingredients/", json={
+            "recipe": "recipe-2", "ingredient": "ingredient-3", "amount": 1
+        })
+        assert resp.status_code == 201
+        assert match(pantry, max_missing=0) == [("recipe-1", 0)]
+
+        resp = client.post(self.RESOURCE_URL, data=json.dumps({"ingredients": pantry}))
+        assert resp.status_code == 415
+        resp = client.post(self.RESOURCE_URL, json={"max_missing": 1})
+        assert resp.status_code == 400
+
+class TestNutritionReport(object):
+
+    RESOURCE_URL = "/api/nutrition/"
+
+    def test_post(self, client):
+        resp = client.get("/api/")
+        ctrl = json.loads(resp.data)["@controls"]["bigrec:nutrition"]
+        assert ctrl["href"] == self.RESOURCE_URL
+
+        resp = client.put("/api/ingredients/ingredient-2/", json={"name": "ingredient-2", "unit": "u", "calories": 10})
+        assert resp.status_code == 204
+        resp = client.put("/api/ingredients/ingredient-3/", json={"name": "ingredient-3", "unit": "u", "calories": 1})
+        assert resp.status_code == 204
+        resp = client.post(self.RESOURCE_URL, json={"recipes": [
+            {"recipe": "recipe-3", "scale": 2},
+            {"recipe": "nothing"},
+            {"recipe": "recipe-2", "scale": 0.5},
+            {"recipe": "recipe-x"},
+            {"recipe": "recipe-1"}
+        ]})
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [(item["name"], item["calories"]) for item in body["items"]] == [
+            ("recipe-3", 6), ("recipe-2", 10), ("recipe-x", 0), ("recipe-1", 0)
+        ]
+        assert body["unknown"] == ["nothing"]
+        _check_control_post_method_recipe_batch("bigrec:nutrition", client, body)
+        _check_control_get_method("self", client, body["items"][0])
+
+        # the totals agree with the materialized column
+        resp = client.get("/api/recipes/recipe-2/")
+        assert json.loads(resp.data)["calories"] == 20
+
+        # text edits keep the loaded matrix, calorie changes replace it
+        with client.application.app_context():
+            matrix = get_recipe_matrix()
+        resp = client.put("/api/recipes/recipe-2/", json={"name": "recipe-2", "text": "stir"})
+        assert resp.status_code == 204
+        with client.application.app_context():
+            assert get_recipe_matrix() is matrix
+        resp = client.put("/api/ingredients/ingredient-2/", json={"name": "ingredient-2", "unit": "u", "calories": 1})
+        assert resp.status_code == 204
+        resp = client.post(self.RESOURCE_URL, json={"recipes": [{"recipe": "recipe-2"}]})
+        assert json.loads(resp.data)["items"][0]["calories"] == 2
+
+        resp = client.post(self.RESOURCE_URL, json={"recipes": []})
+        assert json.loads(resp.data)["items"] == []
+        resp = client.post(self.RESOURCE_URL, data=json.dumps({"recipes": []}))
+        assert resp.status_code == 415
+        resp = client.post(self.RESOURCE_URL, json={"recipes": [{"recipe": "recipe-1", "scale": -1}]})
+        assert resp.status_code == 400
+
+class TestShoppingList(object):
+
+    RESOURCE_URL = "/api/shopping-list"
+
+    def test_post(self, client):
+        resp = client.get("/api/")
+        ctrl = json.loads(resp.data)["@controls"]["bigrec:shopping-list"]
+        assert ctrl["href"] == self.RESOURCE_URL
+
+        resp = client.post("/api/recipes/recipe-2/ingredients/", json={
+            "recipe": "recipe-2", "ingredient": "ingredient-1", "amount": 4
+        })
+        assert resp.status_code == 201
+        resp = client.post(self.RESOURCE_URL, json={"recipes": [
+            {"recipe": "recipe-1", "scale": 2},
+            {"recipe": "recipe-2", "scale": 0.5},
+            {"recipe": "recipe-1"},
+            {"recipe": "recipe-x"},
+            {"recipe": "nothing"}
+        ]})
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["units"] == {"u": {"ingredient-1": 5, "ingredient-2": 1}}
+        assert body["unknown"] == ["nothing"]
+        _check_control_post_method_recipe_batch("bigrec:shopping-list", client, body)
+
+        resp = client.post(self.RESOURCE_URL, json={"recipes": []})
+        assert json.loads(resp.data)["units"] == {}
+        resp = client.post(self.RESOURCE_URL, data=json.dumps({"recipes": []}))
+        assert resp.status_code == 415
+        resp = client.post(self.RESOURCE_URL, json={"recipes": [{"scale": 1}]})
+        assert resp.status_code == 400
+
+class TestSimilarRecipes(object):
+
+    RESOURCE_URL = "/api/recipes/recipe-1/similar/"
+
+    def test_get(self, client):
+        def similar(recipe):
+            resp = client.get("/api/recipes/{}/similar/".format(recipe))
+            assert resp.status_code == 200
+            return [(item["name"], item["similarity"]) for item in json.loads(resp.data)["items"]]
+
+        resp = client.get("/api/recipes/recipe-1/")
+        body = json.loads(resp.data)
+        assert body["@controls"]["bigrec:similar"]["href"] == self.RESOURCE_URL
+        _check_control_get_method("bigrec:similar", client, body)
+
+        # identical ingredient sets always share every bucket
+        assert similar("recipe-1") == []
+        resp = client.post("/api/recipes/recipe-x/ingredients/", json={
+            "recipe": "recipe-x", "ingredient": "ingredient-1", "amount": 1
+        })
+        assert resp.status_code == 201
+        assert similar("recipe-1") == [("recipe-x", 1.0)]
+        batch = [{"name": "bulk", "text": "t", "ingredients": [{"ingredient": "ingredient-1", "amount": 2}]}]
+        resp = client.post("/api/bulk/recipes/", json=batch)
+        assert resp.status_code == 200
+        assert similar("recipe-1") == [("recipe-x", 1.0), ("bulk", 1.0)]
+        resp = client.get(self.RESOURCE_URL + "?limit=1")
+        assert len(json.loads(resp.data)["items"]) == 1
+
+        resp = client.delete("/api/recipes/recipe-x/ingredients/", json={
+            "recipe": "recipe-x", "ingredient": "ingredient-1"
+        })
+        assert resp.status_code == 204
+        resp = client.delete("/api/recipes/recipe-x/")
+        assert resp.status_code == 204
+        assert similar("recipe-1") == [("bulk", 1.0)]
+        # the writes above were applied in place, not by rebuilding
+        with client.application.app_context():
+            index = get_similar_index(build=False)
+            assert index.versions == Revision.current("pairing")
+
+        # only the build-similar command writes the files, which a fresh app
+        # then maps instead of computing the signatures
+        path = client.application.config["SIMILAR_INDEX_PATH"]
+        assert not glob.glob(path + "*")
+        result = client.application.test_cli_runner().invoke(args=["build-similar"])
+        assert "Indexed 4 recipes" in result.output
+        app = create_app(client.application.config)
+        with app.app_context():
+            index = get_similar_index(build=False)
+            assert index.load() and len(index) == 4
+            assert index.versions == Revision.current("pairing")
+
+        # writes that leave the pairings alone don't make the files stale
+        resp = client.post("/api/recipes/", json=_get_recipe_json())
+        assert resp.status_code == 201
+        resp = client.put("/api/recipes/recipe-1/", json={"name": "recipe-1", "text": "stir"})
+        assert resp.status_code == 204
+        resp = client.put("/api/ingredients/ingredient-1/", json={"name": "ingredient-1", "unit": "u", "calories": 3})
+        assert resp.status_code == 204
+        with create_app(client.application.config).app_context():
+            index = get_similar_index(build=False)
+            assert index.load() and index.versions == Revision.current("pairing")
+
+        # files older than the database are not used as they are
+        resp = client.post("/api/recipes/extra-recipe-1/ingredients/", json={
+            "recipe": "extra-recipe-1", "ingredient": "ingredient-1", "amount": 1
+        })
+        assert resp.status_code == 201
+        resp = create_app(client.application.config).test_client().get(self.RESOURCE_URL)
+        assert [item["name"] for item in json.loads(resp.data)["items"]] == ["bulk", "extra-recipe-1"]
+
+        resp = client.get("/api/recipes/nothing/similar/")
+        assert resp.status_code == 404
+        resp = client.get(self.RESOURCE_URL + "?limit=0")
+        assert resp.status_code == 400
+
+class TestAutocomplete(object):
+
+    RESOURCE_URL = "/api/autocomplete"
+
+    def test_get(self, client):
+        def complete(query):
+            resp = client.get(self.RESOURCE_URL + query)
+            assert resp.status_code == 200
+            return [item["name"] for item in json.loads(resp.data)["items"]]
+
+        assert complete("?kind=ingredient&prefix=INGREDIENT-") == [
+            "ingredient-1", "ingredient-2", "ingredient-3", "ingredient-x"
+        ]
+        assert complete("?kind=recipe&prefix=recipe-&limit=2") == ["recipe-1", "recipe-2"]
+        assert complete("?kind=drink&prefix=nothing") == []
+        resp = client.get(self.RESOURCE_URL + "?kind=drink&prefix=drink-3")
+        _check_control_get_method("self", client, json.loads(resp.data)["items"][0])
+
+        # writes keep the index current
+        resp = client.post("/api/drinks/", json=_get_drink_json())
+        assert resp.status_code == 201
+        resp = client.put("/api/drinks/drink-1/", json={"name": "Drink-0", "alcohol": False})
+        assert resp.status_code == 204
+        resp = client.delete("/api/drinks/drink-2/")
+        assert resp.status_code == 204
+        assert complete("?kind=drink&prefix=drink") == ["Drink-0", "drink-3"]
+        assert complete("?kind=drink&prefix=extra") == ["extra-drink-1"]
+        other = create_app(dict(client.application.config, TESTING=True)).test_client()
+        resp = other.post("/api/drinks/", json=_get_drink_json(2))
+        assert resp.status_code == 201
+        assert complete("?kind=drink&prefix=extra-") == ["extra-drink-1", "extra-drink-2"]
+
+        # writes that leave the names alone don't make the index stale
+        assert complete("?kind=recipe&prefix=recipe-") == ["recipe-1", "recipe-2", "recipe-3", "recipe-x"]
+        with client.application.app_context():
+            versions = get_prefix_index("recipe", build=False).versions
+        resp = client.post(
+            "/api/recipes/recipe-3/ingredients/",
+            json={"recipe": "recipe-3", "ingredient": "ingredient-1", "amount": 1}
+        )
+        assert resp.status_code == 201
+        resp = client.put("/api/ingredients/ingredient-1/", json={"name": "ingredient-1", "unit": "u", "calories": 3})
+        assert resp.status_code == 204
+        with client.application.app_context():
+            assert Revision.current("recipe-names") == versions
+
+        resp = client.get(self.RESOURCE_URL + "?kind=chair&prefix=a")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?prefix=a")
+        assert resp.status_code == 400
+
 class TestIngredientCollection(object):
     
     RESOURCE_URL = "/api/ingredients/"
@@ -437,6 +1038,32 @@ class TestIngredientCollection(object):
         assert resp.status_code == 400
         
         
+    def test_get_pages(self, client):
+        # walk forward two at a time, then back from the last page
+        names = []
+        url = self.RESOURCE_URL + "?limit=2&sort=calories"
+        while url:
+            body = json.loads(client.get(url).data)
+            assert len(body["items"]) <= 2
+            names.extend(item["name"] for item in body["items"])
+            last = body
+            url = body["@controls"].get("next", {}).get("href")
+        assert len(names) == 4
+        calories = [item.get("calories", 0) for item in json.loads(client.get(self.RESOURCE_URL + "?stream=true&sort=calories").data)["items"]]
+        assert calories == sorted(calories)
+        prev = json.loads(client.get(last["@controls"]["prev"]["href"]).data)
+        assert [item["name"] for item in prev["items"]] == names[-4:-2]
+
+        resp = client.get(self.RESOURCE_URL + "?sort=unit")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?sort=calories&after=bm90LWpzb24")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?sort=calories&after=" + encode_cursor('[[1], "x"]'))
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?limit=0")
+        assert resp.status_code == 400
+
+
 class TestIngredientItem(object):
     
     RESOURCE_URL = "/api/ingredients/ingredient-1/"
@@ -480,6 +1107,8 @@ class TestIngredientItem(object):
 
     #Testing not-paired ingredient deletion
     def test_delete(self, client):
+        resp = client.delete("/api/ingredients/ingredient-1/")
+        assert resp.status_code == 403
         resp = client.delete("/api/ingredients/ingredient-x/")
         assert resp.status_code == 204
         resp = client.delete("/api/ingredients/ingredient-x/")
@@ -524,6 +1153,25 @@ class TestDrinkCollection(object):
         valid.pop("alcohol")
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 400
+
+    def test_get_pages(self, client):
+        url = self.RESOURCE_URL + "?sort=alcohol&limit=1"
+        body = json.loads(client.get(url).data)
+        assert [item["name"] for item in body["items"]] == ["drink-1"]
+        assert "prev" not in body["@controls"]
+        body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+        assert [item["name"] for item in body["items"]] == ["drink-2"]
+        _check_control_get_method("prev", client, body)
+
+        # alcoholic drinks sort last, and the cached first page notices
+        resp = client.put(self.RESOURCE_URL + "drink-1/", json={"name": "drink-1", "alcohol": True})
+        assert resp.status_code == 204
+        body = json.loads(client.get(url).data)
+        assert [item["name"] for item in body["items"]] == ["drink-2"]
+        resp = client.get(self.RESOURCE_URL + "?sort=alcohol&after=" + encode_cursor('["x", "y"]'))
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?sort=alcohol&after=" + encode_cursor('[true, ["y"]]'))
+        assert resp.status_code == 400
         
         
 class TestDrinkItem(object):
@@ -575,4 +1223,589 @@ class TestDrinkItem(object):
         resp = client.delete(self.RESOURCE_URL)
         assert resp.status_code == 404
         resp = client.delete(self.INVALID_URL)
-        assert resp.status_code == 404
\ No newline at end of file
+        assert resp.status_code == 404
+
+class TestNameCache(object):
+
+    RESOURCE_URL = "/api/_stats/"
+
+    def test_rename_and_delete(self, client):
+        resp = client.get("/api/recipes/recipe-1/")
+        assert resp.status_code == 200
+        resp = client.get("/api/recipes/recipe-1/")
+        assert resp.status_code == 200
+        stats = json.loads(client.get(self.RESOURCE_URL).data)["name_cache"]
+        assert stats["hits"] >= 1
+        assert stats["size"] >= 1
+
+        # renamed rows must not be found by their old name
+        resp = client.put("/api/recipes/recipe-1/", json={"name": "renamed", "text": "t"})
+        assert resp.status_code == 204
+        resp = client.get("/api/recipes/recipe-1/")
+        assert resp.status_code == 404
+        resp = client.get("/api/recipes/renamed/")
+        assert resp.status_code == 200
+
+        # deleted rows neither
+        resp = client.get("/api/drinks/drink-1/")
+        assert resp.status_code == 200
+        resp = client.delete("/api/drinks/drink-1/")
+        assert resp.status_code == 204
+        resp = client.get("/api/drinks/drink-1/")
+        assert resp.status_code == 404
+
+    def test_reused_id(self, client):
+        resp = client.post("/api/recipes/", json=_get_recipe_json())
+        assert resp.status_code == 201
+        resp = client.get("/api/recipes/extra-recipe-1/")
+        assert resp.status_code == 200
+
+        # another process deletes the recipe and its id goes to a new one
+        other = create_app(dict(client.application.config, TESTING=True)).test_client()
+        resp = other.delete("/api/recipes/extra-recipe-1/")
+        assert resp.status_code == 204
+        resp = other.post("/api/recipes/", json=_get_recipe_json(2))
+        assert resp.status_code == 201
+
+        resp = client.post("/api/recipes/extra-recipe-1/ingredients/", json={
+            "recipe": "extra-recipe-1", "ingredient": "ingredient-1", "amount": 1
+        })
+        assert resp.status_code == 404
+        resp = client.get("/api/recipes/extra-recipe-2/ingredients/")
+        assert json.loads(resp.data)["ingredients"] == {}
+
+    def test_lru_bound(self):
+        cache = NameCache(2)
+        cache.put(("Recipe", "a"), 1)
+        cache.put(("Recipe", "b"), 2)
+        assert cache.get(("Recipe", "a")) == 1
+        cache.put(("Recipe", "c"), 3)
+        assert cache.get(("Recipe", "b")) is None
+        assert cache.get(("Recipe", "c")) == 3
+        stats = cache.stats()
+        assert stats["size"] == 2
+        assert stats["hits"] == 2
+        assert stats["misses"] == 1
+
+class TestConditionalRequests(object):
+
+    def _etag(self, client, url, status=200):
+        resp = client.get(url)
+        assert resp.status_code == status
+        return resp.headers["ETag"]
+
+    def test_item(self, client):
+        url = "/api/recipes/recipe-1/"
+        etag = self._etag(client, url)
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+        assert resp.data == b""
+        resp = client.get(url, headers={"If-None-Match": '"stale"'})
+        assert resp.status_code == 200
+
+        # renaming the linked drink changes the recipe representation
+        resp = client.put("/api/drinks/drink-1/", json={"name": "drink-0", "alcohol": False})
+        assert resp.status_code == 204
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["@controls"]["bigrec:drink"]["href"] == "/api/drinks/drink-0/"
+        etag = resp.headers["ETag"]
+
+        # so does a new pairing, through the calorie total
+        resp = client.post("/api/recipes/recipe-1/ingredients/", json={
+            "recipe": "recipe-1", "ingredient": "ingredient-2", "amount": 1
+        })
+        assert resp.status_code == 201
+        assert self._etag(client, url) != etag
+
+        recipe = _get_recipe_json()
+        recipe["name"] = "recipe-1"
+        resp = client.put(url, json=recipe, headers={"If-Match": etag})
+        assert resp.status_code == 412
+        etag = self._etag(client, url)
+        resp = client.put(url, json=recipe, headers={"If-Match": etag})
+        assert resp.status_code == 204
+        resp = client.put(url, json=recipe, headers={"If-Match": etag})
+        assert resp.status_code == 412
+
+        url = "/api/ingredients/ingredient-x/"
+        etag = self._etag(client, url)
+        resp = client.delete(url, headers={"If-Match": '"stale"'})
+        assert resp.status_code == 412
+        resp = client.delete(url, headers={"If-Match": etag})
+        assert resp.status_code == 204
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 404
+
+        # the same name created again gets a tag the old row never had
+        resp = client.post("/api/ingredients/", json={"name": "ingredient-x", "unit": "y"})
+        assert resp.status_code == 201
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["unit"] == "y"
+        resp = client.delete(url, headers={"If-Match": etag})
+        assert resp.status_code == 412
+
+    def test_collection(self, client):
+        url = "/api/ingredients/"
+        etag = self._etag(client, url)
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+
+        # unrelated collections keep their tags
+        resp = client.post("/api/drinks/", json=_get_drink_json())
+        assert resp.status_code == 201
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        resp = client.post(url, json=_get_ingredient_json())
+        assert resp.status_code == 201
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+
+        url = "/api/recipes/recipe-2/ingredients/"
+        etag = self._etag(client, url)
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        resp = client.put("/api/ingredients/ingredient-2/", json={"name": "ingredient-2", "unit": "kg"})
+        assert resp.status_code == 204
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["ingredients"]["ingredient-2"] == [2, "kg"]
+
+        url = "/api/recipes/"
+        etag = self._etag(client, url)
+        batch = [{"name": "bulk", "text": "t"}]
+        resp = client.post("/api/bulk/recipes/", json=batch)
+        assert resp.status_code == 200
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+
+class TestResponseCache(object):
+
+    RESOURCE_URL = "/api/_stats/"
+
+    def _stats(self, client):
+        return json.loads(client.get(self.RESOURCE_URL).data)["response_cache"]
+
+    def test_invalidation(self, client):
+        def names(url):
+            resp = client.get(url)
+            assert resp.status_code == 200
+            return [item["name"] for item in json.loads(resp.data)["items"]]
+
+        first = "/api/recipes/"
+        resp = client.get(first)
+        second = json.loads(resp.data)["@controls"]["next"]["href"]
+        assert names(second) == ["recipe-3", "recipe-x"]
+        assert names("/api/recipes/?sort=name&limit=3") == ["recipe-1", "recipe-2", "recipe-3"]
+        stats = self._stats(client)
+        assert stats["entries"] == 3
+        assert stats["hits"] == 0
+
+        # the query string is normalized
+        assert names("/api/recipes/?limit=3&sort=name") == ["recipe-1", "recipe-2", "recipe-3"]
+        resp = client.get(first, headers={"If-None-Match": resp.headers["ETag"]})
+        assert resp.status_code == 304
+        assert self._stats(client)["hits"] == 2
+
+        # an edit only evicts the pages the recipe is on
+        resp = client.put("/api/recipes/recipe-3/", json={"name": "recipe-3", "text": "t", "description": "new"})
+        assert resp.status_code == 204
+        assert self._stats(client)["entries"] == 1
+        resp = client.get(second)
+        assert json.loads(resp.data)["items"][0]["description"] == "new"
+
+        # pairing changes evict filtered pages
+        assert names("/api/recipes/?ingredient=ingredient-2") == ["recipe-2"]
+        resp = client.post("/api/recipes/recipe-1/ingredients/", json={
+            "recipe": "recipe-1", "ingredient": "ingredient-2", "amount": 1
+        })
+        assert resp.status_code == 201
+        assert names("/api/recipes/?ingredient=ingredient-2") == ["recipe-1", "recipe-2"]
+
+        # new rows evict the whole collection
+        assert names("/api/drinks/") == ["drink-1", "drink-2", "drink-3"]
+        resp = client.post("/api/drinks/", json=_get_drink_json())
+        assert resp.status_code == 201
+        assert names("/api/drinks/")[-1] == "extra-drink-1"
+        assert names("/api/ingredients/")[0] == "ingredient-1"
+        resp = client.put("/api/ingredients/ingredient-1/", json={"name": "aaa", "unit": "u"})
+        assert resp.status_code == 204
+        assert names("/api/ingredients/")[0] == "aaa"
+
+    def test_bounds(self, client):
+        cache = ResponseCache(10, 60)
+        cache.put("a", b"12345", "1", frozenset(["recipe"]))
+        cache.put("b", b"12345", "1", frozenset(["recipe:1"]))
+        assert cache.get("a") == (b"12345", "1")
+        cache.put("c", b"12345", "1", frozenset(["drink"]))
+        assert cache.get("b") is None
+        assert cache.stats()["evictions"] == 1
+        cache.invalidate("recipe")
+        assert cache.get("a") is None
+        assert cache.get("c") is not None
+
+        # a body read before an eviction is not stored after it
+        generation = cache.generation
+        cache.invalidate("drink")
+        cache.put("a", b"12345", "1", frozenset(["recipe"]), generation)
+        assert cache.get("a") is None
+        cache.put("a", b"12345", "1", frozenset(["recipe"]), cache.generation)
+        assert cache.get("a") is not None
+
+        # an entry stored under another ETag than the current one is dropped
+        assert cache.get("a", "1") is not None
+        assert cache.get("a", "2") is None
+        assert cache.get("a") is None
+
+        cache = ResponseCache(10, -1)
+        cache.put("a", b"12345", "1", frozenset())
+        assert cache.get("a") is None
+
+        app = create_app({"RESPONSE_CACHE": False, "TESTING": True})
+        with app.app_context():
+            assert get_response_cache() is None
+
+class TestItemTemplate(object):
+
+    def test_matches_url_for(self, client):
+        names = ["plain", "a b", "ä/ö", "x?y#z", "100%", "q'\"", "semi;colon&amp", "plus+sign"]
+        with client.application.test_request_context():
+            route = RouteTemplate("api.recipeitem", "recipe")
+            for name in names:
+                assert route(name) == url_for("api.recipeitem", recipe=name)
+
+            item = BigrecipeBuilder(name="a b", unit="u", calories=None)
+            item.add_control("self", url_for("api.ingredientitem", ingredient="a b"))
+            item.add_control("profile", INGREDIENT_PROFILE)
+            rendered = item_template("ingredient").render("a b", [("unit", "u"), ("calories", None)])
+            assert rendered == json.dumps(item)
+            assert json.loads(dumps_collection(BigrecipeBuilder(), [rendered])) == {"items": [item]}
+
+
+    def test_shared_schema(self):
+        schema = model_schema(Recipe)
+        assert schema == Recipe.get_schema()
+        with pytest.raises(TypeError):
+            schema["properties"]["name"]["type"] = "integer"
+        with pytest.raises(TypeError):
+            schema["required"].append("description")
+        assert model_schema(Recipe) == Recipe.get_schema()
+
+
+class TestStreaming(object):
+
+    @pytest.mark.parametrize("url", ["/api/ingredients/", "/api/drinks/"])
+    def test_stream_matches_buffered(self, client, url):
+        buffered = client.get(url)
+        streamed = client.get(url + "?stream=true")
+        assert streamed.status_code == 200
+        assert streamed.is_streamed
+        assert streamed.headers["ETag"] == buffered.headers["ETag"]
+        assert json.loads(streamed.data)["items"] == json.loads(buffered.data)["items"]
+        resp = client.get(url + "?stream=maybe")
+        assert resp.status_code == 400
+
+    def test_stream_chunks(self):
+        body = BigrecipeBuilder()
+        body.add_control("self", "/x")
+        items = ['{"n": %d}' % i for i in range(7)]
+        chunks = list(stream_collection(body, iter(items), size=3))
+        assert len(chunks) == 5
+        assert json.loads("".join(chunks)) == {"items": [{"n": i} for i in range(7)], "@controls": {"self": {"href": "/x"}}}
+        assert json.loads("".join(stream_collection(BigrecipeBuilder(), iter([])))) == {"items": []}
+
+
+class TestSparseFields(object):
+
+    def test_fields(self, client):
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with client.application.app_context():
+            event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            body = json.loads(client.get("/api/recipes/?limit=5").data)
+        finally:
+            with client.application.app_context():
+                event.remove(db.engine, "before_cursor_execute", record)
+        assert all("text" not in item for item in body["items"])
+        assert not [s for s in statements if "recipe.text" in s]
+
+        body = json.loads(client.get("/api/recipes/?limit=2&fields=text").data)
+        assert set(body["items"][0]) == {"name", "text", "@controls"}
+        assert "fields=text" in body["@controls"]["next"]["href"]
+        body = json.loads(client.get("/api/recipes/recipe-1/?fields=calories").data)
+        assert body["name"] == "recipe-1" and body["calories"] == 0
+        assert "text" not in body and "description" not in body
+        _check_control_get_method("bigrec:similar", client, body)
+
+        body = json.loads(client.get("/api/ingredients/?fields=unit&sort=calories").data)
+        assert set(body["items"][0]) == {"name", "unit", "@controls"}
+        body = json.loads(client.get("/api/drinks/drink-1/?fields=description").data)
+        assert set(body) - {"@controls", "@namespaces"} == {"name", "description"}
+
+        for url in ("/api/recipes/?fields=bogus", "/api/ingredients/ingredient-1/?fields=name,text"):
+            assert client.get(url).status_code == 400
+
+
+class TestEmbed(object):
+
+    def _count(self, client, url):
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with client.application.app_context():
+            event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            resp = client.get(url)
+        finally:
+            with client.application.app_context():
+                event.remove(db.engine, "before_cursor_execute", record)
+        return json.loads(resp.data), len(statements)
+
+    def test_collection(self, client):
+        # the number of queries doesn't grow with the page
+        small, few = self._count(client, "/api/recipes/?embed=ingredients,drink&limit=1")
+        body, many = self._count(client, "/api/recipes/?embed=ingredients,drink&limit=4")
+        assert len(body["items"]) == 4
+        assert few == many
+        first = body["items"][0]
+        assert [item["name"] for item in first["ingredients"]] == ["ingredient-1"]
+        assert first["ingredients"][0]["amount"] == 1
+        _check_control_get_method("self", client, first["ingredients"][0])
+        assert first["drink"]["name"] == "drink-1"
+        _check_control_get_method("self", client, first["drink"])
+        assert body["items"][3]["ingredients"] == []
+        assert body["items"][3]["drink"] is None
+        assert "embed=" in small["@controls"]["next"]["href"]
+
+        # embedded items are evicted from the response cache with their rows
+        resp = client.put("/api/drinks/drink-1/", json={"name": "drink-1", "alcohol": False, "description": "d"})
+        assert resp.status_code == 204
+        body = json.loads(client.get("/api/recipes/?embed=ingredients,drink&limit=4").data)
+        assert body["items"][0]["drink"]["description"] == "d"
+        resp = client.get("/api/recipes/?embed=steps")
+        assert resp.status_code == 400
+
+    def test_items(self, client):
+        resp = client.get("/api/recipes/recipe-1/?embed=ingredients,drink")
+        body = json.loads(resp.data)
+        assert body["ingredients"][0]["unit"] == "u"
+        assert body["drink"]["name"] == "drink-1"
+        etag = resp.headers["ETag"]
+
+        # a change to an embedded ingredient changes the tag
+        resp = client.put("/api/ingredients/ingredient-1/", json={"name": "ingredient-1", "unit": "g"})
+        assert resp.status_code == 204
+        resp = client.get("/api/recipes/recipe-1/?embed=ingredients", headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["ingredients"][0]["unit"] == "g"
+
+        body = json.loads(client.get("/api/ingredients/ingredient-1/?embed=recipes").data)
+        assert [item["name"] for item in body["recipes"]] == ["recipe-1"]
+        _check_control_get_method("self", client, body["recipes"][0])
+        body = json.loads(client.get("/api/drinks/drink-2/?embed=recipes").data)
+        assert [item["name"] for item in body["recipes"]] == ["recipe-2"]
+        resp = client.get("/api/drinks/drink-2/?embed=drink")
+        assert resp.status_code == 400
+
+
+class TestBatch(object):
+
+    RESOURCE_URL = "/api/batch"
+
+    def test_post(self, client):
+        paths = [
+            "/api/recipes/recipe-1/", "/api/recipes/recipe-2/?embed=drink", "/api/recipes/nope/",
+            "/api/ingredients/?limit=1", "/api/drinks/drink-3/", "/admin/", "/api/recipes"
+        ]
+        resp = client.post(self.RESOURCE_URL, json={"requests": paths})
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["path"] for item in body["items"]] == paths
+        assert [item["status"] for item in body["items"]] == [200, 200, 404, 200, 200, 404, 308]
+        for item in body["items"][:5]:
+            single = client.get(item["path"])
+            assert item["body"] == json.loads(single.data)
+            assert item["etag"] == single.get_etag()[0]
+        assert body["items"][1]["body"]["drink"]["name"] == "drink-2"
+        _check_control_post_method_batch("bigrec:batch", client, body)
+
+        resp = client.post(self.RESOURCE_URL, data=json.dumps({"requests": paths}))
+        assert resp.status_code == 415
+        resp = client.post(self.RESOURCE_URL, json={"requests": ["/api/"] * (BATCH_SIZE + 1)})
+        assert resp.status_code == 400
+
+    def test_grouped_lookups(self, client):
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        def count(names):
+            del statements[:]
+            with client.application.app_context():
+                event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                resp = client.post(self.RESOURCE_URL, json={
+                    "requests": ["/api/recipes/{}/".format(name) for name in names]
+                })
+            finally:
+                with client.application.app_context():
+                    event.remove(db.engine, "before_cursor_execute", record)
+            assert all(item["status"] == 200 for item in json.loads(resp.data)["items"])
+            return len(statements)
+
+        # rows are fetched together and their ETags made from them, so more
+        # paths don't mean more statements
+        one = count(["recipe-1"])
+        four = count(["recipe-1", "recipe-2", "recipe-3", "recipe-x"])
+        assert four == one
+
+
+class TestCatalog(object):
+
+    RESOURCE_URL = "/api/bulk/catalog/"
+
+    def _lines(self, items):
+        return "".join(json.dumps(item) + "\n" for item in items)
+
+    def test_get(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.mimetype == "application/x-ndjson"
+        items = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        assert [item["type"] for item in items] == ["ingredient"] * 4 + ["drink"] * 3 + ["recipe"] * 4 + ["pairing"] * 3
+        recipes = {item["name"]: item for item in items if item["type"] == "recipe"}
+        assert recipes["recipe-2"] == {"type": "recipe", "name": "recipe-2", "text": "text-2", "drink": "drink-2"}
+        assert "drink" not in recipes["recipe-x"]
+        assert {"type": "pairing", "recipe": "recipe-3", "ingredient": "ingredient-3", "amount": 3} in items
+
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": resp.headers["ETag"]})
+        assert resp.status_code == 304
+        client.put("/api/drinks/drink-1/", json={"name": "drink-1", "alcohol": True})
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": resp.headers["ETag"]})
+        assert resp.status_code == 200
+
+    def test_post(self, client):
+        export = client.get(self.RESOURCE_URL).get_data(as_text=True)
+        ndjson = "application/x-ndjson"
+
+        # everything exists already
+        resp = client.post(self.RESOURCE_URL, data=export, content_type=ndjson)
+        assert resp.status_code == 409
+        assert "Line 1" in json.loads(resp.data)["@error"]["@messages"][0]
+        resp = client.post(self.RESOURCE_URL + "?on_conflict=skip", data=export, content_type=ndjson)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert {item["type"]: item["skipped"] for item in body["items"]} == {
+            "ingredient": 4, "drink": 3, "recipe": 4, "pairing": 3
+        }
+        assert all(item["created"] == 0 for item in body["items"])
+
+        # new rows can refer to each other, overwritten recipes get the
+        # pairings of the file
+        lines = self._lines([
+            {"type": "ingredient", "name": "ingredient-1", "unit": "u", "calories": 10},
+            {"type": "ingredient", "name": "new-ingredient", "unit": "g", "calories": 2},
+            {"type": "recipe", "name": "new-recipe", "text": "new", "drink": "drink-1"},
+            {"type": "recipe", "name": "recipe-2", "text": "changed"},
+            {"type": "pairing", "recipe": "new-recipe", "ingredient": "new-ingredient", "amount": 5},
+            {"type": "pairing", "recipe": "recipe-2", "ingredient": "ingredient-1", "amount": 3},
+        ])
+        resp = client.post(self.RESOURCE_URL + "?on_conflict=overwrite", data=lines, content_type=ndjson)
+        assert resp.status_code == 200
+        counts = {item["type"]: item for item in json.loads(resp.data)["items"]}
+        assert counts["ingredient"]["created"] == 1 and counts["ingredient"]["overwritten"] == 1
+        assert counts["recipe"]["created"] == 1 and counts["recipe"]["overwritten"] == 1
+        assert counts["pairing"]["created"] == 2
+        body = json.loads(client.get("/api/recipes/recipe-2/").data)
+        assert body["text"] == "changed" and body["calories"] == 30
+        assert json.loads(client.get("/api/recipes/recipe-1/").data)["calories"] == 10
+        assert json.loads(client.get("/api/recipes/new-recipe/").data)["calories"] == 10
+        pairings = json.loads(client.get("/api/recipes/recipe-2/ingredients/").data)["ingredients"]
+        assert pairings == {"ingredient-1": [3, "u"]}
+        resp = client.get("/api/recipes/?ingredient=new-ingredient")
+        assert [item["name"] for item in json.loads(resp.data)["items"]] == ["new-recipe"]
+        resp = client.get("/api/autocomplete?kind=ingredient&prefix=new")
+        assert [item["name"] for item in json.loads(resp.data)["items"]] == ["new-ingredient"]
+
+        # a bad line rolls back the lines before it
+        lines = self._lines([
+            {"type": "ingredient", "name": "rolled-back", "unit": "g"},
+            {"type": "pairing", "recipe": "nope", "ingredient": "rolled-back", "amount": 1},
+        ])
+        resp = client.post(self.RESOURCE_URL, data=lines, content_type=ndjson)
+        assert resp.status_code == 400
+        assert "Line 2" in json.loads(resp.data)["@error"]["@messages"][0]
+        assert client.get("/api/ingredients/rolled-back/").status_code == 404
+        for line in ['{"type": "recipe", "name": 1, "text": "x"}', '{"type": "user"}', "[1", '{"type": ["recipe"]}']:
+            resp = client.post(self.RESOURCE_URL, data=line, content_type=ndjson)
+            assert resp.status_code == 400
+
+        resp = client.post(self.RESOURCE_URL, json=[])
+        assert resp.status_code == 415
+        resp = client.post(self.RESOURCE_URL + "?on_conflict=merge", data=export, content_type=ndjson)
+        assert resp.status_code == 400
+
+
+class TestMetrics(object):
+
+    RESOURCE_URL = "/api/_metrics"
+
+    def _samples(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/plain"
+        samples = {}
+        for line in resp.get_data(as_text=True).splitlines():
+            if not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_disabled(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 404
+        assert "metrics" not in client.application.extensions
+
+    def test_get(self, tmp_path):
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "test.db"),
+            "SIMILAR_INDEX_PATH": str(tmp_path / "similar"),
+            "METRICS": True,
+            "TESTING": True
+        })
+        with app.app_context():
+            db.create_all()
+            _populate_db()
+        client = app.test_client()
+        for i in range(3):
+            resp = client.get("/api/recipes/recipe-1/")
+            assert resp.status_code == 200
+        size = len(resp.data)
+        resp = client.post("/api/recipes/", json=_get_recipe_json())
+        assert resp.status_code == 201
+        with client.get("/api/ingredients/?stream=true") as resp:
+            streamed = len(resp.data)
+
+        samples = self._samples(client)
+        item = '{resource="RecipeItem",method="GET"'
+        assert samples["bigrecipe_requests_total" + item + "}"] == 3
+        assert samples["bigrecipe_request_duration_seconds_count" + item + "}"] == 3
+        assert samples["bigrecipe_request_duration_seconds_bucket" + item + ',le="+Inf"}'] == 3
+        assert samples["bigrecipe_request_duration_seconds_bucket" + item + ',le="0.001"}'] <= 3
+        assert samples["bigrecipe_request_duration_seconds_sum" + item + "}"] > 0
+        assert samples["bigrecipe_sql_statements_total" + item + "}"] >= 3
+        assert samples["bigrecipe_sql_seconds_total" + item + "}"] > 0
+        assert samples["bigrecipe_serialization_seconds_total" + item + "}"] > 0
+        assert samples["bigrecipe_response_bytes_total" + item + "}"] == 3 * size
+        assert samples['bigrecipe_requests_total{resource="RecipeCollection",method="POST"}'] == 1
+        stream = '{resource="IngredientCollection",method="GET"}'
+        assert samples["bigrecipe_response_bytes_total" + stream] == streamed
+        assert samples["bigrecipe_sql_statements_total" + stream] >= 1
+        with app.app_context():
+            db.engine.dispose()